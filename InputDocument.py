@@ -1,43 +1,173 @@
 import fitz
 from pathlib import Path
 import os
+import numpy as np
+from PIL import Image
+
+RENDER_DPI = int(os.environ.get("RENDER_DPI", "72"))
+COLORSPACES = {"rgb": fitz.csRGB, "gray": fitz.csGRAY}
+# Citation thumbnails saved next to the page images; a width of 0 disables them
+THUMBNAIL_WIDTH = int(os.environ.get("THUMBNAIL_WIDTH", "320"))
+THUMBNAIL_FORMAT = os.environ.get("THUMBNAIL_FORMAT", "webp")
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "75"))
+THUMBNAIL_FORMATS = {"webp": ("WEBP", "webp"), "jpeg": ("JPEG", "jpg")}
+
+def parse_page_range(pages, total_pages):
+    """
+    Turns a page selection into a sorted list of 1-based page numbers.
+
+    :param pages: None for every page, a string such as "1-3,7", or an iterable of page numbers.
+    :param total_pages: Page count of the document; pages outside it are dropped.
+    """
+    if pages is None:
+        return list(range(1, total_pages + 1))
+    if isinstance(pages, str):
+        selected = set()
+        for part in pages.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if "-" in part:
+                start, end = part.split("-", 1)
+                selected.update(range(int(start or 1), int(end or total_pages) + 1))
+            else:
+                selected.add(int(part))
+        pages = selected
+    return sorted(pageno for pageno in set(pages) if 1 <= pageno <= total_pages)
+
+def thumbnail_path(images_folder, pageno, image_format=THUMBNAIL_FORMAT):
+    return os.path.join(images_folder, f"page_{pageno}.thumb.{THUMBNAIL_FORMATS[image_format][1]}")
+
 class InputDocument:
-    def __init__(self, document_name, file_path, save_images_to_disk=True):
+    """
+    A PDF whose pages are rendered one at a time.
+
+    Every rendering method is a generator that renders a page, hands it over
+    and releases it before rendering the next, so memory stays at one page
+    whatever the length of the document. Page numbers are 1-based.
+
+    :param dpi: Render resolution, 72 renders at the PDF's native size.
+    :param colorspace: "rgb" or "gray".
+    :param pages: Pages rendered to disk on creation, see parse_page_range.
+    """
+    def __init__(self, document_name, file_path, save_images_to_disk=True, dpi=RENDER_DPI, colorspace="rgb", pages=None):
         self.document_name = document_name
-        self.pages = []
         space_path = Path(file_path).parent.absolute()
         self.file_path = file_path
-        self.imagesfolder = os.path.join(space_path,self.document_name[0:self.document_name.rindex(".")] ) 
+        self.dpi = dpi
+        self.colorspace = colorspace
+        self._document = None
+        self.current_page = 0
+        self.imagesfolder = os.path.join(space_path,self.document_name[0:self.document_name.rindex(".")] )
         if save_images_to_disk:
             if not os.path.exists(self.imagesfolder):
-                if not os.path.exists(self.imagesfolder):
-                    os.makedirs(self.imagesfolder)
-                    print("Image folder path:", self.imagesfolder)
-                    self.document = fitz.open(file_path)
-                    self.total_pages = self.document.page_count
-                    self.pages = [self.document.load_page(i).get_pixmap() for i in range(self.total_pages)]
-                    self.current_page = 0
-                    paths = self.save_pixmaps_to_images()
-                    #return paths
+                os.makedirs(self.imagesfolder)
+                print("Image folder path:", self.imagesfolder)
+                for _ in self.save_pages(pages):
+                    pass
         else:
-            # document is already processed 
+            # document is already processed
             return None
 
-    def save_pixmaps_to_images(self):
-        image_paths = []
-        for i, pixmap in enumerate(self.pages):
-            image_path = os.path.join(self.imagesfolder, f"page_{i+1}.png")
-            pixmap.save(image_path)
-            image_paths.append(image_path)
-            print(f"Saved page {i+1} to {image_path}")
-        return image_paths
+    @property
+    def document(self):
+        if self._document is None:
+            self._document = fitz.open(self.file_path)
+        return self._document
+
+    @property
+    def total_pages(self):
+        return self.document.page_count
+
+    def close(self):
+        if self._document is not None:
+            self._document.close()
+            self._document = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def image_path(self, pageno):
+        return os.path.join(self.imagesfolder, f"page_{pageno}.png")
+
+    def thumbnail_path(self, pageno, image_format=THUMBNAIL_FORMAT):
+        return thumbnail_path(self.imagesfolder, pageno, image_format)
+
+    def render_page(self, pageno, dpi=None, colorspace=None):
+        """Renders one page to a fitz.Pixmap."""
+        dpi = dpi or self.dpi
+        colorspace = COLORSPACES[colorspace or self.colorspace]
+        page = self.document.load_page(pageno - 1)
+        if dpi == 72:
+            return page.get_pixmap(colorspace=colorspace)
+        return page.get_pixmap(dpi=dpi, colorspace=colorspace)
+
+    def iter_pixmaps(self, pages=None, dpi=None, colorspace=None):
+        """Yields (pageno, pixmap) for the selected pages, one rendered page alive at a time."""
+        for pageno in parse_page_range(pages, self.total_pages):
+            pixmap = self.render_page(pageno, dpi=dpi, colorspace=colorspace)
+            yield pageno, pixmap
+            pixmap = None
+
+    def save_pages(self, pages=None, dpi=None, colorspace=None):
+        """
+        Renders and saves the selected pages to ``page_<n>.png``, yielding each path.
+
+        Each image is written to a temporary file first, so an interrupted run
+        never leaves a truncated PNG behind.
+        """
+        os.makedirs(self.imagesfolder, exist_ok=True)
+        for pageno, pixmap in self.iter_pixmaps(pages, dpi=dpi, colorspace=colorspace):
+            image_path = self.image_path(pageno)
+            pixmap.save(f"{image_path}.tmp", output="png")
+            os.replace(f"{image_path}.tmp", image_path)
+            print(f"Saved page {pageno} to {image_path}")
+            yield image_path
+
+    def save_thumbnails(self, pages=None, width=THUMBNAIL_WIDTH, image_format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY):
+        """
+        Renders the selected pages ``width`` pixels wide and saves them as
+        compressed WebP or JPEG thumbnails, yielding each path.
+
+        Each page is rendered straight at thumbnail size rather than scaled down
+        from a full render.
+        """
+        pil_format, _ = THUMBNAIL_FORMATS[image_format]
+        os.makedirs(self.imagesfolder, exist_ok=True)
+        for pageno in parse_page_range(pages, self.total_pages):
+            page = self.document.load_page(pageno - 1)
+            zoom = width / page.rect.width
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+            image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+            path = self.thumbnail_path(pageno, image_format)
+            image.save(f"{path}.tmp", format=pil_format, quality=quality)
+            os.replace(f"{path}.tmp", path)
+            yield path
+
+    def save_pixmaps_to_images(self, pages=None):
+        return list(self.save_pages(pages))
+
+    def iter_buffers(self, pages=None, dpi=None, colorspace=None, output="png"):
+        """Yields (pageno, encoded image bytes) without touching the disk."""
+        for pageno, pixmap in self.iter_pixmaps(pages, dpi=dpi, colorspace=colorspace):
+            yield pageno, pixmap.tobytes(output)
+
+    def iter_arrays(self, pages=None, dpi=None, colorspace=None):
+        """Yields (pageno, HxWxC uint8 array) that OCR can consume without an image file."""
+        for pageno, pixmap in self.iter_pixmaps(pages, dpi=dpi, colorspace=colorspace):
+            array = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+            yield pageno, array.copy()
+
     @property
     def extension(self):
         return self.document_name.split('.')[-1] if '.' in self.document_name else ''
 
     def get_current_page_pixmap(self):
         if 0 <= self.current_page < self.total_pages:
-            return self.pages[self.current_page]
+            return self.render_page(self.current_page + 1)
         else:
             return None
 
@@ -58,5 +188,3 @@ class InputDocument:
             self.current_page = page_number
         else:
             print("Page number out of range.")
-
-
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_file,send_from_directory, abort
+from flask import Flask, request, jsonify, send_file,send_from_directory, abort, Response
 from flask_cors import CORS
 import sys
 import os
@@ -7,6 +7,8 @@ from io import BytesIO
 from PIL import Image
 from werkzeug.utils import secure_filename
 import json, os, signal
+import re
+import time
 from InputDocument import InputDocument
 import requests
 from dotenv import load_dotenv
@@ -14,21 +16,26 @@ import pathlib
 import textwrap
 import psycopg2
 from datetime import datetime
-from paddleocr import PaddleOCR
 import google.generativeai as genai
 import tqdm as notebook_tqdm
 from psycopg2.extras import execute_values
 from psycopg2.extras import DictCursor
 import numpy as np
-from sentence_transformers import SentenceTransformer
 load_dotenv()
 import logging
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from sqltools.dataaccess import DataKeeper
+from embedlib.embeddings import embedding_cache, get_embeddings
+from embedlib.client import EmbeddingError
+from embedlib.backends import get_backend, check_dimension
+from searchlib.federated import federated_search
+from extractor.pipeline import IngestionPipeline, file_hash, ingestion_stats, render_missing_page, render_missing_thumbnail, warmup as warmup_ingestion
+from extractor.chunking import Chunker
+from extractor.extractor import extraction_settings
+from jobs.worker import JobWorker, JobCancelled, describe_job, TERMINAL_STATUSES
+from concurrent.futures import ThreadPoolExecutor
 dbkeeper = DataKeeper()
 
-#ocr = PaddleOCR(use_angle_cls=True, lang='en')
-#ocr = None
 GOOGLE_API_KEY = os.environ["GEMINI_API_KEY"]
 genai.configure(api_key=GOOGLE_API_KEY)
 gemini_model = genai.GenerativeModel('gemini-1.5-flash')
@@ -37,6 +44,11 @@ app = Flask(__name__)
 CORS(app)
 
 ROOT_DIR = 'spaces'
+JOB_EVENTS_SECONDS = float(os.environ.get("JOB_EVENTS_SECONDS", "1.0"))
+FEDERATED_BUDGET_MS = int(os.environ.get("FEDERATED_BUDGET_MS", "2000"))
+FEDERATED_MAX_BUDGET_MS = int(os.environ.get("FEDERATED_MAX_BUDGET_MS", "10000"))
+FEDERATED_MAX_ROWS = int(os.environ.get("FEDERATED_MAX_ROWS", "100"))
+federated_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("FEDERATED_WORKERS", "8")))
 # PostgreSQL connection
 conn = psycopg2.connect(
     dbname=os.environ["DBNAME"],
@@ -50,8 +62,6 @@ db = os.environ["DBNAME"]
 dbschema = os.environ["SCHEMA"]
 dbtable = "spaces_embeddings"
 cur = conn.cursor()
-model_dir = "models/all-MiniLM-L6-v2"
-embedding_model = ''
 logging.basicConfig(level=logging.DEBUG)
 # # Example usage:
 # db_config = {
@@ -63,95 +73,26 @@ logging.basicConfig(level=logging.DEBUG)
 # }
 
 #db_manager = DatabaseManager(db_config)
-# Check if the model directory exists
-if not os.path.exists(model_dir):
-    # Load and save the model to the specified directory
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-    embedding_model.save(model_dir)
-else:
-    # Load the model from the specified directory
-    embedding_model = SentenceTransformer(model_dir)
-
-# Function to perform OCR on an image
-def perform_ocr(image_path):
-    ocr = None 
-    if ocr is None:
-        ocr = PaddleOCR(use_angle_cls=True, lang='en') 
-    #else:
-    try:
-        result = ocr.ocr(image_path, cls=True)      
-        ocr_text = "\n".join([line[1][0] for line in result[0]])
-    except Exception as e:
-        logging.exception(e)
-    return ocr_text
-
-def get_embeddings(content):
-    url = "http://localhost:11434/api/embeddings"
-    payload = {
-        "model": "nomic-embed-text",
-        "prompt": content
-    }
-    headers = {
-        "Content-Type": "application/json"
-    }
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
-    response.raise_for_status()
-    return response.json()["embedding"]
-
-def get_top(query_embedding, conn, schema, table, space, filename=None, numrows=5):
-    try:
-        with conn.cursor() as cursor:
-            if filename:
-                cur.execute(f"""
-                    SELECT pageno, context, metadata, source, imagepath, embedding, COALESCE(numtokens, 0)
-                    FROM {schema}.{table} where metadata->>'space' = %s
-                    and source = %s
-                """, (space, filename))
-            else:
-                cur.execute(f"""
-                    SELECT pageno, context, metadata, source, imagepath, embedding, COALESCE(numtokens, 0)
-                    FROM {schema}.{table} where metadata->>'space' = %s
-                """, (space,))
-            rows = cur.fetchall()
-            print("rows", len(rows))
-            results = []
-            for row in rows:
-                pageno, context, metadata, source, imagepath, embedding_str, numtokens = row
-                try:
-                    if isinstance(embedding_str, str):
-                        embedding = json.loads(embedding_str)
-                    elif isinstance(embedding_str, (bytes, bytearray)):
-                        embedding = json.loads(embedding_str.decode('utf-8'))
-                    elif isinstance(embedding_str, list):
-                        embedding = np.array(embedding_str)
-                    else:
-                        embedding = embedding_str
-
-                    norm = np.linalg.norm(embedding)
-                    if norm == 0:
-                        logging.warning(f"Skipping normalization for zero vector: {embedding}")
-                        continue
-
-                    embedding = embedding / norm
-                    similarity = np.dot(query_embedding, embedding)
-
-                    numtokens = numtokens if numtokens is not None else 0
-                    weighted_similarity = similarity * (1 + 0.01 * numtokens)
-
-                    results.append((pageno, context, metadata, source, imagepath, weighted_similarity))
-                except json.JSONDecodeError as e:
-                    logging.error(f"JSON decode error for row: {e}")
-                except Exception as e:
-                    logging.error(f"Error processing row : {e}")
-
-            results.sort(key=lambda x: x[-1], reverse=True)
-            top_docs = results
-
-            return top_docs
-    except Exception as e:
-        print(e)
-        rows = ""
-    return rows
+# Embeddings come from EMBEDDING_BACKEND (Ollama over HTTP or an in-process
+# SentenceTransformer); its vectors must fit the VECTOR(n) embedding column
+embedding_backend = get_backend()
+check_dimension(embedding_backend, dbkeeper.get_vector_dimension())
+
+# Pages are split into chunks sized in the embedding model's tokens, see extractor/chunking.py
+chunker = Chunker()
+
+# With app.run(debug=True) this module is also imported by the Werkzeug reloader's
+# parent process, which only watches files; background work belongs to the child
+# it serves from (WERKZEUG_RUN_MAIN), or to the process of a WSGI server
+SERVING_PROCESS = __name__ != '__main__' or os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+
+# Render and OCR workers are forked before the server starts any threads,
+# and each OCR worker loads its PaddleOCR models once
+if SERVING_PROCESS and os.environ.get("OCR_WARMUP", "true").lower() == "true":
+    warmup_ingestion()
+
+def get_top(query_embedding, conn, schema, table, space, filename=None, numrows=5, query_text=None):
+    return dbkeeper.get_top_chunks(query_embedding, schema, table, space, filename=filename, numrows=numrows, query_text=query_text)
 
 def save_ocr_result(source, pageno, imagesource, ocrtext, embedding, cost, metadata):
     try:
@@ -166,14 +107,16 @@ def save_ocr_result(source, pageno, imagesource, ocrtext, embedding, cost, metad
         raise
     return cur.fetchone()[0]
 
-@app.route('/files', methods=['POST'])
+@app.route('/files', methods=['GET', 'POST'])
 def serve_file():
     try:
         BASE_DIRECTORY = "spaces"
-        data = request.get_json()
+        # GET takes the same fields as query parameters, so browsers can cache the images
+        data = request.get_json(silent=True) if request.method == 'POST' else request.args
         space = data.get('space')
         source = data.get('source')
         filename = data.get('filename')
+        thumbnail = data.get('size') == 'thumbnail'
 
         if not space or not source or not filename:
             abort(400, description="Invalid request, 'space', 'source', and 'filename' are required")
@@ -189,7 +132,27 @@ def serve_file():
             abort(403)
 
         directory = os.path.join(BASE_DIRECTORY, space, pdf_name) if filename.endswith('.png') else os.path.join(BASE_DIRECTORY, space)
-        return send_from_directory(directory, filename)
+        # Pages read from the PDF's text layer are only rendered the first time they are shown
+        page_match = re.fullmatch(r"page_(\d+)\.png", filename)
+        pdf_path = os.path.join(BASE_DIRECTORY, space, source)
+        if page_match and os.path.exists(pdf_path):
+            if not os.path.abspath(pdf_path).startswith(os.path.abspath(BASE_DIRECTORY)):
+                abort(403)
+            if thumbnail:
+                # Compressed thumbnail saved at ingestion, see InputDocument.save_thumbnails
+                filename = os.path.basename(render_missing_thumbnail(pdf_path, directory, int(page_match.group(1))))
+            elif not os.path.exists(file_path):
+                render_missing_page(pdf_path, directory, int(page_match.group(1)))
+        # Re-indexing re-renders page images at the same URL, so every response is
+        # revalidated with its ETag / Last-Modified; unchanged files cost a 304.
+        # Uploaded documents stay out of shared caches.
+        response = send_from_directory(directory, filename, conditional=True, etag=True, max_age=0)
+        response.cache_control.no_cache = True
+        if page_match:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+        return response
     except FileNotFoundError:
         abort(404)
     except Exception as e:
@@ -265,6 +228,14 @@ def save_conversation():
 
     return jsonify({"status": "conversation saved"})
 
+@app.route('/embedding_cache_stats', methods=['GET'])
+def embedding_cache_stats():
+    return jsonify(embedding_cache.stats())
+
+@app.route('/ingestion_stats', methods=['GET'])
+def get_ingestion_stats():
+    return jsonify(ingestion_stats())
+
 @app.route('/list_spaces', methods=['GET'])
 def list_spaces():
     spaces = [name for name in os.listdir(ROOT_DIR) if os.path.isdir(os.path.join(ROOT_DIR, name))]
@@ -295,7 +266,8 @@ def list_files(space):
         files = []
         for f in os.listdir(space_path):
             file_path = os.path.join(space_path, f)
-            if "DS_Store" not in file_path:
+            # Dotfiles are internal, e.g. the vector index of the space
+            if not f.startswith("."):
                 if os.path.isfile(file_path):
                     images_folder = file_path[0:file_path.rindex(".")]
                     images_folder_path = images_folder
@@ -344,20 +316,31 @@ def chat():
     model = data.get('model')
     spaces = dbkeeper.get_space_by_name(space)
     space_id = spaces["id"]
+    index_version = spaces.get("index_version")
+    file_id = None
     if filename:
-        files = dbkeeper.get_file_by_name(filename)
+        files = dbkeeper.get_file_by_name(filename, space_id=space_id)
         file_id = files["id"]
     user_ip = request.remote_addr
     if not space or not question:
         return jsonify({"error": "Space and query are required"}), 400
 
     try:
+        question_to_index = f"{space}/{filename} - {question}"
+        question_to_indexembed = get_embeddings(question_to_index)
+        # A close enough question answered against the current index skips retrieval and the LLM
+        cached = dbkeeper.find_cached_answer(space_id, file_id, question_to_indexembed)
+        if cached:
+            answer_prefix = f"{space}/{filename} - "
+            content = cached["text"][len(answer_prefix):] if cached["text"].startswith(answer_prefix) else cached["text"]
+            return jsonify({"role": "assistant", "content": content, "citations": cached["citations"] or [], "cached": True}), 200
+
         embed = get_embeddings(question)
 
         if filename:
-            res = get_top(embed, conn=conn, schema=dbschema, table=f"spaces_embeddings", space=space, filename=filename, numrows=10)
+            res = get_top(embed, conn=conn, schema=dbschema, table=f"spaces_embeddings", space=space, filename=filename, numrows=10, query_text=question)
         else:
-            res = get_top(embed, conn=conn, schema=dbschema, table=f"spaces_embeddings", space=space, numrows=10)
+            res = get_top(embed, conn=conn, schema=dbschema, table=f"spaces_embeddings", space=space, numrows=10, query_text=question)
 
         citations = [{"fileName": doc[3], "thumbnail": doc[4]} for doc in res[:2]]
         envelope = f"You are a friendly AI assistant who finds information for HR assistants, Engineers, sales teams and many more. only using the given context {res} answer the question in as much detail as you can, here is the question or instruction {question}"
@@ -371,19 +354,17 @@ def chat():
                 response_message = gemini_model.generate_content(envelope)
                 response = {"content": response_message.text, "citations": citations}
                 # Create the conversation in DB
-                question_to_index = f"{space}/{filename} - {question}"  
-                question_to_indexembed =  get_embeddings(question_to_index)
                 if filename :
-                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=file_id, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed)
+                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=file_id, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed, index_version=index_version)
                 else:
-                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=None, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed)
+                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=None, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed, index_version=index_version)
                 
                 response_to_index = f"{space}/{filename} - {response_message.text}"  
                 response_to_indexembed =  get_embeddings(response_to_index)
                 if filename :
-                    dbkeeper.create_conversation(sender="ai", text=response_to_index, space_id = space_id, file_id=file_id, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed)
+                    dbkeeper.create_conversation(sender="ai", text=response_to_index, space_id = space_id, file_id=file_id, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed, citations=citations, index_version=index_version)
                 else:
-                    dbkeeper.create_conversation(sender="ai", text=response_to_index, space_id = space_id, file_id=None, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed)
+                    dbkeeper.create_conversation(sender="ai", text=response_to_index, space_id = space_id, file_id=None, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed, citations=citations, index_version=index_version)
                 return jsonify(response), 200
             elif model == "gpt4-o":
                 todo = "Implement openai"
@@ -391,26 +372,67 @@ def chat():
                 response_message = chatIM(messages, model)
                 response_message["citations"] = citations
                 # Create the conversation in DB
-                question_to_index = f"{space}/{filename} - {question}"  
-                question_to_indexembed =  get_embeddings(question_to_index)
                 if filename: 
-                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=file_id, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed)
+                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=file_id, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed, index_version=index_version)
                 else:
-                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=None, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed)
+                    inserted = dbkeeper.create_conversation(sender="user", text=question_to_index, space_id = space_id, file_id=None, related_message_id=None, user_ip=user_ip, embedding=question_to_indexembed, index_version=index_version)
                 response_to_index = f"{space}/{filename} - {response_message['content']}"  
                 response_to_indexembed =  get_embeddings(response_to_index)
 
                 if filename:
-                    dbkeeper.create_conversation(sender='ai', text=response_to_index, space_id = space_id, file_id=file_id, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed)
+                    dbkeeper.create_conversation(sender='ai', text=response_to_index, space_id = space_id, file_id=file_id, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed, citations=citations, index_version=index_version)
                 else:
-                    dbkeeper.create_conversation(sender='ai', text=response_to_index, space_id = space_id, file_id=None, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed)
+                    dbkeeper.create_conversation(sender='ai', text=response_to_index, space_id = space_id, file_id=None, related_message_id=int(inserted), user_ip=user_ip, embedding=response_to_indexembed, citations=citations, index_version=index_version)
             
             return jsonify(response_message), 200
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+    except EmbeddingError as e:
+        return jsonify({"error": str(e)}), 503
     except requests.exceptions.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/search', methods=['POST'])
+def search():
+    data = request.json or {}
+    question = data.get('query')
+    spaces = data.get('spaces')
+    if not question:
+        return jsonify({"error": "Query is required"}), 400
+    try:
+        numrows = min(max(int(data.get('numrows', 10)), 1), FEDERATED_MAX_ROWS)
+        budget_ms = min(max(float(data.get('budget_ms') or FEDERATED_BUDGET_MS), 1.0), FEDERATED_MAX_BUDGET_MS)
+    except (TypeError, ValueError):
+        return jsonify({"error": "numrows and budget_ms must be numbers"}), 400
+    if not spaces or spaces == "all":
+        spaces = [name for name in os.listdir(ROOT_DIR) if os.path.isdir(os.path.join(ROOT_DIR, name))]
+    elif isinstance(spaces, str):
+        spaces = [spaces]
+    if not isinstance(spaces, list) or not all(isinstance(name, str) for name in spaces):
+        return jsonify({"error": "spaces must be a list of space names or \"all\""}), 400
+
+    try:
+        embed = get_embeddings(question)
+    except EmbeddingError as e:
+        return jsonify({"error": str(e)}), 503
+
+    # Searches still running when the budget ends are cancelled by their statement_timeout
+    deadline = time.monotonic() + budget_ms / 1000
+
+    def search_space(space_name):
+        with dbkeeper.search_deadline(deadline):
+            try:
+                return get_top(embed, conn=conn, schema=dbschema, table=f"spaces_embeddings", space=space_name, numrows=numrows, query_text=question)
+            except psycopg2.extensions.QueryCanceledError as e:
+                raise TimeoutError(f"Search of {space_name} exceeded its budget") from e
+
+    results, report = federated_search(search_space, spaces, numrows, federated_executor, budget_seconds=budget_ms / 1000)
+    citations = [
+        {"space": space_name, "fileName": doc[3], "thumbnail": doc[4], "pageno": doc[0], "context": doc[1], "score": float(doc[-1])}
+        for space_name, doc in results
+    ]
+    return jsonify({"results": citations, "spaces": report}), 200
+
 @app.route('/upload_file/<space>', methods=['POST'])
 def upload_file(space):
     if 'file' not in request.files:
@@ -444,26 +466,115 @@ def convert_pdf(filename):
     if not os.path.exists(filepath):
         return jsonify({"error": "File not found"}), 404
 
-    pdf_doc = InputDocument(document_name=filename, file_path=filepath)
+    # Indexing runs on the job workers; the client follows it at /jobs/<id>
+    job = dbkeeper.create_job("convert_pdf", {"space": space, "filename": filename})
+    if job is None:
+        return jsonify({"error": "Could not queue the conversion"}), 500
+    job_worker.notify()
+    return jsonify({"message": f"Queued PDF {filename} for indexing in space: {space}", "job_id": job["id"], "job": describe_job(job)}), 202
+
+def index_pdf(context):
+    """Job handler for convert_pdf: ingests one PDF of a space and returns a summary."""
+    space = context.payload["space"]
+    filename = context.payload["filename"]
+    filepath = os.path.join(ROOT_DIR, space, filename)
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(filepath)
+
+    space_id = dbkeeper.get_space_by_name(space)["id"]
+    pdf_doc = InputDocument(document_name=filename, file_path=filepath, save_images_to_disk=False)
     images_folder = pdf_doc.imagesfolder
 
-    embeddings = []
-    i = 0
-    for image_file in os.listdir(images_folder):
-        if image_file.endswith(".png"):
-            image_path = os.path.join(images_folder, image_file)
-            pageno = int(image_file.split('_')[1].split('.')[0])
-            metadata = {"filename": filename, "page": pageno, "space": space}
-            ocr_text = perform_ocr(image_path)
-            content = f"{metadata} {ocr_text}"
-            embedding = get_embeddings(content)
-            cost = len(content.split()) * 0.0001
-            files = dbkeeper.get_file_by_name(filename)
-            #imagepath=os.path.join(images_folder, f"{filename}_page_{i+1}.png")
-            dbkeeper.create_embedding(pageno=pageno, metadata=json.dumps(metadata), context=content, embedding=embedding, numtokens=len(ocr_text.split()), cost=cost, tabletext="", source=filename, imagepath=image_path, file_id=files["id"])
-            #save_ocr_result(source=filename, pageno=pageno, imagesource=image_path, ocrtext=ocr_text, embedding=embedding, cost=cost, metadata=metadata)
-            embeddings.append(embedding)
-            i +=1
+    files = dbkeeper.get_file_by_name(filename, space_id=space_id)
+
+    def embed_pages(pages):
+        # The chunk text alone is embedded, so boilerplate repeated across files
+        # shares one stored vector and only new text reaches the embedding server
+        chunks = [chunk for page in pages for chunk in page.chunks]
+        if not chunks:
+            return
+        embeddings, text_hashes = dbkeeper.embed_texts([chunk.text for chunk in chunks])
+        for chunk, embedding, text_hash in zip(chunks, embeddings, text_hashes):
+            chunk.embedding = embedding
+            chunk.content_hash = text_hash
+
+    indexed = []
+    removed = []
+    committed = []
+    def write_pages(pages):
+        replaced = []
+        for page in pages:
+            if page.error or any(chunk.embedding is None or np.isnan(chunk.embedding).any() for chunk in page.chunks):
+                # The page keeps its previous rows and hash, so the next run tries it again
+                logging.error(f"Skipping page {page.pageno} of {filename}: {page.error or 'it could not be embedded'}")
+                continue
+            rows = []
+            for chunk in page.chunks:
+                label = {"filename": filename, "page": page.pageno, "space": space}
+                metadata = dict(label, chunk=chunk.index, kind=chunk.kind, bbox=chunk.bbox, bboxes=chunk.bboxes)
+                content = f"{label} {chunk.text}"
+                rows.append({"pageno": page.pageno, "metadata": json.dumps(metadata), "context": content, "embedding": chunk.embedding.tolist(),
+                             "numtokens": chunk.numtokens, "cost": len(content.split()) * 0.0001, "source": filename,
+                             "tabletext": chunk.text if chunk.kind == "table" else "",
+                             "imagepath": page.image_path, "content_hash": chunk.content_hash})
+            replaced.append((page.pageno, hashes[page.pageno], rows))
+        if not replaced:
+            return
+        result = dbkeeper.replace_pages(files["id"], space_id, replaced)
+        if result is None:
+            raise RuntimeError("the pages could not be saved")
+        ids, removed_ids = result
+        removed.extend(removed_ids)
+        committed.extend(pageno for pageno, _, _ in replaced)
+        rows = [row for _, _, page_rows in replaced for row in page_rows]
+        indexed.extend((embedding_id, row["embedding"], row["numtokens"], {"pageno": row["pageno"], "source": filename, "imagepath": row["imagepath"]}) for embedding_id, row in zip(ids, rows))
+
+    # Pages are rendered, OCRed, embedded and written concurrently, see extractor/pipeline.py
+    pipeline = IngestionPipeline(filepath, images_folder, embed_pages, write_pages, progress=context.progress, cancelled=context.cancelled, chunker=chunker)
+
+    # Only pages whose hash differs from the one recorded when they were last
+    # indexed are processed again. Pages that were never committed, because
+    # an earlier run failed or was stopped, have no hash and are picked up too.
+    stored = dbkeeper.get_page_hashes(files["id"])
+    total_pages = pipeline.page_count()
+    settings = extraction_settings()
+    source_hash = chunker.key(f"{file_hash(filepath)}:{settings}")
+    if source_hash == files.get("content_hash"):
+        hashes = pipeline.page_hashes([pageno for pageno in range(1, total_pages + 1) if pageno not in stored])
+    else:
+        hashes = pipeline.page_hashes()
+    hashes = {pageno: chunker.key(f"{page_hash}:{settings}") for pageno, page_hash in hashes.items()}
+    changed = sorted(pageno for pageno, page_hash in hashes.items() if stored.get(pageno) != page_hash)
+    # Pages past the end of a document that got shorter
+    removed_pages = sorted(pageno for pageno in stored if pageno > total_pages)
+
+    for pageno in changed:
+        # The image rendered for the old version of the page is rendered again when next served
+        stale_image = pdf_doc.image_path(pageno)
+        if os.path.exists(stale_image):
+            os.remove(stale_image)
+
+    context.progress(pages_done=0, pages_total=len(changed))
+    pages = pipeline.run(changed) if changed else []
+    ocr_ms = {page.pageno: page.ocr_ms for page in pages if page.method == "ocr"}
+    native_pages = [page.pageno for page in pages if page.method == "native"]
+    if removed_pages and not pipeline.stopped:
+        result = dbkeeper.replace_pages(files["id"], space_id, [(pageno, None, []) for pageno in removed_pages])
+        if result is not None:
+            removed.extend(result[1])
+
+    if removed:
+        # The disk index cannot drop rows, it is rebuilt from Postgres on the next query
+        dbkeeper.reset_disk_index(space)
+    elif indexed:
+        ids, vectors, numtokens, rows = zip(*indexed)
+        dbkeeper.append_to_disk_index(space, list(ids), np.array(vectors, dtype=np.float32), list(numtokens), list(rows))
+    if indexed or removed:
+        # Answers cached against the previous contents of the space are no longer valid
+        dbkeeper.bump_index_version(space_id)
+    if not pipeline.stopped and not pipeline.errors and len(committed) == len(changed):
+        # Every page is indexed from this version of the file, the next run can skip page hashing
+        dbkeeper.update_file(files["id"], content_hash=source_hash)
 
     # for i, embedding in enumerate(embeddings):
     #     try:
@@ -477,7 +588,62 @@ def convert_pdf(filename):
     #         logging.error(f"Error saving embedding: {e}")
     #         raise
 
-    return jsonify({"message": f"Indexed PDF {filename} in space: {space}", "imageslocation": images_folder}), 200
+    if pipeline.stopped:
+        raise JobCancelled()
+    return {"message": f"Indexed PDF {filename} in space: {space}", "imageslocation": images_folder, "ocr_ms": ocr_ms, "native_pages": native_pages,
+            "chunks": sum(len(page.chunks) for page in pages), "tables": sum(len(page.tables) for page in pages), "changed_pages": changed, "removed_pages": removed_pages, "unchanged_pages": total_pages - len(changed), "timings": pipeline.timings, "errors": pipeline.errors}
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    jobs = dbkeeper.list_jobs(status=request.args.get('status'), limit=int(request.args.get('limit', 50)))
+    return jsonify({"jobs": [describe_job(job) for job in jobs]})
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    job = dbkeeper.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(describe_job(job))
+
+@app.route('/jobs/<int:job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Streams the job as server-sent events until it finishes."""
+    if dbkeeper.get_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def stream():
+        last = None
+        while True:
+            job = dbkeeper.get_job(job_id)
+            if job is None:
+                break
+            event = json.dumps(describe_job(job), default=str)
+            if event != last:
+                yield f"data: {event}\n\n"
+                last = event
+            if job["status"] in TERMINAL_STATUSES:
+                break
+            time.sleep(JOB_EVENTS_SECONDS)
+
+    return Response(stream(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    status = dbkeeper.cancel_job(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"job_id": job_id, "status": status})
+
+@app.route('/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    status = dbkeeper.retry_job(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    if status != "queued":
+        return jsonify({"error": f"Only failed or cancelled jobs can be retried, this one is {status}"}), 409
+    job_worker.notify()
+    return jsonify({"job_id": job_id, "status": status})
+
 
 @app.route('/get_conversations', methods=['GET'])
 def get_conversations():
@@ -527,6 +693,11 @@ def get_conversations():
     return jsonify({"conversations": conversations})
 
 
+# Jobs queued before a restart, or left running by a server that stopped, are picked up here
+job_worker = JobWorker(dbkeeper, {"convert_pdf": index_pdf})
+if SERVING_PROCESS:
+    job_worker.start()
+
 if __name__ == '__main__':
     if not os.path.exists(ROOT_DIR):
         os.makedirs(ROOT_DIR)
@@ -0,0 +1,278 @@
+"""
+Retrieval benchmark over synthetic spaces.
+
+Generates a clustered corpus of unit vectors, runs every retrieval strategy on
+the same queries and reports latency percentiles, throughput, memory and
+recall@k against exact search.
+
+    python benchmarks/retrieval_bench.py --sizes 10000 100000 --output results.json
+    python benchmarks/retrieval_bench.py --sizes 100000 --postgres --modes exact ann hybrid
+
+In-memory strategies need about ``size * dim * 4`` bytes of RAM; the disk
+strategies build their index chunk by chunk and work for the largest sizes.
+The --postgres strategies load the corpus into a space named bench_<size>
+using the database settings from .env and remove it afterwards.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from searchlib.scoring import normalize_rows, top_k
+from searchlib.diskindex import DiskVectorIndex
+
+CHUNK_ROWS = 100000
+
+def generate_corpus(size, dim=768, clusters=256, files=50, seed=0):
+    """
+    Yields the synthetic corpus in chunks of CHUNK_ROWS rows.
+
+    Vectors are drawn around random cluster centres so nearest neighbours are
+    meaningful, as they are for real page embeddings.
+
+    :return: Generator of (start, vectors, numtokens, sources) tuples.
+    """
+    rng = np.random.default_rng(seed)
+    centres = normalize_rows(rng.standard_normal((clusters, dim)).astype(np.float32))
+    for start in range(0, size, CHUNK_ROWS):
+        rows = min(CHUNK_ROWS, size - start)
+        assignment = rng.integers(0, clusters, rows)
+        vectors = centres[assignment] + 0.35 * rng.standard_normal((rows, dim)).astype(np.float32) / np.sqrt(dim) * 4
+        numtokens = rng.integers(20, 600, rows).astype(np.float32)
+        sources = [f"file_{i % files}.pdf" for i in range(start, start + rows)]
+        yield start, vectors.astype(np.float32), numtokens, sources
+
+def generate_queries(corpus_matrix, count, seed=1):
+    """Perturbed copies of random corpus rows, so every query has close neighbours."""
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(corpus_matrix), count)
+    noise = rng.standard_normal((count, corpus_matrix.shape[1])).astype(np.float32) * 0.02
+    return corpus_matrix[picks] + noise
+
+def percentile_report(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "mean_ms": round(float(latencies.mean()), 3),
+    }
+
+def recall_at_k(results, truth):
+    hits = [len(set(map(int, r)) & set(map(int, t))) / max(len(t), 1) for r, t in zip(results, truth)]
+    return round(float(np.mean(hits)), 4)
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+def run_strategy(name, build, search, queries, truth, k, warmup):
+    """
+    Builds one strategy and times every query against it.
+
+    :param build: Callable returning the state passed to ``search``.
+    :param search: Callable(state, query, k) returning result ids best first.
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    state = build()
+    build_seconds = time.perf_counter() - started
+    for query in queries[:warmup]:
+        search(state, query, k)
+
+    latencies = []
+    results = []
+    started = time.perf_counter()
+    for query in queries:
+        query_started = time.perf_counter()
+        results.append(search(state, query, k))
+        latencies.append(time.perf_counter() - query_started)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    report = {
+        "strategy": name,
+        "build_seconds": round(build_seconds, 3),
+        "queries": len(queries),
+        "throughput_qps": round(len(queries) / elapsed, 2) if elapsed else None,
+        "recall_at_k": recall_at_k(results, truth),
+        "peak_traced_mb": round(peak / 1024 / 1024, 1),
+        "max_rss_mb": round(max_rss_mb(), 1),
+    }
+    report.update(percentile_report(latencies))
+    print(f"  {name:<16} p50 {report['p50_ms']:>9.3f} ms  p99 {report['p99_ms']:>9.3f} ms  "
+          f"{report['throughput_qps']:>9} qps  recall@{k} {report['recall_at_k']:.3f}")
+    return report
+
+def memory_strategies(matrix, numtokens):
+    yield "exact", (lambda: (matrix, numtokens)), \
+        (lambda state, q, k: top_k(q, state[0], state[1], k)[0])
+    yield "cache", (lambda: (normalize_rows(matrix), numtokens)), \
+        (lambda state, q, k: top_k(q, state[0], state[1], k, normalized=True)[0])
+
+def disk_strategies(size, dim, seed, workdir, rescore):
+    for dtype in ("int8", "float16"):
+        path = os.path.join(workdir, f"index_{dtype}")
+
+        def build(dtype=dtype, path=path):
+            DiskVectorIndex.create(path, dim, dtype=dtype)
+            for start, vectors, numtokens, sources in generate_corpus(size, dim, seed=seed):
+                ids = np.arange(start, start + len(vectors))
+                rows = [{"pageno": int(i), "source": s, "imagepath": ""} for i, s in zip(ids, sources)]
+                DiskVectorIndex.append(path, ids, vectors, numtokens, rows)
+            return DiskVectorIndex(path)
+
+        yield f"disk-{dtype}", build, (lambda index, q, k: index.search(q, k, rescore_factor=rescore)[0])
+
+def postgres_strategies(size, dim, seed, modes):
+    """Loads the corpus into Postgres and benchmarks DataKeeper's retrieval modes."""
+    from psycopg2.extras import execute_values
+    from sqltools.dataaccess import DataKeeper, to_vector_literal
+
+    keeper = DataKeeper()
+    space = f"bench_{size}"
+    schema = keeper.config["dbschema"]
+    connection = keeper.connection
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT id FROM org.spaces WHERE name = %s", (space,))
+        row = cursor.fetchone()
+    if row is None:
+        space_id = keeper.create_space(space)
+        file_id = keeper.create_file("bench.pdf", space_id, 0)
+        print(f"  loading {size} rows into space {space}")
+        for start, vectors, numtokens, sources in generate_corpus(size, dim, seed=seed):
+            rows = [
+                (start + i, json.dumps({"space": space, "page": start + i}), f"synthetic page {start + i}",
+                 to_vector_literal(vector), int(tokens), 0.0, "", "bench.pdf", "", file_id, space_id, datetime.date.today())
+                for i, (vector, tokens) in enumerate(zip(vectors, numtokens))
+            ]
+            with connection.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO org.spaces_embeddings (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, space_id, created)
+                    VALUES %s
+                """, rows, page_size=1000)
+            connection.commit()
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE org.spaces_embeddings")
+        connection.commit()
+
+    for mode in modes:
+        def build(mode=mode):
+            keeper.config["retrieval_mode"] = mode
+            keeper.matrix_cache.invalidate()
+            return keeper
+
+        def search(keeper, q, k):
+            # Every synthetic page matches this text, so hybrid measures the cost of both legs
+            results = keeper.get_top_chunks(q, schema, "spaces_embeddings", space, numrows=k, query_text="synthetic page")
+            return [result[0] for result in results]
+
+        yield f"postgres-{mode}", build, search
+
+def drop_postgres_space(size):
+    from sqltools.dataaccess import DataKeeper
+    keeper = DataKeeper()
+    with keeper.connection.cursor() as cursor:
+        cursor.execute("DELETE FROM org.spaces_embeddings WHERE space_id = (SELECT id FROM org.spaces WHERE name = %s)", (f"bench_{size}",))
+        cursor.execute("DELETE FROM org.spaces_files WHERE space_id = (SELECT id FROM org.spaces WHERE name = %s)", (f"bench_{size}",))
+        cursor.execute("DELETE FROM org.spaces WHERE name = %s", (f"bench_{size}",))
+    keeper.connection.commit()
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "params": vars(args),
+        "results": [],
+    }
+    for size in args.sizes:
+        print(f"size {size} x {args.dim}")
+        in_memory = size <= args.max_memory_rows
+        matrix = numtokens = None
+        if in_memory or args.postgres:
+            chunks = list(generate_corpus(size, args.dim, seed=args.seed))
+            matrix = np.vstack([c[1] for c in chunks])
+            numtokens = np.concatenate([c[2] for c in chunks])
+            del chunks
+        else:
+            # Ground truth still needs the vectors, computed one chunk at a time
+            first = next(generate_corpus(min(size, CHUNK_ROWS), args.dim, seed=args.seed))
+            matrix, numtokens = first[1], first[2]
+        queries = generate_queries(matrix, args.queries, seed=args.seed + 1)
+        truth = exact_truth(size, args, queries, matrix, numtokens, in_memory or args.postgres)
+
+        strategies = []
+        if in_memory:
+            strategies.extend(memory_strategies(matrix, numtokens))
+        workdir = tempfile.mkdtemp(prefix="spaces-bench-")
+        try:
+            if not args.skip_disk:
+                strategies.extend(disk_strategies(size, args.dim, args.seed, workdir, args.rescore))
+            if args.postgres:
+                strategies.extend(postgres_strategies(size, args.dim, args.seed, args.modes))
+            for name, build, search in strategies:
+                result = run_strategy(name, build, search, queries, truth, args.k, args.warmup)
+                result.update({"size": size, "dim": args.dim, "k": args.k})
+                report["results"].append(result)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            if args.postgres and not args.keep_postgres:
+                drop_postgres_space(size)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.output}")
+    return report
+
+def exact_truth(size, args, queries, matrix, numtokens, have_matrix):
+    """Exact top-k ids of every query, the reference for recall@k."""
+    if have_matrix:
+        return [top_k(q, matrix, numtokens, args.k)[0] for q in queries]
+    best = [[] for _ in queries]
+    for start, vectors, tokens, _ in generate_corpus(size, args.dim, seed=args.seed):
+        for i, q in enumerate(queries):
+            indices, scores = top_k(q, vectors, tokens, args.k)
+            best[i].extend(zip(scores, indices + start))
+    return [np.array([row for _, row in sorted(b, reverse=True)[:args.k]]) for b in best]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark get_top / get_top_chunks retrieval strategies")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="Vectors per synthetic space")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rescore", type=int, default=4, help="Candidate multiple rescored by the disk index")
+    parser.add_argument("--max-memory-rows", type=int, default=1000000, help="Largest size run with the in-memory strategies")
+    parser.add_argument("--skip-disk", action="store_true")
+    parser.add_argument("--postgres", action="store_true", help="Also benchmark DataKeeper against the database in .env")
+    parser.add_argument("--modes", nargs="+", default=["exact", "ann"], help="DataKeeper retrieval modes for --postgres")
+    parser.add_argument("--keep-postgres", action="store_true", help="Keep the synthetic space after the run")
+    parser.add_argument("--output", help="Write the machine-readable report to this JSON file")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,211 @@
+import atexit
+import logging
+import os
+import threading
+import numpy as np
+from embedlib.embeddings import embedding_cache, EMBEDDING_BATCH_SIZE, EMBEDDING_DIMENSION
+from embedlib.client import AsyncEmbeddingClient, run_sync
+
+class EmbeddingBackend:
+    """
+    Turns texts into embeddings.
+
+    Every backend reports the model it uses, which keys embedding_cache, and
+    the dimension of its vectors, which must match the VECTOR(n) columns.
+    """
+    name = None
+
+    @property
+    def model(self):
+        raise NotImplementedError
+
+    @property
+    def dimension(self):
+        raise NotImplementedError
+
+    @property
+    def tokenizer_name(self):
+        """Hugging Face tokenizer matching the model, used to size chunks in real tokens."""
+        return self.model
+
+    def embed(self, texts):
+        """
+        :return: float32 array of shape (len(texts), dimension); rows that failed are NaN.
+        """
+        raise NotImplementedError
+
+    def embed_one(self, text):
+        """Embeds a single text, returning a list of floats or None on failure."""
+        vector = self.embed([text])[0]
+        if np.isnan(vector).any():
+            return None
+        return vector.tolist()
+
+class OllamaBackend(EmbeddingBackend):
+    """
+    Embeds over HTTP with the Ollama server's /api/embed endpoint.
+
+    Uncached texts are sent in batches that run concurrently through an
+    AsyncEmbeddingClient, within its concurrency limit and circuit breaker.
+    """
+    name = "ollama"
+    # Hugging Face tokenizers of the embedding models Ollama serves under short names
+    tokenizers = {
+        "nomic-embed-text": "nomic-ai/nomic-embed-text-v1.5",
+        "mxbai-embed-large": "mixedbread-ai/mxbai-embed-large-v1",
+        "all-minilm": "sentence-transformers/all-MiniLM-L6-v2",
+        "snowflake-arctic-embed": "Snowflake/snowflake-arctic-embed-m",
+        "bge-m3": "BAAI/bge-m3",
+    }
+
+    def __init__(self, model=None, base_url=None, dimension=None, batch_size=None):
+        self._model = model or os.environ.get("EMBEDDING_MODEL", "nomic-embed-text")
+        if base_url is None:
+            if os.environ.get("LLM_BACKEND"):
+                base_url = f"http://{os.environ['LLM_BACKEND']}:{os.environ.get('LLM_BACKEND_PORT', '11434')}"
+            else:
+                base_url = "http://localhost:11434"
+        self.base_url = base_url
+        self._dimension = dimension or EMBEDDING_DIMENSION
+        self.batch_size = batch_size or EMBEDDING_BATCH_SIZE
+        self.client = AsyncEmbeddingClient.from_env(self.base_url, self._model)
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def dimension(self):
+        return self._dimension
+
+    @property
+    def tokenizer_name(self):
+        return self.tokenizers.get(self._model.split(":")[0], self._model)
+
+    def embed(self, texts):
+        vectors = [embedding_cache.get(self._model, text) for text in texts]
+        pending = [i for i, vector in enumerate(vectors) if vector is None]
+        if pending:
+            results = run_sync(self.client.embed([texts[i] for i in pending], batch_size=self.batch_size))
+            for i, vector in zip(pending, results):
+                if vector is not None and len(vector) != self._dimension:
+                    raise ValueError(f"{self._model} returned {len(vector)}-dim vectors, expected {self._dimension}")
+                vectors[i] = vector
+                embedding_cache.put(self._model, texts[i], vector)
+        matrix = np.full((len(texts), self._dimension), np.nan, dtype=np.float32)
+        for i, vector in enumerate(vectors):
+            if vector is not None:
+                matrix[i] = vector
+        return matrix
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """
+    Embeds in process with a SentenceTransformer model.
+
+    The model is saved under ``models/`` on first use and loaded from there
+    afterwards. With ``processes`` > 1, large inputs are encoded by a pool of
+    worker processes, one per CPU core given.
+    """
+    name = "sentence-transformers"
+
+    def __init__(self, model=None, model_dir="models", batch_size=32, processes=1, device=None, normalize=False):
+        self.model_name = model or os.environ.get("SENTENCE_TRANSFORMER_MODEL", "sentence-transformers/all-mpnet-base-v2")
+        self.model_dir = model_dir
+        self.batch_size = batch_size
+        self.processes = processes
+        self.device = device
+        self.normalize = normalize
+        self._encoder = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        return self.model_name
+
+    @property
+    def encoder(self):
+        with self._lock:
+            if self._encoder is None:
+                from sentence_transformers import SentenceTransformer
+                local_dir = os.path.join(self.model_dir, self.model_name.split("/")[-1])
+                if not os.path.exists(local_dir):
+                    # Load and save the model to the specified directory
+                    self._encoder = SentenceTransformer(self.model_name, device=self.device)
+                    self._encoder.save(local_dir)
+                else:
+                    self._encoder = SentenceTransformer(local_dir, device=self.device)
+            return self._encoder
+
+    @property
+    def dimension(self):
+        return self.encoder.get_sentence_embedding_dimension()
+
+    def _encode(self, texts):
+        # Load the model before taking the lock: the encoder property takes it too.
+        encoder = self.encoder
+        if self.processes > 1 and len(texts) >= self.batch_size * self.processes:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = encoder.start_multi_process_pool(target_devices=["cpu"] * self.processes)
+                    atexit.register(self.close)
+                pool = self._pool
+            return encoder.encode_multi_process(texts, pool, batch_size=self.batch_size, normalize_embeddings=self.normalize)
+        return encoder.encode(texts, batch_size=self.batch_size, convert_to_numpy=True, normalize_embeddings=self.normalize)
+
+    def embed(self, texts):
+        vectors = [embedding_cache.get(self.model_name, text) for text in texts]
+        pending = [i for i, vector in enumerate(vectors) if vector is None]
+        matrix = np.full((len(texts), self.dimension), np.nan, dtype=np.float32)
+        if pending:
+            try:
+                encoded = np.asarray(self._encode([texts[i] for i in pending]), dtype=np.float32)
+                for i, vector in zip(pending, encoded):
+                    vectors[i] = vector
+                    embedding_cache.put(self.model_name, texts[i], vector)
+            except Exception as e:
+                logging.error(f"Error encoding {len(pending)} texts with {self.model_name}: {e}")
+        for i, vector in enumerate(vectors):
+            if vector is not None:
+                matrix[i] = vector
+        return matrix
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._encoder.stop_multi_process_pool(self._pool)
+                self._pool = None
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """
+    Returns the process-wide backend selected by EMBEDDING_BACKEND.
+
+    ``ollama`` (default) uses EMBEDDING_MODEL on the Ollama server,
+    ``sentence-transformers`` uses SENTENCE_TRANSFORMER_MODEL in process with
+    EMBEDDING_PROCESSES encoding processes.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            kind = os.environ.get("EMBEDDING_BACKEND", "ollama")
+            if kind == OllamaBackend.name:
+                _backend = OllamaBackend()
+            elif kind == SentenceTransformerBackend.name:
+                _backend = SentenceTransformerBackend(
+                    batch_size=int(os.environ.get("EMBEDDING_BATCH_SIZE", "32")),
+                    processes=int(os.environ.get("EMBEDDING_PROCESSES", "1")),
+                )
+            else:
+                raise ValueError(f"Unknown EMBEDDING_BACKEND: {kind}")
+        return _backend
+
+def check_dimension(backend, expected):
+    """Raises when the backend's vectors would not fit the VECTOR(expected) columns."""
+    if expected is not None and backend.dimension != expected:
+        raise ValueError(
+            f"Embedding backend {backend.name} ({backend.model}) produces {backend.dimension}-dim vectors "
+            f"but the database stores VECTOR({expected}); pick a {expected}-dim model or migrate the schema"
+        )
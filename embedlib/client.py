@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import httpx
+
+class EmbeddingError(RuntimeError):
+    """Raised when texts could not be embedded, instead of handing back empty vectors."""
+
+class CircuitOpenError(EmbeddingError):
+    """Raised without calling the server while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """
+    Stops calling a failing server for a while.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    every call is refused for ``reset_seconds``. Then a single trial call is
+    let through: success closes the circuit, failure opens it again.
+    """
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+class AsyncEmbeddingClient:
+    """
+    Async client for Ollama's /api/embed endpoint.
+
+    At most ``concurrency`` requests are in flight at once, so callers can
+    submit many batches without overloading the server. Timeouts, transport
+    errors, 429 and 5xx responses are retried with exponential backoff and
+    full jitter; other 4xx responses fail at once. Every failed request counts
+    against the circuit breaker.
+
+    :param base_url: Embedding server, e.g. http://localhost:11434.
+    :param model: Embedding model name.
+    :param concurrency: Requests in flight at once.
+    :param timeout: Seconds allowed per request.
+    :param max_retries: Retries after the first attempt.
+    :param backoff_base: Upper bound of the first backoff, in seconds.
+    :param backoff_max: Upper bound of any backoff, in seconds.
+    :param breaker: CircuitBreaker shared by the requests.
+    """
+    def __init__(self, base_url, model, concurrency=4, timeout=30.0, max_retries=3, backoff_base=0.5, backoff_max=8.0, breaker=None):
+        self.base_url = base_url
+        self.model = model
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._http = None
+        self._semaphore = None
+
+    @classmethod
+    def from_env(cls, base_url, model):
+        return cls(
+            base_url,
+            model,
+            concurrency=int(os.environ.get("EMBEDDING_CONCURRENCY", "4")),
+            timeout=float(os.environ.get("EMBEDDING_TIMEOUT", "30")),
+            max_retries=int(os.environ.get("EMBEDDING_MAX_RETRIES", "3")),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.environ.get("EMBEDDING_BREAKER_FAILURES", "5")),
+                reset_seconds=float(os.environ.get("EMBEDDING_BREAKER_RESET", "30")),
+            ),
+        )
+
+    def _client(self):
+        # Created lazily so both belong to the loop the client runs on
+        if self._http is None:
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            self._http = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=limits)
+            self._semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        return self._http
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def embed_batch(self, texts):
+        """
+        Embeds one batch in a single request.
+
+        :return: List of embeddings, one per text.
+        :raises EmbeddingError: When every attempt failed or the circuit is open.
+        """
+        http = self._client()
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Embedding server {self.base_url} is unavailable, circuit open")
+            try:
+                async with self._semaphore:
+                    response = await http.post("/api/embed", json={"model": self.model, "input": texts})
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise httpx.HTTPStatusError(f"Server error {response.status_code}", request=response.request, response=response)
+                response.raise_for_status()
+                embeddings = response.json()["embeddings"]
+                if len(embeddings) != len(texts) or any(not embedding for embedding in embeddings):
+                    raise EmbeddingError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+                self.breaker.record_success()
+                return embeddings
+            except httpx.HTTPStatusError as e:
+                self.breaker.record_failure()
+                last_error = e
+                if e.response.status_code != 429 and e.response.status_code < 500:
+                    break
+            except (httpx.TransportError, EmbeddingError, ValueError) as e:
+                self.breaker.record_failure()
+                last_error = e
+            if attempt < self.max_retries:
+                delay = self._backoff(attempt)
+                logging.warning(f"Embedding request failed ({last_error}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+        raise EmbeddingError(f"Embedding request failed after {attempt + 1} attempts: {last_error}")
+
+    async def embed(self, texts, batch_size=32):
+        """
+        Embeds all texts, with the batches running concurrently.
+
+        :return: List with one embedding per text, None for texts whose batch failed.
+        :raises CircuitOpenError: When the server is known to be down.
+        """
+        batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+        results = await asyncio.gather(*(self.embed_batch(batch) for batch in batches), return_exceptions=True)
+        embeddings = []
+        for batch, result in zip(batches, results):
+            if isinstance(result, CircuitOpenError):
+                raise result
+            if isinstance(result, BaseException):
+                logging.error(f"Embedding failed for a batch of {len(batch)} texts: {result}")
+                embeddings.extend([None] * len(batch))
+            else:
+                embeddings.extend(result)
+        return embeddings
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine on the shared background event loop and waits for its result.
+
+    Lets synchronous code such as Flask handlers use the async clients. All
+    clients share the loop, so their connection pools and limits are shared
+    across request threads.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="embedding-client", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
@@ -1,20 +1,174 @@
 import os
-import requests
-import json
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+DISK_PRUNE_INTERVAL = 100
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "768"))
+
+class EmbeddingCache:
+    """
+    Two-tier cache of embeddings keyed by a hash of the model name and the text.
+
+    The memory tier is a bounded dict evicted by LRU (or FIFO) order, with an
+    optional TTL. The optional disk tier is a sqlite file shared by every worker
+    on the host and pruned by least recent use.
+
+    :param max_entries: Entries kept in memory, 0 disables the memory tier.
+    :param ttl_seconds: Age after which an entry is recomputed, None keeps entries forever.
+    :param disk_path: sqlite file of the disk tier, None disables it.
+    :param disk_max_entries: Rows kept in the disk tier, None for unbounded.
+    :param policy: "lru" or "fifo" eviction of the memory tier.
+    """
+    def __init__(self, max_entries=10000, ttl_seconds=None, disk_path=None, disk_max_entries=None, policy="lru"):
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.policy = policy
+        self.disk_max_entries = disk_max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self.puts_since_prune = 0
+        self.disk = None
+        if disk_path:
+            self.disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self.disk.execute("PRAGMA journal_mode=WAL")
+            self.disk.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self.disk.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+            self.disk.commit()
+
+    @classmethod
+    def from_env(cls):
+        ttl = os.environ.get("EMBEDDING_CACHE_TTL")
+        disk_size = os.environ.get("EMBEDDING_CACHE_DISK_SIZE")
+        return cls(
+            max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000")),
+            ttl_seconds=float(ttl) if ttl else None,
+            disk_path=os.environ.get("EMBEDDING_CACHE_PATH") or None,
+            disk_max_entries=int(disk_size) if disk_size else None,
+            policy=os.environ.get("EMBEDDING_CACHE_POLICY", "lru"),
+        )
+
+    @staticmethod
+    def key(model, content):
+        return hashlib.sha256(f"{model}\0{content}".encode("utf-8")).hexdigest()
+
+    def get(self, model, content):
+        """Returns the cached embedding as a list of floats, or None."""
+        key = self.key(model, content)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                created, vector = entry
+                if self._expired(created, now):
+                    del self.entries[key]
+                    self.counters["expirations"] += 1
+                else:
+                    if self.policy == "lru":
+                        self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return vector.tolist()
+            if self.disk is not None:
+                row = self.disk.execute("SELECT vector, created FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self.disk.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (now, key))
+                    self.disk.commit()
+                    vector = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, row[1], vector)
+                    self.counters["disk_hits"] += 1
+                    return vector.tolist()
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, model, content, embedding):
+        if embedding is None:
+            return
+        key = self.key(model, content)
+        now = time.time()
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            self._remember(key, now, vector)
+            if self.disk is not None:
+                self.disk.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, vector.tobytes(), now, now),
+                )
+                self.puts_since_prune += 1
+                # Pruning scans the table, so it runs every DISK_PRUNE_INTERVAL writes
+                if self.disk_max_entries and self.puts_since_prune >= DISK_PRUNE_INTERVAL:
+                    self.puts_since_prune = 0
+                    self.disk.execute("""
+                        DELETE FROM embeddings WHERE key IN (
+                            SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                        )
+                    """, (self.disk_max_entries,))
+                self.disk.commit()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, size=len(self.entries))
+            if self.disk is not None:
+                stats["disk_size"] = self.disk.execute("SELECT count(*) FROM embeddings").fetchone()[0]
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.disk is not None:
+                self.disk.execute("DELETE FROM embeddings")
+                self.disk.commit()
+
+    def _expired(self, created, now):
+        return self.ttl_seconds is not None and now - created > self.ttl_seconds
+
+    def _remember(self, key, created, vector):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = (created, vector)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+embedding_cache = EmbeddingCache.from_env()
+
 def get_embeddings(content):
-    try:
-        url = f"http://{os.environ['LLM_BACKEND']}:{os.environ['LLM_BACKEND_PORT']}/api/embeddings"
-        payload = {
-            "model": os.environ['EMBEDDING_MODEL'],
-            "prompt": content
-        }
-        headers = {
-            "Content-Type": "application/json"
-        }
-        response = requests.post(url, data=json.dumps(payload), headers=headers)
-        response.raise_for_status()
-        return response.json()["embedding"]
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-    except Exception as err:
-        print(f"Other error occurred: {err}") 
\ No newline at end of file
+    """
+    Embeds one text with the configured backend.
+
+    :raises EmbeddingError: When the text could not be embedded.
+    """
+    from embedlib.backends import get_backend
+    from embedlib.client import EmbeddingError
+    embedding = get_backend().embed_one(content)
+    if embedding is None:
+        raise EmbeddingError("Could not embed text")
+    return embedding
+
+def get_embeddings_batch(texts):
+    """
+    Embeds many texts with the configured backend, which serves cached texts
+    from embedding_cache and batches the rest.
+
+    :param texts: Texts to embed.
+    :return: float32 array of shape (len(texts), dim); rows that failed are NaN.
+    """
+    from embedlib.backends import get_backend
+    return get_backend().embed(list(texts))
@@ -0,0 +1,110 @@
+import hashlib
+import re
+import unicodedata
+from contextlib import contextmanager
+import numpy as np
+from psycopg2.extras import execute_values
+from searchlib.scoring import decode_vectors
+
+def normalize_text(text):
+    """Normalizes text before hashing and embedding: NFKC, collapsed whitespace, no NUL bytes."""
+    text = unicodedata.normalize("NFKC", text).replace("\x00", "")
+    return re.sub(r"\s+", " ", text).strip()
+
+def content_hash(model, text):
+    """Address of an embedding: sha256 of the model name and the normalized text."""
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+@contextmanager
+def _borrow(connection):
+    if callable(connection):
+        with connection() as borrowed:
+            yield borrowed
+    else:
+        yield connection
+
+class EmbeddingStore:
+    """
+    Content-addressed embeddings kept in org.embedding_store.
+
+    Vectors are keyed by the model and a hash of the normalized text, so a text
+    embedded once, in any file, space or conversation, is read back instead of
+    being sent to the embedding server again. Chunk rows record the hash of
+    the vector they were given in spaces_embeddings.content_hash.
+
+    :param backend: EmbeddingBackend computing the vectors that are not stored yet.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def ensure_table(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS org.embedding_store (
+                    model VARCHAR(255) NOT NULL,
+                    content_hash CHAR(64) NOT NULL,
+                    embedding VECTOR({self.backend.dimension}) NOT NULL,
+                    created TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (model, content_hash)
+                );
+            """)
+
+    def lookup(self, connection, hashes):
+        """
+        :return: Dict of content hash to float32 vector for the stored hashes.
+        """
+        if not hashes:
+            return {}
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT content_hash, vector_send(embedding) FROM org.embedding_store
+                WHERE model = %s AND content_hash = ANY(%s);
+            """, (self.backend.model, list(hashes)))
+            rows = cursor.fetchall()
+        if not rows:
+            return {}
+        matrix = decode_vectors([row[1] for row in rows])
+        return {row[0]: vector for row, vector in zip(rows, matrix)}
+
+    def save(self, connection, vectors):
+        """Stores a dict of content hash to vector; hashes already stored are kept as they are."""
+        if not vectors:
+            return
+        with connection.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO org.embedding_store (model, content_hash, embedding) VALUES %s
+                ON CONFLICT (model, content_hash) DO NOTHING;
+            """, [(self.backend.model, key, vector.tolist()) for key, vector in vectors.items()])
+
+    def embed(self, connection, texts):
+        """
+        Embeds texts, computing only those whose normalized text is not stored yet.
+
+        Duplicates within ``texts`` are embedded once. The caller commits.
+
+        :param connection: psycopg2 connection, or a callable returning a context
+                           manager that lends one (e.g. DataKeeper.search_connection),
+                           in which case no connection is held while the backend computes.
+        :return: (matrix, hashes): a float32 array with NaN rows for texts that
+                 could not be embedded, and the content hash of every text.
+        """
+        normalized = [normalize_text(text) for text in texts]
+        hashes = [content_hash(self.backend.model, text) for text in normalized]
+        unique = dict(zip(hashes, normalized))
+        with _borrow(connection) as borrowed:
+            vectors = self.lookup(borrowed, unique.keys())
+
+        missing = [key for key in unique if key not in vectors]
+        if missing:
+            computed = self.backend.embed([unique[key] for key in missing])
+            new = {key: vector for key, vector in zip(missing, computed) if not np.isnan(vector).any()}
+            if new:
+                with _borrow(connection) as borrowed:
+                    self.save(borrowed, new)
+                vectors.update(new)
+
+        matrix = np.full((len(texts), self.backend.dimension), np.nan, dtype=np.float32)
+        for i, key in enumerate(hashes):
+            if key in vectors:
+                matrix[i] = vectors[key]
+        return matrix, hashes
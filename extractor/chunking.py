@@ -0,0 +1,312 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+
+CHUNK_MODE = os.environ.get("CHUNK_MODE", "structure")
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", "256"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "32"))
+CHUNK_MIN_TOKENS = int(os.environ.get("CHUNK_MIN_TOKENS", "32"))
+
+_WORDS = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=\S)")
+_CELL_SEPARATOR = re.compile(r"\t| {2,}|\s\|\s")
+_MARKDOWN_SEPARATOR = re.compile(r"^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?$")
+_NUMBERED = re.compile(r"^(\d+(\.\d+)*\.?|[IVXLC]+\.|[A-Z]\.|(chapter|section|part|appendix)\s+\w+)\s+\S", re.IGNORECASE)
+
+class Tokenizer:
+    """
+    Counts and locates tokens the way the embedding model does.
+
+    Uses the model's Hugging Face fast tokenizer. When it cannot be loaded,
+    e.g. offline, words and punctuation marks stand in for tokens, which
+    undercounts long words split into several subwords.
+
+    :param name: Hugging Face tokenizer name, see EmbeddingBackend.tokenizer_name.
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self._tokenizer = None
+        if name:
+            try:
+                from transformers import AutoTokenizer
+                self._tokenizer = AutoTokenizer.from_pretrained(name, use_fast=True)
+            except Exception as e:
+                logging.warning(f"Could not load tokenizer {name}, counting words instead: {e}")
+
+    def spans(self, text):
+        """:return: List of (start, end) character offsets of the tokens of ``text``."""
+        if self._tokenizer is None:
+            return [match.span() for match in _WORDS.finditer(text)]
+        offsets = self._tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)["offset_mapping"]
+        return [(start, end) for start, end in offsets if end > start]
+
+    def count(self, text):
+        return len(self.spans(text))
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+def get_tokenizer(name=None):
+    """Returns the shared tokenizer for ``name``, CHUNK_TOKENIZER or the embedding backend's model."""
+    if name is None:
+        name = os.environ.get("CHUNK_TOKENIZER")
+    if name is None:
+        from embedlib.backends import get_backend
+        name = get_backend().tokenizer_name
+    with _tokenizers_lock:
+        if name not in _tokenizers:
+            _tokenizers[name] = Tokenizer(name)
+        return _tokenizers[name]
+
+@dataclass
+class Chunk:
+    """
+    A span of page text small enough to embed whole.
+
+    ``bboxes`` are the PDF-point boxes of the blocks the text came from, so
+    a retrieved chunk can be highlighted on its page. ``embedding`` and
+    ``content_hash`` are set by the ingestion pipeline's embed step.
+    """
+    pageno: int
+    index: int
+    text: str
+    numtokens: int
+    kind: str = "paragraph"
+    bboxes: list = field(default_factory=list)
+    embedding: object = None
+    content_hash: str = None
+
+    @property
+    def bbox(self):
+        """Union of ``bboxes``, or None."""
+        if not self.bboxes:
+            return None
+        return [min(b[0] for b in self.bboxes), min(b[1] for b in self.bboxes), max(b[2] for b in self.bboxes), max(b[3] for b in self.bboxes)]
+
+@dataclass
+class _Segment:
+    kind: str
+    text: str
+    tokens: int
+    bbox: list = None
+
+def classify(text):
+    """Tells a block's kind from its text: "heading", "table" or "paragraph"."""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines:
+        return "paragraph"
+    rows = [line for line in lines if len(_CELL_SEPARATOR.split(line)) >= 2]
+    if len(lines) >= 2 and len(rows) >= 0.6 * len(lines):
+        return "table"
+    words = text.split()
+    if len(lines) == 1 and len(words) <= 12 and not text.rstrip().endswith((".", ",", ";", ":")):
+        capitalized = sum(1 for word in words if word[0].isupper() or word[0].isdigit())
+        if _NUMBERED.match(text) or text.isupper() or capitalized >= 0.6 * len(words):
+            return "heading"
+    return "paragraph"
+
+def merge_lines(blocks):
+    """
+    Groups OCR lines into blocks: lines on the same row are joined with two
+    spaces, so table cells stay apart, and lines close below each other
+    become one paragraph.
+    """
+    merged = []
+    for block in blocks:
+        x0, y0, x1, y1 = block["bbox"]
+        if merged:
+            last = merged[-1]
+            height = max(last["line"][3] - last["line"][1], 1.0)
+            same_row = abs(y0 - last["line"][1]) < 0.5 * height
+            if same_row or 0 <= y0 - last["line"][3] <= 0.8 * height:
+                last["text"] += ("  " if same_row else "\n") + block["text"]
+                last["bbox"] = [min(last["bbox"][0], x0), min(last["bbox"][1], y0), max(last["bbox"][2], x1), max(last["bbox"][3], y1)]
+                last["line"] = block["bbox"]
+                continue
+        merged.append({"bbox": list(block["bbox"]), "text": block["text"], "line": block["bbox"]})
+    return [{"bbox": block["bbox"], "text": block["text"]} for block in merged]
+
+class Chunker:
+    """
+    Splits page text into chunks of at most ``max_tokens`` tokens.
+
+    ``tokens`` mode slides a window of ``max_tokens`` over the page, with
+    ``overlap`` tokens shared by consecutive windows. ``structure`` mode
+    keeps headings with the text that follows them, packs whole paragraphs
+    while they fit, splits long paragraphs at sentence ends and long tables
+    between rows, repeating the table's first row; consecutive paragraph
+    chunks share ``overlap`` tokens. A last chunk under ``min_tokens`` is
+    merged into the one before when both fit, and blank pages have no chunk.
+
+    :param tokenizer: Tokenizer; by default the one of the embedding model.
+    """
+    def __init__(self, tokenizer=None, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, mode=CHUNK_MODE, min_tokens=CHUNK_MIN_TOKENS):
+        if not 0 <= overlap < max_tokens:
+            raise ValueError(f"Chunk overlap must be below the chunk size, got {overlap} and {max_tokens}")
+        if mode not in ("structure", "tokens"):
+            raise ValueError(f"Unknown CHUNK_MODE: {mode}")
+        self._tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.mode = mode
+        self.min_tokens = min_tokens
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer()
+        return self._tokenizer
+
+    @property
+    def settings(self):
+        return f"{self.mode}:{self.max_tokens}:{self.overlap}:{self.min_tokens}:{self.tokenizer.name}"
+
+    def key(self, content_hash):
+        """Ties a file or page hash to the chunk settings, so changing them re-indexes the pages."""
+        return hashlib.sha256(f"{content_hash}:{self.settings}".encode("utf-8")).hexdigest()
+
+    def chunk(self, pageno, text, blocks=None, lines=False):
+        """
+        :param blocks: Text blocks of the page with their bbox; ``text`` is used when there are none.
+        :param lines: The blocks are OCR lines, see merge_lines.
+        :return: List of Chunk in reading order.
+        """
+        blocks = [block for block in (blocks or []) if block["text"].strip()]
+        if lines:
+            blocks = merge_lines(blocks)
+        if not blocks:
+            blocks = [{"bbox": None, "text": text}] if text.strip() else []
+        if self.mode == "tokens":
+            chunks = self._windows(blocks)
+        else:
+            chunks = self._pack(self._segments(blocks))
+        return [Chunk(pageno=pageno, index=i, text=chunk_text, numtokens=tokens, kind=kind, bboxes=bboxes)
+                for i, (chunk_text, tokens, kind, bboxes) in enumerate(chunks)]
+
+    def _windows(self, blocks):
+        text, ranges = "", []
+        for block in blocks:
+            if text:
+                text += "\n"
+            ranges.append((len(text), len(text) + len(block["text"]), block["bbox"]))
+            text += block["text"]
+        spans = self.tokenizer.spans(text)
+        chunks = []
+        step = self.max_tokens - self.overlap
+        for start in range(0, len(spans), step):
+            window = spans[start:start + self.max_tokens]
+            begin, end = window[0][0], window[-1][1]
+            bboxes = [bbox for block_start, block_end, bbox in ranges if bbox and block_start < end and block_end > begin]
+            chunks.append((text[begin:end], len(window), "paragraph", bboxes))
+            if start + self.max_tokens >= len(spans):
+                break
+        return chunks
+
+    def _split_tokens(self, kind, text, bbox):
+        """Cuts text into pieces of at most max_tokens tokens, at token boundaries."""
+        spans = self.tokenizer.spans(text)
+        pieces = []
+        for start in range(0, len(spans), self.max_tokens):
+            window = spans[start:start + self.max_tokens]
+            pieces.append(_Segment(kind, text[window[0][0]:window[-1][1]], len(window), bbox))
+        return pieces
+
+    def _segments(self, blocks):
+        segments = []
+        for block in blocks:
+            text = block["text"].strip()
+            kind = block.get("kind") or classify(text)
+            tokens = self.tokenizer.count(text)
+            if tokens <= self.max_tokens:
+                segments.append(_Segment(kind, text, tokens, block["bbox"]))
+            elif kind == "table":
+                segments.extend(self._split_table(text, block["bbox"]))
+            else:
+                for sentence in _SENTENCE_END.split(text):
+                    tokens = self.tokenizer.count(sentence)
+                    if tokens <= self.max_tokens:
+                        segments.append(_Segment("sentence", sentence, tokens, block["bbox"]))
+                    else:
+                        segments.extend(self._split_tokens("sentence", sentence, block["bbox"]))
+        return segments
+
+    def _split_table(self, text, bbox):
+        rows = [row for row in text.splitlines() if row.strip()]
+        # A Markdown table's header is its first row and the separator below it
+        header_rows = 2 if len(rows) > 2 and _MARKDOWN_SEPARATOR.match(rows[1]) else 1
+        header, header_tokens = "\n".join(rows[:header_rows]), self.tokenizer.count("\n".join(rows[:header_rows]))
+        if header_tokens > self.max_tokens // 2:
+            header, header_tokens, rows = None, 0, rows
+        else:
+            rows = rows[header_rows:]
+        segments, current, current_tokens = [], [], header_tokens
+        for row in rows:
+            tokens = self.tokenizer.count(row)
+            if current and current_tokens + tokens > self.max_tokens:
+                segments.append(_Segment("table", "\n".join(([header] if header else []) + current), current_tokens, bbox))
+                current, current_tokens = [], header_tokens
+            if header_tokens + tokens > self.max_tokens:
+                segments.extend(self._split_tokens("table", row, bbox))
+                continue
+            current.append(row)
+            current_tokens += tokens
+        if current:
+            segments.append(_Segment("table", "\n".join(([header] if header else []) + current), current_tokens, bbox))
+        return segments
+
+    def _tail(self, segment):
+        """The last ``overlap`` tokens of a paragraph, carried into the next chunk."""
+        if self.overlap == 0 or segment.kind not in ("paragraph", "sentence"):
+            return None
+        spans = self.tokenizer.spans(segment.text)
+        if len(spans) <= self.overlap:
+            return _Segment(segment.kind, segment.text, len(spans), segment.bbox)
+        return _Segment(segment.kind, segment.text[spans[-self.overlap][0]:], self.overlap, segment.bbox)
+
+    def _pack(self, segments):
+        groups, current, carried = [], [], False
+        for segment in segments:
+            headings_only = all(item.kind == "heading" for item in current)
+            size = sum(item.tokens for item in current)
+            starts_chunk = segment.kind in ("heading", "table") and not headings_only
+            after_table = bool(current) and current[-1].kind == "table"
+            if current and (starts_chunk or after_table or size + segment.tokens > self.max_tokens):
+                tail = None if starts_chunk or after_table else self._tail(current[-1])
+                groups.append(current)
+                carried = bool(tail) and tail.tokens + segment.tokens <= self.max_tokens
+                current = [tail] if carried else []
+            current.append(segment)
+        if current:
+            # A short last chunk joins the one before, without the overlap it repeats
+            own = current[1:] if carried else current
+            prose = ("paragraph", "sentence")
+            if groups and groups[-1][-1].kind in prose and all(item.kind in prose for item in own) \
+                    and sum(item.tokens for item in own) < self.min_tokens \
+                    and sum(item.tokens for item in groups[-1] + own) <= self.max_tokens:
+                groups[-1] = groups[-1] + own
+            else:
+                groups.append(current)
+
+        chunks = []
+        for group in groups:
+            text = group[0].text
+            for previous, segment in zip(group, group[1:]):
+                # Sentences of one paragraph stay on one line
+                same_paragraph = previous.kind == segment.kind == "sentence" and previous.bbox == segment.bbox
+                text += (" " if same_paragraph else "\n") + segment.text
+            kinds = {segment.kind for segment in group} - {"heading"}
+            kind = "table" if "table" in kinds else ("paragraph" if kinds else "heading")
+            bboxes = []
+            for segment in group:
+                if segment.bbox and segment.bbox not in bboxes:
+                    bboxes.append(segment.bbox)
+            tokens = self.tokenizer.count(text)
+            if tokens <= self.max_tokens:
+                chunks.append((text, tokens, kind, bboxes))
+            else:
+                # Joining segments can shift token boundaries; window a chunk that ended up too long
+                chunks.extend((piece.text, piece.tokens, kind, bboxes) for piece in self._split_tokens(kind, text, None))
+        return chunks
@@ -0,0 +1,109 @@
+import hashlib
+import os
+
+NATIVE_TEXT_MIN_CHARS = int(os.environ.get("NATIVE_TEXT_MIN_CHARS", "100"))
+NATIVE_MAX_IMAGE_COVERAGE = float(os.environ.get("NATIVE_MAX_IMAGE_COVERAGE", "0.6"))
+TABLE_EXTRACTION = os.environ.get("TABLE_EXTRACTION", "true").lower() == "true"
+
+def extraction_settings():
+    """Settings that change what is extracted from a page; re-indexing compares pages under them."""
+    return f"native={NATIVE_TEXT_MIN_CHARS}:{NATIVE_MAX_IMAGE_COVERAGE}:tables={TABLE_EXTRACTION}"
+
+def image_coverage(page):
+    """Fraction of the page area covered by images, overlaps counted once per image."""
+    area = abs(page.rect)
+    if not area:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        bbox = page.rect & info["bbox"]
+        if not bbox.is_empty:
+            covered += abs(bbox)
+    return min(covered / area, 1.0)
+
+def text_blocks(page):
+    """
+    Reads the text layer of a fitz page in reading order.
+
+    :return: List of {"bbox": [x0, y0, x1, y1], "text": str} in PDF points.
+    """
+    blocks = []
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks", sort=True):
+        text = text.strip()
+        # block_type 1 is an image block
+        if block_type == 0 and text:
+            blocks.append({"bbox": [round(x0, 2), round(y0, 2), round(x1, 2), round(y1, 2)], "text": text})
+    return blocks
+
+def table_markdown(rows):
+    """Formats table rows, the first being the header, as a Markdown table."""
+    def cell(value):
+        return " ".join(str(value or "").split()).replace("|", "\\|")
+    width = max(len(row) for row in rows)
+    lines = ["|" + "|".join(cell(value) for value in row + [None] * (width - len(row))) + "|" for row in rows]
+    lines.insert(1, "|" + "|".join(["---"] * width) + "|")
+    return "\n".join(lines)
+
+def page_tables(page):
+    """
+    Finds the tables drawn on a fitz page with PyMuPDF's find_tables.
+
+    Only the text layer is searched, so scanned pages have no tables.
+
+    :return: List of {"bbox", "text", "kind": "table"} blocks, the text being a Markdown table.
+    """
+    tables = []
+    for table in page.find_tables().tables:
+        rows = [row for row in table.extract() if any(value and str(value).strip() for value in row)]
+        if len(rows) < 2:
+            continue
+        x0, y0, x1, y1 = table.bbox
+        tables.append({"bbox": [round(x0, 2), round(y0, 2), round(x1, 2), round(y1, 2)], "text": table_markdown(rows), "kind": "table"})
+    return tables
+
+def with_tables(blocks, tables):
+    """
+    Replaces the blocks that lie inside a table with the table itself.
+
+    A block belongs to a table when its center is within the table's bbox.
+    The result is in reading order, top to bottom then left to right.
+    """
+    if not tables:
+        return blocks
+    def inside(block, table):
+        x = (block["bbox"][0] + block["bbox"][2]) / 2
+        y = (block["bbox"][1] + block["bbox"][3]) / 2
+        return table["bbox"][0] <= x <= table["bbox"][2] and table["bbox"][1] <= y <= table["bbox"][3]
+    kept = [block for block in blocks if not any(inside(block, table) for table in tables)]
+    return sorted(kept + tables, key=lambda block: (block["bbox"][1], block["bbox"][0]))
+
+def native_text(page, min_chars=NATIVE_TEXT_MIN_CHARS, max_image_coverage=NATIVE_MAX_IMAGE_COVERAGE):
+    """
+    Returns the text layer of a page when it can be used instead of OCR.
+
+    A page qualifies when its text layer has at least ``min_chars`` characters
+    and images cover at most ``max_image_coverage`` of it. Scanned pages have
+    no text layer, and image-heavy pages keep most of their text in pixels.
+
+    :return: (text, blocks), or None when the page should be OCRed.
+    """
+    blocks = text_blocks(page)
+    text = "\n".join(block["text"] for block in blocks)
+    if len(text) < min_chars or image_coverage(page) > max_image_coverage:
+        return None
+    return text, blocks
+
+def page_hash(page):
+    """
+    Fingerprint of what a fitz page shows, used to skip unchanged pages on re-indexing.
+
+    It covers the page size, its content streams, its text (which also picks
+    up text drawn from form XObjects) and the digest of every image.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(tuple(page.rect)).encode("utf-8"))
+    digest.update(page.read_contents())
+    digest.update(page.get_text("text").encode("utf-8"))
+    for info in page.get_image_info(hashes=True):
+        digest.update(info.get("digest") or b"")
+    return digest.hexdigest()
@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+import numpy as np
+
+OCR_REC_BATCH_NUM = int(os.environ.get("OCR_REC_BATCH_NUM", "16"))
+
+@dataclass
+class OCRResult:
+    """Text recognized on one page image and the time it took."""
+    image: str
+    text: str
+    lines: list = field(default_factory=list)
+    seconds: float = 0.0
+    error: str = None
+
+class OCREngine:
+    """
+    PaddleOCR models loaded once and shared by every page in the process.
+
+    Building PaddleOCR loads the detection, angle classification and
+    recognition models, so it is done on first use (or by ``warmup``) and the
+    engine is reused afterwards. Inference is serialized with a lock because
+    the Paddle predictors are not thread-safe. Recognition of the text lines
+    found on a page runs in batches of ``rec_batch_num``.
+
+    :param lang: PaddleOCR language.
+    :param use_angle_cls: Detect and correct rotated text lines.
+    :param rec_batch_num: Text lines per recognition inference call.
+    """
+    def __init__(self, lang="en", use_angle_cls=True, rec_batch_num=OCR_REC_BATCH_NUM):
+        self.lang = lang
+        self.use_angle_cls = use_angle_cls
+        self.rec_batch_num = rec_batch_num
+        self._ocr = None
+        self._load_lock = threading.Lock()
+        self._inference_lock = threading.Lock()
+
+    @property
+    def ocr(self):
+        with self._load_lock:
+            if self._ocr is None:
+                from paddleocr import PaddleOCR
+                started = time.perf_counter()
+                self._ocr = PaddleOCR(use_angle_cls=self.use_angle_cls, lang=self.lang, rec_batch_num=self.rec_batch_num, show_log=False)
+                logging.info(f"Loaded PaddleOCR models in {time.perf_counter() - started:.2f}s")
+            return self._ocr
+
+    def warmup(self):
+        """Loads the models and runs one inference so the first real page is not slowed down."""
+        ocr = self.ocr
+        blank = np.full((64, 256, 3), 255, dtype=np.uint8)
+        with self._inference_lock:
+            ocr.ocr(blank, cls=self.use_angle_cls)
+
+    def recognize(self, image):
+        """
+        Recognizes the text of one page image.
+
+        :param image: Image path or HxWx3 uint8 array.
+        :return: OCRResult; on failure its text is empty and error is set.
+        """
+        ocr = self.ocr
+        name = image if isinstance(image, str) else "<array>"
+        with self._inference_lock:
+            started = time.perf_counter()
+            try:
+                result = ocr.ocr(image, cls=self.use_angle_cls)
+                # A page without text comes back as [None]
+                lines = [(line[1][0], float(line[1][1]), line[0]) for line in (result[0] or [])] if result else []
+                page = OCRResult(image=name, text="\n".join(line[0] for line in lines), lines=lines)
+            except Exception as e:
+                logging.exception(e)
+                page = OCRResult(image=name, text="", error=str(e))
+            page.seconds = time.perf_counter() - started
+        return page
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_ocr_engine(lang="en"):
+    """
+    Returns this process's OCR engine for ``lang``.
+
+    Engines are keyed by process id, so a forked worker loads its own models
+    rather than using the parent's Paddle predictors.
+    """
+    key = (os.getpid(), lang)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = OCREngine(lang=lang)
+        return _engines[key]
@@ -0,0 +1,431 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+import numpy as np
+
+CPU_WORKERS = max((os.cpu_count() or 2) // 2, 1)
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", str(CPU_WORKERS)))
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(CPU_WORKERS)))
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "4"))
+EXTRACT_CHUNK_PAGES = int(os.environ.get("EXTRACT_CHUNK_PAGES", "8"))
+EMBED_BATCH_PAGES = int(os.environ.get("EMBED_BATCH_PAGES", "16"))
+WRITE_BATCH_PAGES = int(os.environ.get("WRITE_BATCH_PAGES", "32"))
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "64"))
+OCR_DPI = int(os.environ.get("OCR_DPI", "150"))
+
+_STOP = object()
+
+@dataclass
+class Page:
+    """
+    One page moving through the ingestion pipeline; pageno starts at 1.
+
+    ``method`` is "native" when the text came from the PDF's text layer and
+    "ocr" when the page was rasterized and OCRed. ``blocks`` are the text
+    blocks or lines with their bbox in PDF points; ``tables`` are the tables
+    found on the text layer, which replace the blocks they cover. When the pipeline has a
+    chunker, ``chunks`` holds the page's extractor.chunking.Chunk list and
+    embeddings are set on the chunks instead of the page.
+    """
+    pageno: int
+    image_path: str = None
+    text: str = ""
+    method: str = None
+    blocks: list = field(default_factory=list)
+    tables: list = field(default_factory=list)
+    ocr_ms: float = 0.0
+    embedding: object = None
+    content_hash: str = None
+    chunks: list = None
+    error: str = None
+
+def render_missing_page(file_path, images_folder, pageno):
+    """Renders the image of a page that was ingested without one; returns its path."""
+    from InputDocument import InputDocument
+    with InputDocument(os.path.basename(file_path), file_path, save_images_to_disk=False) as document:
+        image_path = os.path.join(images_folder, f"page_{pageno}.png")
+        if not os.path.exists(image_path):
+            document.imagesfolder = images_folder
+            for _ in document.save_pages([pageno]):
+                pass
+    return image_path
+
+def render_missing_thumbnail(file_path, images_folder, pageno):
+    """Renders the thumbnail of a page that was ingested without one; returns its path."""
+    from InputDocument import InputDocument, thumbnail_path
+    path = thumbnail_path(images_folder, pageno)
+    if not os.path.exists(path):
+        with InputDocument(os.path.basename(file_path), file_path, save_images_to_disk=False) as document:
+            document.imagesfolder = images_folder
+            for _ in document.save_thumbnails([pageno]):
+                pass
+    return path
+
+def extract_chunk(file_path, images_folder, pagenos):
+    """
+    Reads the text layer of pages in a worker process.
+
+    Pages with a usable text layer (see extractor.native_text) take their text
+    from it, the others are marked for OCR. Tables on the text layer are
+    read as Markdown (see extractor.page_tables). Only the small citation
+    thumbnails are rendered here; full page images are rendered on demand
+    when first served.
+    """
+    from InputDocument import InputDocument, THUMBNAIL_WIDTH
+    from extractor.extractor import TABLE_EXTRACTION, native_text, page_tables, with_tables
+    pages = []
+    with InputDocument(os.path.basename(file_path), file_path, save_images_to_disk=False) as document:
+        for pageno in pagenos:
+            image_path = os.path.join(images_folder, f"page_{pageno}.png")
+            try:
+                page = document.document.load_page(pageno - 1)
+                native = native_text(page)
+                # Tables come from the text layer, in the same pass as the text
+                tables = page_tables(page) if TABLE_EXTRACTION and page.get_text("text").strip() else []
+                if native is not None:
+                    text, blocks = native
+                    pages.append(Page(pageno=pageno, image_path=image_path, text=text, method="native", blocks=with_tables(blocks, tables), tables=tables))
+                else:
+                    pages.append(Page(pageno=pageno, image_path=image_path, method="ocr", tables=tables))
+            except Exception as e:
+                pages.append(Page(pageno=pageno, error=f"extraction failed: {e}"))
+                continue
+            if THUMBNAIL_WIDTH:
+                document.imagesfolder = images_folder
+                try:
+                    for _ in document.save_thumbnails([pageno]):
+                        pass
+                except Exception as e:
+                    # A missing thumbnail is rendered when first served
+                    logging.warning(f"Could not save the thumbnail of page {pageno}: {e}")
+    return pages
+
+def file_hash(file_path, block_size=1 << 20):
+    """sha256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def page_hashes(file_path, pagenos=None):
+    """
+    Hashes the given pages of a PDF, all of them by default; see extractor.page_hash.
+
+    :return: Dict of page number to hash.
+    """
+    from InputDocument import InputDocument, parse_page_range
+    from extractor.extractor import page_hash
+    with InputDocument(os.path.basename(file_path), file_path, save_images_to_disk=False) as document:
+        return {pageno: page_hash(document.document.load_page(pageno - 1)) for pageno in parse_page_range(pagenos, document.total_pages)}
+
+def ocr_page(file_path, pageno, dpi=OCR_DPI):
+    """
+    Renders one page in memory and OCRs it with the worker process's engine.
+
+    The page goes straight from the renderer to PaddleOCR as an array, with
+    no PNG encoded or read back in between.
+
+    :return: (text, blocks, seconds, error), with one block per recognized
+             line and its bbox scaled back to PDF points.
+    """
+    from InputDocument import InputDocument
+    from extractor.ocr import get_ocr_engine
+    with InputDocument(os.path.basename(file_path), file_path, save_images_to_disk=False, dpi=dpi) as document:
+        _, array = next(document.iter_arrays([pageno]))
+    # PaddleOCR expects OpenCV's BGR channel order
+    result = get_ocr_engine().recognize(np.ascontiguousarray(array[:, :, ::-1]))
+    scale = 72.0 / dpi
+    blocks = []
+    for text, _, box in result.lines:
+        xs = [float(point[0]) * scale for point in box]
+        ys = [float(point[1]) * scale for point in box]
+        blocks.append({"bbox": [round(min(xs), 2), round(min(ys), 2), round(max(xs), 2), round(max(ys), 2)], "text": text})
+    return result.text, blocks, result.seconds, result.error
+
+def warm_ocr_worker():
+    from extractor.ocr import get_ocr_engine
+    get_ocr_engine().warmup()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(name, workers, initializer=None):
+    """
+    Returns the process pool shared by every pipeline run of this process.
+
+    Pools live as long as the process, so OCR workers load their models once.
+    They are forked; create them (see warmup) before the parent starts threads
+    or loads Paddle itself. A pool broken by a dead worker is replaced.
+    """
+    key = (os.getpid(), name)
+    with _pools_lock:
+        if key not in _pools or _pools[key]._broken:
+            _pools[key] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"), initializer=initializer)
+        return _pools[key]
+
+def _discard_pool(name, pool):
+    key = (os.getpid(), name)
+    with _pools_lock:
+        if _pools.get(key) is pool:
+            del _pools[key]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def run_in_pool(name, workers, fn, *args, initializer=None):
+    """
+    Runs ``fn(*args)`` in the named pool and returns its result.
+
+    When a worker dies (a Paddle segfault, the OOM killer), the pool fails
+    every later task; it is then replaced and the task retried once on the
+    new workers.
+    """
+    for attempt in range(2):
+        pool = get_pool(name, workers, initializer=initializer)
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            logging.error(f"A {name} worker process died, restarting the {name} pool")
+            _discard_pool(name, pool)
+            if attempt:
+                raise
+
+def warmup(extract_workers=EXTRACT_WORKERS, ocr_workers=OCR_WORKERS):
+    """Forks the extraction and OCR workers now; each OCR worker loads and warms up its models."""
+    futures = [get_pool("extract", extract_workers).submit(time.sleep, 0)]
+    futures += [get_pool("ocr", ocr_workers, initializer=warm_ocr_worker).submit(time.sleep, 0) for _ in range(ocr_workers)]
+    for future in futures:
+        future.result()
+
+_stats = {"runs": 0, "pages": 0, "native_pages": 0, "ocr_pages": 0, "chunks": 0, "tables": 0, "errors": 0, "extract_seconds": 0.0, "ocr_seconds": 0.0, "chunk_seconds": 0.0, "embed_seconds": 0.0, "write_seconds": 0.0, "wall_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+def ingestion_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["avg_ocr_page_ms"] = round(stats["ocr_seconds"] / stats["ocr_pages"] * 1000, 1) if stats["ocr_pages"] else 0.0
+    stats["pages_per_second"] = round(stats["pages"] / stats["wall_seconds"], 2) if stats["wall_seconds"] else 0.0
+    return stats
+
+class IngestionPipeline:
+    """
+    Extracts, OCRs, embeds and writes the pages of one PDF concurrently.
+
+    Each stage is a set of threads reading from a bounded queue and writing to
+    the next one, so a slow stage holds back the ones before it instead of
+    letting pages pile up in memory. Extraction and OCR run in process pools,
+    one thread per worker keeping it busy; pages are then chunked, if the
+    pipeline has a chunker, and embedding batches run on
+    ``embed_workers`` threads so several requests are in flight at once. The
+    writer hands pages to ``write`` in batches, always in ascending page
+    order, so results do not depend on which worker finished first.
+
+    :param file_path: PDF to ingest.
+    :param images_folder: Folder of the page images.
+    :param embed: Callable setting ``embedding`` and ``content_hash`` on a list of pages,
+                  or on their chunks when ``chunker`` is set.
+    :param write: Callable persisting a list of pages, called from the writer thread.
+                  Pages whose extraction or OCR failed are passed with ``error`` set.
+    :param progress: Optional callable(pages_done, pages_total, errors) called after each write.
+    :param cancelled: Optional callable returning True once the run should stop. Stages
+                      then drain their queues without handling what is left.
+    :param chunker: Optional extractor.chunking.Chunker splitting each page before it is embedded.
+    """
+    def __init__(self, file_path, images_folder, embed, write, extract_workers=EXTRACT_WORKERS, ocr_workers=OCR_WORKERS,
+                 embed_workers=EMBED_WORKERS, embed_batch=EMBED_BATCH_PAGES, write_batch=WRITE_BATCH_PAGES, queue_size=PIPELINE_QUEUE_SIZE,
+                 progress=None, cancelled=None, chunker=None):
+        self.file_path = file_path
+        self.images_folder = images_folder
+        self.embed = embed
+        self.write = write
+        self.extract_workers = extract_workers
+        self.ocr_workers = ocr_workers
+        self.embed_workers = embed_workers
+        self.embed_batch = embed_batch
+        self.write_batch = write_batch
+        self.queue_size = queue_size
+        self.progress = progress
+        self.cancelled = cancelled
+        self.chunker = chunker
+        self.stopped = False
+        self.timings = {"extract": 0.0, "ocr": 0.0, "chunk": 0.0, "embed": 0.0, "write": 0.0}
+        self.errors = []
+        self.dropped = set()
+        self.lock = threading.Lock()
+
+    def page_count(self):
+        import fitz
+        with fitz.open(self.file_path) as document:
+            return document.page_count
+
+    def page_hashes(self, pagenos=None):
+        """Hashes pages in an extraction worker process, see page_hashes."""
+        return run_in_pool("extract", self.extract_workers, page_hashes, self.file_path, pagenos)
+
+    def run(self, pagenos=None):
+        """
+        Ingests the given pages, all of them by default.
+
+        :return: The written pages, in page order.
+        """
+        started = time.perf_counter()
+        os.makedirs(self.images_folder, exist_ok=True)
+        pagenos = sorted(pagenos) if pagenos is not None else list(range(1, self.page_count() + 1))
+
+        chunks = queue.Queue()
+        for start in range(0, len(pagenos), EXTRACT_CHUNK_PAGES):
+            chunks.put(pagenos[start:start + EXTRACT_CHUNK_PAGES])
+        chunks.put(_STOP)
+        extracted = queue.Queue(self.queue_size)
+        recognized = queue.Queue(self.queue_size)
+        chunked = queue.Queue(self.queue_size)
+        embedded = queue.Queue(self.queue_size)
+
+        threads = self._stage("extract", chunks, extracted, self.extract_workers, 1,
+                              lambda items: run_in_pool("extract", self.extract_workers, extract_chunk, self.file_path, self.images_folder, items[0]))
+        threads += self._stage("ocr", extracted, recognized, self.ocr_workers, 1, lambda items: self._ocr(items[0]))
+        threads += self._stage("chunk", recognized, chunked, 1, 1, lambda items: self._chunk(items[0]))
+        threads += self._stage("embed", chunked, embedded, self.embed_workers, self.embed_batch, self._embed)
+        written = []
+        writer = threading.Thread(target=self._writer, args=(embedded, pagenos, written), name="ingest-write", daemon=True)
+        threads.append(writer)
+        for thread in threads:
+            thread.start()
+        writer.join()
+        if self.progress:
+            self.progress(len(written), len(pagenos), self.errors)
+
+        with _stats_lock:
+            _stats["runs"] += 1
+            _stats["pages"] += len(written)
+            _stats["native_pages"] += sum(1 for page in written if page.method == "native")
+            _stats["ocr_pages"] += sum(1 for page in written if page.method == "ocr")
+            _stats["chunks"] += sum(len(page.chunks) for page in written if page.chunks is not None)
+            _stats["tables"] += sum(len(page.tables) for page in written)
+            _stats["errors"] += len(self.errors)
+            for name, seconds in self.timings.items():
+                _stats[f"{name}_seconds"] += seconds
+            _stats["wall_seconds"] += time.perf_counter() - started
+        return written
+
+    def _stopping(self):
+        if not self.stopped and self.cancelled is not None and self.cancelled():
+            self.stopped = True
+        return self.stopped
+
+    def _ocr(self, page):
+        if page.error or page.method == "native":
+            return [page]
+        page.text, page.blocks, seconds, page.error = run_in_pool("ocr", self.ocr_workers, ocr_page, self.file_path, page.pageno, initializer=warm_ocr_worker)
+        if page.tables:
+            from extractor.extractor import with_tables
+            page.blocks = with_tables(page.blocks, page.tables)
+        page.ocr_ms = round(seconds * 1000, 1)
+        return [page]
+
+    def _chunk(self, page):
+        if self.chunker is not None and not page.error:
+            page.chunks = self.chunker.chunk(page.pageno, page.text, page.blocks, lines=page.method == "ocr")
+        return [page]
+
+    def _embed(self, pages):
+        ok = [page for page in pages if not page.error]
+        if ok:
+            self.embed(ok)
+        return pages
+
+    def _take(self, inbox, batch):
+        """Takes up to ``batch`` items, waiting for the first; None once the stage is done."""
+        item = inbox.get()
+        if item is _STOP:
+            inbox.put(_STOP)
+            return None
+        items = [item]
+        while len(items) < batch:
+            try:
+                item = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                inbox.put(_STOP)
+                break
+            items.append(item)
+        return items
+
+    def _stage(self, name, inbox, outbox, workers, batch, handle):
+        running = [workers]
+
+        def work():
+            while True:
+                items = self._take(inbox, batch)
+                if items is None:
+                    break
+                if self._stopping():
+                    continue
+                started = time.perf_counter()
+                try:
+                    results = handle(items)
+                except Exception as e:
+                    logging.exception(e)
+                    results = []
+                    # Extract items are lists of page numbers, later stages pass pages
+                    lost = items[0] if name == "extract" else [page.pageno for page in items]
+                    with self.lock:
+                        self.errors.append(f"{name} failed for pages {lost}: {e}")
+                        self.dropped.update(lost)
+                with self.lock:
+                    self.timings[name] += time.perf_counter() - started
+                for result in results:
+                    outbox.put(result)
+            with self.lock:
+                running[0] -= 1
+                last = running[0] == 0
+            if last:
+                outbox.put(_STOP)
+
+        return [threading.Thread(target=work, name=f"ingest-{name}-{i}", daemon=True) for i in range(workers)]
+
+    def _writer(self, inbox, pagenos, written):
+        pending = {}
+        order = iter(pagenos)
+        expected = next(order, None)
+
+        def flush(pages):
+            if self._stopping():
+                return
+            started = time.perf_counter()
+            try:
+                self.write(pages)
+                written.extend(pages)
+            except Exception as e:
+                logging.exception(e)
+                with self.lock:
+                    self.errors.append(f"write failed for pages {[page.pageno for page in pages]}: {e}")
+            with self.lock:
+                self.timings["write"] += time.perf_counter() - started
+            if self.progress:
+                self.progress(len(written), len(pagenos), self.errors)
+
+        ready = []
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                break
+            pending[item.pageno] = item
+            # Only the next pages in order are released, so writes follow page order
+            while expected is not None and (expected in pending or expected in self.dropped):
+                if expected in pending:
+                    ready.append(pending.pop(expected))
+                expected = next(order, None)
+            if len(ready) >= self.write_batch:
+                flush(ready)
+                ready = []
+        ready.extend(pending[pageno] for pageno in sorted(pending))
+        if ready:
+            flush(ready)
@@ -0,0 +1,178 @@
+import datetime
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "1"))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "1.0"))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_STALE_SECONDS = float(os.environ.get("JOB_STALE_SECONDS", "120"))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get("JOB_RETRY_BASE_SECONDS", "5"))
+JOB_RETRY_MAX_SECONDS = float(os.environ.get("JOB_RETRY_MAX_SECONDS", "300"))
+JOB_CANCEL_CHECK_SECONDS = float(os.environ.get("JOB_CANCEL_CHECK_SECONDS", "2"))
+JOB_ERROR_BACKOFF_MAX_SECONDS = float(os.environ.get("JOB_ERROR_BACKOFF_MAX_SECONDS", "60"))
+
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+class JobCancelled(Exception):
+    """Raised by a handler that notices its job was cancelled."""
+
+class JobContext:
+    """
+    What a job handler sees of the queue while it runs.
+
+    ``progress`` records pages done and refreshes the heartbeat; ``cancelled``
+    tells the handler to stop. Both read and write the job row, so
+    ``cancelled`` answers from the last progress update and only queries the
+    database every ``JOB_CANCEL_CHECK_SECONDS``.
+    """
+    def __init__(self, dbkeeper, job):
+        self.dbkeeper = dbkeeper
+        self.job = job
+        self.cancel_requested = False
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def payload(self):
+        return self.job["payload"]
+
+    def progress(self, pages_done=None, pages_total=None, errors=None):
+        requested = self.dbkeeper.update_job_progress(self.job["id"], pages_done, pages_total,
+                                                      list(errors) if errors is not None else None)
+        with self.lock:
+            self.cancel_requested = self.cancel_requested or requested
+            self.checked = time.monotonic()
+
+    def heartbeat(self):
+        self.progress()
+
+    def cancelled(self):
+        with self.lock:
+            due = time.monotonic() - self.checked >= JOB_CANCEL_CHECK_SECONDS
+        if due and not self.cancel_requested:
+            self.heartbeat()
+        return self.cancel_requested
+
+def describe_job(job):
+    """
+    A job row as returned by the API, with its progress and an ETA.
+
+    The ETA extrapolates the pace of the current run, so it is None until
+    the first pages are written.
+    """
+    described = dict(job)
+    done, total = job.get("pages_done") or 0, job.get("pages_total")
+    described["progress"] = round(done / total, 4) if total else (1.0 if job["status"] == "succeeded" else 0.0)
+    described["eta_seconds"] = None
+    if job["status"] == "running" and total and done and job.get("started"):
+        elapsed = (datetime.datetime.now(datetime.timezone.utc) - job["started"]).total_seconds()
+        described["eta_seconds"] = round(elapsed / done * (total - done), 1)
+    return described
+
+def retry_delay(attempt):
+    """Backoff before the next attempt of a failed job: full jitter, capped."""
+    return random.uniform(0, min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+
+class JobWorker:
+    """
+    Runs jobs from org.jobs on background threads.
+
+    Each thread claims the oldest queued job of a registered kind, calls its
+    handler with a JobContext, and records the outcome. A handler returns a
+    JSON-serializable result, raises JobCancelled to stop, or raises anything
+    else to fail the attempt; failed attempts are retried with backoff until
+    the job's max_attempts. While a job runs, a heartbeat keeps its row fresh;
+    jobs whose heartbeat goes stale, because the server stopped, are put back
+    in the queue by ``requeue_stale`` when a worker starts.
+
+    :param dbkeeper: DataKeeper.
+    :param handlers: Dict of job kind to callable(context) returning the result.
+    :param workers: Jobs run at the same time by this process.
+    """
+    def __init__(self, dbkeeper, handlers, workers=JOB_WORKERS, poll_seconds=JOB_POLL_SECONDS):
+        self.dbkeeper = dbkeeper
+        self.handlers = dict(handlers)
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+        self.threads = []
+
+    def requeue_stale(self):
+        requeued = self.dbkeeper.requeue_stale_jobs(JOB_STALE_SECONDS)
+        if requeued:
+            logging.info(f"Requeued {requeued} interrupted jobs")
+        return requeued
+
+    def start(self):
+        self.requeue_stale()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def notify(self):
+        """Wakes an idle worker, so a job submitted in this process starts without waiting for the next poll."""
+        self.wakeup.set()
+
+    def _loop(self):
+        last_requeue = time.monotonic()
+        failures = 0
+        while not self.stop_event.is_set():
+            try:
+                if time.monotonic() - last_requeue >= JOB_STALE_SECONDS:
+                    self.requeue_stale()
+                    last_requeue = time.monotonic()
+                job = self.dbkeeper.claim_job(f"{self.name}:{threading.current_thread().name}", list(self.handlers))
+                if job is None:
+                    self.wakeup.wait(self.poll_seconds)
+                    self.wakeup.clear()
+                else:
+                    self.run(job)
+                failures = 0
+            except Exception:
+                # The thread must outlive any error, or queued jobs would wait forever
+                failures += 1
+                logging.exception(f"Job worker {threading.current_thread().name} failed, retrying")
+                self.stop_event.wait(min(self.poll_seconds * 2 ** failures, JOB_ERROR_BACKOFF_MAX_SECONDS))
+
+    def run(self, job):
+        context = JobContext(self.dbkeeper, job)
+        beating = threading.Event()
+
+        def beat():
+            while not beating.wait(JOB_HEARTBEAT_SECONDS):
+                context.heartbeat()
+
+        heartbeat = threading.Thread(target=beat, name=f"job-{job['id']}-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            result = self.handlers[job["kind"]](context)
+            if context.cancel_requested:
+                raise JobCancelled()
+            self.dbkeeper.finish_job(job["id"], "succeeded", result=result)
+        except JobCancelled:
+            self.dbkeeper.finish_job(job["id"], "cancelled")
+        except Exception as e:
+            logging.exception(e)
+            error = f"attempt {job['attempts']}: {traceback.format_exc(limit=5)}"
+            if context.cancel_requested:
+                self.dbkeeper.finish_job(job["id"], "cancelled", error=error)
+            else:
+                self.dbkeeper.finish_job(job["id"], "failed", error=error, retry_delay=retry_delay(job["attempts"]))
+        finally:
+            beating.set()
+            heartbeat.join()
@@ -9,53 +9,60 @@ const AdminPanel = ({ selectedSpace, selectedFile, setSelectedFile }) => {
     const [loading, setLoading] = useState(false);
     const [progress, setProgress] = useState(0);
 
+    const [job, setJob] = useState(null);
+
+    const toastOptions = {
+        position: "top-center",
+        autoClose: 5000,
+        hideProgressBar: false,
+        closeOnClick: true,
+        pauseOnHover: true,
+        draggable: true,
+        progress: undefined,
+    };
+
+    // Indexing runs as a background job; poll it until it finishes
+    const followJob = async (jobId) => {
+        while (true) {
+            const { data } = await axios.get(`http://192.168.1.3:5000/jobs/${jobId}`);
+            setJob(data);
+            setProgress(Math.round(data.progress * 100));
+            if (data.status === 'succeeded') {
+                toast.success(data.result.message, toastOptions);
+                return;
+            }
+            if (data.status === 'failed' || data.status === 'cancelled') {
+                toast.error(`Indexing ${data.status}`, toastOptions);
+                return;
+            }
+            await new Promise((resolve) => setTimeout(resolve, 1000));
+        }
+    };
+
+    const cancelJob = async () => {
+        if (job) {
+            await axios.post(`http://192.168.1.3:5000/jobs/${job.id}/cancel`);
+        }
+    };
+
     const convertPdf = async () => {
         if (selectedFile && selectedSpace) {
             setLoading(true);
             setProgress(0);
+            setJob(null);
             try {
                 const response = await axios.post(
                     `http://192.168.1.3:5000/convert_pdf/${selectedFile.name}`,
-                    { space: selectedSpace.name },
-                    {
-                        onUploadProgress: (progressEvent) => {
-                            const percentCompleted = Math.round((progressEvent.loaded * 100) / progressEvent.total);
-                            setProgress(percentCompleted);
-                        }
-                    }
+                    { space: selectedSpace.name }
                 );
-                toast.success(response.data.message, {
-                    position: "top-center",
-                    autoClose: 5000,
-                    hideProgressBar: false,
-                    closeOnClick: true,
-                    pauseOnHover: true,
-                    draggable: true,
-                    progress: undefined,
-                });
+                await followJob(response.data.job_id);
             } catch (error) {
-                toast.error('Error converting PDF', {
-                    position: "top-center",
-                    autoClose: 5000,
-                    hideProgressBar: false,
-                    closeOnClick: true,
-                    pauseOnHover: true,
-                    draggable: true,
-                    progress: undefined,
-                });
+                toast.error('Error converting PDF', toastOptions);
             } finally {
                 setLoading(false);
             }
         } else {
-            toast.warn('No file selected or space selected', {
-                position: "top-center",
-                autoClose: 5000,
-                hideProgressBar: false,
-                closeOnClick: true,
-                pauseOnHover: true,
-                draggable: true,
-                progress: undefined,
-            });
+            toast.warn('No file selected or space selected', toastOptions);
         }
     };
 
@@ -113,7 +120,16 @@ const AdminPanel = ({ selectedSpace, selectedFile, setSelectedFile }) => {
                                     )}
                                 </Button>
                                 {loading && (
-                                    <ProgressBar now={progress} label={`${progress}%`} className="mt-3" />
+                                    <>
+                                        <ProgressBar now={progress} label={`${progress}%`} className="mt-3" />
+                                        {job && (
+                                            <p className="mt-2">
+                                                {job.pages_done}/{job.pages_total || '?'} pages
+                                                {job.eta_seconds !== null && ` - about ${Math.ceil(job.eta_seconds)}s left`}
+                                                <Button className="ms-2" size="sm" variant="outline-danger" onClick={cancelJob}>Cancel</Button>
+                                            </p>
+                                        )}
+                                    </>
                                 )}
                             </>
                         )}
@@ -0,0 +1,203 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from searchlib.scoring import normalize_rows
+
+class SpaceMatrix:
+    """
+    Immutable snapshot of one space's embeddings.
+
+    :param ids: spaces_embeddings ids, one per row.
+    :param matrix: (n, dim) float32 matrix of unit-length embeddings.
+    :param numtokens: Token count of each row.
+    :param rows: (pageno, context, metadata, source, imagepath) tuple of each row.
+    """
+    def __init__(self, ids, matrix, numtokens, rows):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.numtokens = np.asarray(numtokens, dtype=np.float32)
+        self.rows = list(rows)
+        self.sources = np.array([row[3] for row in self.rows], dtype=object)
+        self.positions = {int(row_id): i for i, row_id in enumerate(self.ids)}
+        text_bytes = sum(len(row[1] or "") for row in self.rows)
+        self.nbytes = self.matrix.nbytes + self.ids.nbytes + self.numtokens.nbytes + text_bytes
+
+    @classmethod
+    def from_raw(cls, ids, matrix, numtokens, rows):
+        """Builds a snapshot from embeddings that are not normalized yet."""
+        return cls(ids, normalize_rows(matrix), numtokens, rows)
+
+    def select(self, filename=None):
+        """Returns the row positions belonging to ``filename``, or all rows."""
+        if filename is None:
+            return None
+        return np.flatnonzero(self.sources == filename)
+
+    def with_rows(self, row_ids, embeddings, numtokens, rows):
+        """Returns a snapshot with the given rows appended, copying the matrix once."""
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32).reshape(len(row_ids), -1))
+        if len(self.ids) and vectors.shape[1] != self.matrix.shape[1]:
+            raise ValueError("Embedding dimension does not match the cached space")
+        matrix = np.vstack([self.matrix, vectors]) if len(self.ids) else vectors
+        return SpaceMatrix(
+            np.concatenate([self.ids, np.asarray(row_ids, dtype=np.int64)]), matrix,
+            np.concatenate([self.numtokens, np.asarray(numtokens, dtype=np.float32)]), self.rows + list(rows),
+        )
+
+    def with_update(self, row_id, context=None, embedding=None):
+        i = self.positions[int(row_id)]
+        matrix = self.matrix
+        rows = self.rows
+        if embedding is not None:
+            matrix = matrix.copy()
+            matrix[i] = normalize_rows(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+        if context is not None:
+            rows = list(rows)
+            rows[i] = (rows[i][0], context) + tuple(rows[i][2:])
+        return SpaceMatrix(self.ids, matrix, self.numtokens, rows)
+
+    def without_rows(self, row_ids):
+        """Returns a snapshot without the given rows, copying the matrix once."""
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[[self.positions[int(row_id)] for row_id in row_ids if int(row_id) in self.positions]] = False
+        return SpaceMatrix(self.ids[keep], self.matrix[keep], self.numtokens[keep], [row for row, kept in zip(self.rows, keep) if kept])
+
+class SpaceMatrixCache:
+    """
+    LRU cache of SpaceMatrix snapshots keyed by space name, capped by memory.
+
+    Entries are replaced rather than modified, so a reader that already holds a
+    snapshot is never affected by a concurrent write-through. New snapshots are
+    built outside the lock, one per write batch. Every write bumps the space's
+    generation, so a snapshot loaded while a write was in flight is not stored:
+    readers take a token() before loading and hand it to put().
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Writes to rows of an unknown space bump the epoch, which covers every space
+        self.epoch = 0
+        self.generations = {}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, space):
+        with self.lock:
+            entry = self.entries.get(space)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(space)
+            self.hits += 1
+            return entry
+
+    def token(self, space):
+        """Version of ``space`` to pass to put() for a snapshot loaded from now on."""
+        with self.lock:
+            return self.epoch, self.generations.get(space, 0)
+
+    def put(self, space, entry, token=None):
+        """
+        Stores a snapshot of ``space``.
+
+        :param token: token() taken before the snapshot was loaded; when the
+                      space was written since, the snapshot is dropped.
+        :return: Whether the snapshot was stored.
+        """
+        with self.lock:
+            if token is not None and token != (self.epoch, self.generations.get(space, 0)):
+                return False
+            self._put(space, entry)
+            return True
+
+    def invalidate(self, space=None):
+        with self.lock:
+            if space is None:
+                self.epoch += 1
+                self.entries.clear()
+                self.current_bytes = 0
+            else:
+                self._bump(space)
+                self._discard(space)
+
+    def add_rows(self, space, row_ids, embeddings, numtokens, rows):
+        if len(row_ids):
+            self._apply(space, lambda entry: entry.with_rows(row_ids, embeddings, numtokens, rows))
+
+    def add_row(self, space, row_id, embedding, numtokens, row):
+        self.add_rows(space, [row_id], [embedding], [numtokens], [row])
+
+    def update_row(self, row_id, context=None, embedding=None):
+        with self.lock:
+            space = self._owner(row_id)
+            if space is None:
+                self.epoch += 1
+                return
+        self._apply(space, lambda entry: entry.with_update(row_id, context=context, embedding=embedding))
+
+    def remove_rows(self, row_ids):
+        by_space = {}
+        with self.lock:
+            for row_id in row_ids:
+                space = self._owner(row_id)
+                if space is None:
+                    # A snapshot being loaded may still hold the row
+                    self.epoch += 1
+                else:
+                    by_space.setdefault(space, []).append(row_id)
+        for space, space_ids in by_space.items():
+            self._apply(space, lambda entry, space_ids=space_ids: entry.without_rows(space_ids))
+
+    def remove_row(self, row_id):
+        self.remove_rows([row_id])
+
+    def _apply(self, space, change):
+        """Bumps the generation of ``space`` and replaces its snapshot with change(snapshot)."""
+        with self.lock:
+            generation = self._bump(space)
+            entry = self.entries.get(space)
+        if entry is None:
+            return
+        try:
+            updated = change(entry)
+        except (KeyError, ValueError):
+            updated = None
+        with self.lock:
+            # A concurrent write to the space built on the same snapshot; drop both
+            if self.entries.get(space) is not entry or self.generations.get(space) != generation:
+                updated = None
+            if updated is None:
+                self._discard(space)
+            else:
+                self._put(space, updated)
+
+    def _bump(self, space):
+        self.generations[space] = self.generations.get(space, 0) + 1
+        return self.generations[space]
+
+    def _owner(self, row_id):
+        for space, entry in self.entries.items():
+            if int(row_id) in entry.positions:
+                return space
+        return None
+
+    def _put(self, space, entry):
+        self._discard(space)
+        if entry.nbytes > self.max_bytes:
+            return
+        self.entries[space] = entry
+        self.current_bytes += entry.nbytes
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+
+    def _discard(self, space):
+        entry = self.entries.pop(space, None)
+        if entry is not None:
+            self.current_bytes -= entry.nbytes
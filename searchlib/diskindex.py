@@ -0,0 +1,270 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+import numpy as np
+from searchlib.scoring import normalize_rows
+
+INDEX_FOLDER = ".vectorindex"
+LOCK_FOLDER = ".locks"
+INDEX_VERSION = 1
+SCORE_CHUNK_ROWS = 16384
+
+def index_path(space_path):
+    """Location of the vector index of the space folder ``space_path``."""
+    return os.path.join(space_path, INDEX_FOLDER)
+
+def quantize(matrix, dtype):
+    """
+    Quantizes unit-length rows.
+
+    :return: (codes, scales) where scales is None for float16.
+    """
+    if dtype == "float16":
+        return matrix.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unsupported index dtype: {dtype}")
+
+class DiskVectorIndex:
+    """
+    Memory-mapped, quantized vector index of one space.
+
+    Layout of the index folder:
+
+    - ``header.json``: dim, dtype, the number of committed rows and whether the
+      index holds every row of the space (``built``) or must be rebuilt.
+    - ``vectors.bin``: quantized unit-length vectors (float16 or int8), row major.
+    - ``scales.f32``: per-vector scale of the int8 codes.
+    - ``full.f32``: float32 vectors, only paged in to rescore the top candidates.
+    - ``ids.i64`` / ``numtokens.f32``: spaces_embeddings id and token count per row.
+    - ``rows.jsonl``: id, pageno, source and imagepath per row.
+
+    Rows are appended to every file before ``header.json`` is replaced, so readers
+    never see a row that is only partly written. A rebuild writes a new folder
+    and swaps the ``path`` symlink to it. Writers hold locked(path). Everything
+    is opened with np.memmap, so worker processes share the OS page cache
+    instead of each holding a copy.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "header.json")) as f:
+            self.header = json.load(f)
+        self.dim = self.header["dim"]
+        self.dtype = self.header["dtype"]
+        self.count = self.header["count"]
+        # Indexes written before the marker existed were only ever empty when reset
+        self.built = self.header.get("built", self.count > 0)
+        self.ids = self._map("ids.i64", np.int64, (self.count,))
+        self.numtokens = self._map("numtokens.f32", np.float32, (self.count,))
+        self.vectors = self._map("vectors.bin", self.dtype, (self.count, self.dim))
+        self.scales = self._map("scales.f32", np.float32, (self.count,)) if self.dtype == "int8" else None
+        self.full = self._map("full.f32", np.float32, (self.count, self.dim)) if self.header.get("full") else None
+        self.rows = []
+        with open(os.path.join(path, "rows.jsonl")) as f:
+            for line in f:
+                if len(self.rows) == self.count:
+                    break
+                self.rows.append(json.loads(line))
+        self.sources = np.array([row["source"] for row in self.rows], dtype=object)
+
+    def _map(self, name, dtype, shape):
+        if self.count == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=shape)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "header.json"))
+
+    @staticmethod
+    @contextmanager
+    def locked(path):
+        """Serializes the writers of the index at ``path``, across threads and processes."""
+        # Kept in a hidden folder, so the lock never shows up among the space's files
+        locks = os.path.join(os.path.dirname(path) or ".", LOCK_FOLDER)
+        os.makedirs(locks, exist_ok=True)
+        with open(os.path.join(locks, os.path.basename(path) + ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def build(path, dim, ids, vectors, numtokens, rows, dtype="int8", keep_full=True):
+        """
+        Writes a complete index into a new folder and publishes it at ``path``.
+
+        Readers keep the previous index until the symlink is swapped. An index
+        built from no rows is valid and searches as empty. Call with
+        locked(path) held.
+        """
+        parent = os.path.dirname(path) or "."
+        folder = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(path) + ".")
+        try:
+            for name in ("ids.i64", "numtokens.f32", "vectors.bin", "scales.f32", "full.f32", "rows.jsonl"):
+                open(os.path.join(folder, name), "wb").close()
+            header = {"version": INDEX_VERSION, "dim": dim, "dtype": dtype, "full": keep_full, "count": 0, "rows_bytes": 0, "built": True}
+            DiskVectorIndex._write(folder, header, ids, vectors, numtokens, rows)
+            link = folder + ".link"
+            os.symlink(os.path.basename(folder), link)
+            previous = os.path.realpath(path) if os.path.lexists(path) else None
+            if previous is not None and not os.path.islink(path):
+                # A folder written before indexes were published through a symlink
+                os.rename(path, folder + ".old")
+                previous = folder + ".old"
+            os.replace(link, path)
+        except BaseException:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        if previous is not None and previous != folder:
+            shutil.rmtree(previous, ignore_errors=True)
+
+    @staticmethod
+    def mark_stale(path):
+        """Flags the index at ``path`` for a rebuild. Call with locked(path) held."""
+        if not DiskVectorIndex.exists(path):
+            return
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+        header["built"] = False
+        DiskVectorIndex._commit(path, header)
+
+    @staticmethod
+    def append(path, ids, vectors, numtokens, rows):
+        """
+        Appends rows to the index at ``path``. Call with locked(path) held.
+
+        :param ids: spaces_embeddings ids.
+        :param vectors: (n, dim) embeddings, normalized here.
+        :param numtokens: Token count per row.
+        :param rows: Dicts with pageno, source and imagepath per row.
+        """
+        if len(ids) == 0:
+            return
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+        DiskVectorIndex._truncate(path, header)
+        DiskVectorIndex._write(path, header, ids, vectors, numtokens, rows)
+
+    @staticmethod
+    def _write(path, header, ids, vectors, numtokens, rows):
+        if len(ids):
+            matrix = normalize_rows(np.asarray(vectors, dtype=np.float32))
+            if matrix.shape[1] != header["dim"]:
+                raise ValueError(f"Index dimension is {header['dim']}, got {matrix.shape[1]}")
+            codes, scales = quantize(matrix, header["dtype"])
+            with open(os.path.join(path, "ids.i64"), "ab") as f:
+                f.write(np.asarray(ids, dtype=np.int64).tobytes())
+            with open(os.path.join(path, "numtokens.f32"), "ab") as f:
+                f.write(np.asarray(numtokens, dtype=np.float32).tobytes())
+            with open(os.path.join(path, "vectors.bin"), "ab") as f:
+                f.write(codes.tobytes())
+            if scales is not None:
+                with open(os.path.join(path, "scales.f32"), "ab") as f:
+                    f.write(scales.tobytes())
+            if header.get("full"):
+                with open(os.path.join(path, "full.f32"), "ab") as f:
+                    f.write(matrix.tobytes())
+            with open(os.path.join(path, "rows.jsonl"), "ab") as f:
+                for row_id, row in zip(ids, rows):
+                    f.write((json.dumps(dict(row, id=int(row_id))) + "\n").encode("utf-8"))
+                header["rows_bytes"] = f.tell()
+            header["count"] += len(ids)
+        DiskVectorIndex._commit(path, header)
+
+    @staticmethod
+    def _commit(path, header):
+        with open(os.path.join(path, "header.json.tmp"), "w") as f:
+            json.dump(header, f)
+        os.replace(os.path.join(path, "header.json.tmp"), os.path.join(path, "header.json"))
+
+    @staticmethod
+    def _truncate(path, header):
+        # Drops bytes left behind by an append that failed before committing the header
+        count, dim = header["count"], header["dim"]
+        code_size = 2 if header["dtype"] == "float16" else 1
+        sizes = {"ids.i64": count * 8, "numtokens.f32": count * 4, "vectors.bin": count * dim * code_size, "rows.jsonl": header["rows_bytes"]}
+        if header["dtype"] == "int8":
+            sizes["scales.f32"] = count * 4
+        if header.get("full"):
+            sizes["full.f32"] = count * dim * 4
+        for name, size in sizes.items():
+            with open(os.path.join(path, name), "r+b") as f:
+                f.truncate(size)
+
+    def search(self, query_embedding, k, filename=None, rescore_factor=4):
+        """
+        Returns the ids and scores of the best k rows.
+
+        Candidates are picked on the quantized vectors, then rescored with the
+        float32 vectors and the numtokens weighting used by the other retrieval modes.
+
+        :return: (ids, scores) sorted by descending score.
+        """
+        if self.count == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        positions = np.flatnonzero(self.sources == filename) if filename else np.arange(self.count)
+        if len(positions) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        approx = np.empty(len(positions), dtype=np.float32)
+        contiguous = filename is None
+        for start in range(0, len(positions), SCORE_CHUNK_ROWS):
+            chunk = positions[start:start + SCORE_CHUNK_ROWS]
+            rows = slice(chunk[0], chunk[-1] + 1) if contiguous else chunk
+            scores = self.vectors[rows].astype(np.float32) @ query
+            if self.scales is not None:
+                scores *= self.scales[rows]
+            approx[start:start + len(chunk)] = scores * (1 + 0.01 * self.numtokens[rows])
+
+        candidates = min(len(positions), max(k * rescore_factor, k))
+        if candidates < len(positions):
+            best = np.argpartition(-approx, candidates - 1)[:candidates]
+        else:
+            best = np.arange(len(positions))
+        rows = np.sort(positions[best])
+        if self.full is not None:
+            weighted = (np.asarray(self.full[rows]) @ query) * (1 + 0.01 * self.numtokens[rows])
+        else:
+            weighted = approx[np.searchsorted(positions, rows)]
+        order = np.argsort(-weighted, kind="stable")[:k]
+        return np.asarray(self.ids[rows[order]]), weighted[order]
+
+class DiskIndexCache:
+    """Keeps one open DiskVectorIndex per folder and reopens it when rows are appended."""
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        for attempt in range(2):
+            if not DiskVectorIndex.exists(path):
+                return None
+            # Resolved once, so a rebuild swapping the symlink cannot mix two folders
+            folder = os.path.realpath(path)
+            try:
+                # header.json is replaced on every append, so its inode identifies the version
+                stat = os.stat(os.path.join(folder, "header.json"))
+                version = (folder, stat.st_ino, stat.st_mtime_ns)
+                with self.lock:
+                    cached = self.indexes.get(path)
+                    if cached is not None and cached[0] == version:
+                        return cached[1]
+                index = DiskVectorIndex(folder)
+            except FileNotFoundError:
+                # The folder was replaced by a rebuild while opening it
+                if attempt:
+                    raise
+                continue
+            with self.lock:
+                self.indexes[path] = (version, index)
+            return index
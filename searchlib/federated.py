@@ -0,0 +1,54 @@
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import wait
+
+def federated_search(search, spaces, numrows, executor, budget_seconds=None):
+    """
+    Runs ``search(space)`` for every space concurrently and merges the results.
+
+    Each search must return its results best first, as tuples whose last item
+    is the score. Spaces that have not answered when the latency budget runs
+    out are dropped from the response. Searches that have not started are
+    cancelled; running ones cannot be, so ``search`` should stop itself at the
+    same budget (see DataKeeper.search_deadline) to free its thread, and
+    raise TimeoutError when it does, so the space is reported as timed out.
+
+    :param search: Callable taking a space name.
+    :param spaces: Space names to search.
+    :param numrows: Number of merged results to return.
+    :param executor: concurrent.futures executor the searches run on.
+    :param budget_seconds: Latency budget, None waits for every space.
+    :return: (results, report) where results are (space, result) pairs ranked
+             globally and report lists the searched, timed out and failed spaces.
+    """
+    started = time.monotonic()
+    futures = {executor.submit(search, space): space for space in spaces}
+    done, not_done = wait(futures, timeout=budget_seconds)
+    for future in not_done:
+        future.cancel()
+
+    report = {"searched": [], "timed_out": sorted(futures[f] for f in not_done), "failed": []}
+    ranked_lists = []
+    for future in done:
+        space = futures[future]
+        try:
+            results = future.result()
+        except TimeoutError:
+            # The search stopped itself at the budget just before wait() returned
+            report["timed_out"].append(space)
+            continue
+        except Exception as e:
+            logging.error(f"Search failed for space {space}: {e}")
+            report["failed"].append(space)
+            continue
+        report["searched"].append(space)
+        ranked_lists.append([(space, result) for result in results])
+    report["searched"].sort()
+    report["timed_out"].sort()
+    report["failed"].sort()
+    report["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+
+    merged = heapq.merge(*ranked_lists, key=lambda item: item[1][-1], reverse=True)
+    return list(itertools.islice(merged, numrows)), report
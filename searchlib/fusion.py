@@ -0,0 +1,16 @@
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses several rankings with reciprocal rank fusion.
+
+    Each key scores ``sum(1 / (k + rank))`` over the rankings it appears in,
+    with ranks starting at 1, so no score normalization across rankers is needed.
+
+    :param rankings: Lists of keys, best first.
+    :param k: Damping constant; 60 is the value from the original RRF paper.
+    :return: List of (key, score) sorted by descending score.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
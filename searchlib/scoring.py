@@ -0,0 +1,68 @@
+import numpy as np
+
+# pgvector's binary format (vector_send) is a big-endian int16 dimension,
+# an unused int16, then the float4 values, also big-endian.
+VECTOR_HEADER_BYTES = 4
+
+def decode_vectors(buffers):
+    """
+    Decodes pgvector binary values into one contiguous float32 matrix.
+
+    :param buffers: Sequence of bytes/memoryview values returned by vector_send(embedding).
+    :return: Array of shape (len(buffers), dim).
+    """
+    if not buffers:
+        return np.empty((0, 0), dtype=np.float32)
+    blob = b"".join(bytes(b) for b in buffers)
+    dim = int(np.frombuffer(blob, dtype=">i2", count=1)[0])
+    row_words = dim + VECTOR_HEADER_BYTES // 4
+    if len(blob) != len(buffers) * row_words * 4:
+        raise ValueError("Embeddings in the result set have different dimensions")
+    words = np.frombuffer(blob, dtype=">f4").reshape(len(buffers), row_words)
+    return np.ascontiguousarray(words[:, VECTOR_HEADER_BYTES // 4:], dtype=np.float32)
+
+def normalize_rows(matrix):
+    """Returns L2-normalized rows; zero vectors stay zero."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+def top_k(query_embedding, matrix, numtokens, k, normalized=False):
+    """
+    Scores every row against the query and returns the best k.
+
+    Rows are scored by cosine similarity weighted by ``1 + 0.01 * numtokens``,
+    the same formula used by the original per-row loop. Zero vectors are skipped.
+
+    :param query_embedding: Query vector.
+    :param matrix: (n, dim) float32 matrix of row embeddings.
+    :param numtokens: Length-n sequence of token counts.
+    :param k: Number of rows to return.
+    :param normalized: Set when the rows of ``matrix`` are already unit length.
+    :return: (indices, scores) sorted by descending score.
+    """
+    if len(matrix) == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query_norm = np.linalg.norm(query)
+    if query_norm > 0:
+        query = query / query_norm
+    if normalized:
+        similarities = matrix @ query
+        valid = np.any(matrix, axis=1)
+    else:
+        norms = np.linalg.norm(matrix, axis=1)
+        valid = norms > 0
+        similarities = (matrix @ query) / np.where(valid, norms, 1)
+    scores = similarities * (1 + 0.01 * np.asarray(numtokens, dtype=np.float32))
+    scores = np.where(valid, scores, -np.inf)
+
+    k = min(k, int(valid.sum()))
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    order = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+    return order, scores[order]
@@ -1,22 +1,42 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 import json
 import logging
+import threading
+import time
 import numpy as np
 from dotenv import load_dotenv
 import os
 load_dotenv()
-from embedlib.embeddings import get_embeddings
+from embedlib.backends import get_backend
+from embedlib.client import EmbeddingError
+from embedlib.store import EmbeddingStore, content_hash, normalize_text
+from searchlib.scoring import decode_vectors, top_k
+from searchlib.cache import SpaceMatrix, SpaceMatrixCache
+from searchlib.diskindex import DiskIndexCache, DiskVectorIndex, index_path
+from searchlib.fusion import reciprocal_rank_fusion
 import datetime
+
+# Upper bound pgvector accepts for hnsw.ef_search
+HNSW_MAX_EF_SEARCH = 1000
+
+def to_vector_literal(embedding):
+    """Formats an embedding as a pgvector text literal, e.g. '[0.1,0.2]'."""
+    return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
 class DataKeeper:
     def __init__(self):
-        self.connection = psycopg2.connect(
+        self.dsn = dict(
             dbname=os.environ["DBNAME"],
             user=os.environ["DBUSER"],
             password=os.environ["DBUSERPASSWORD"],
             host=os.environ["HOST"],
             port=os.environ["PORT"]
         )
+        self.connection = psycopg2.connect(**self.dsn)
         self.config ={}
         self.config["dbschema"] =os.environ["SCHEMA"]
         self.config["spaces_table"] =os.environ["SPACES_TABLE"]
@@ -24,6 +44,46 @@ class DataKeeper:
         self.config["files_table"] =os.environ["FILES_TABLE"]
         self.config["conversations_table"] =os.environ["CONVERSATIONS_TABLE"]
         self.connection.autocommit = os.environ["AUTOCOMMIT"]
+        # Retrieval: "exact" scores every row of the space in Python,
+        # "ann" pushes the search into the pgvector index (see upgradeto2.1.py),
+        # "disk" searches the memory-mapped index kept in each space folder,
+        # "hybrid" fuses full-text and ANN results (see upgradeto2.2.py)
+        self.config["retrieval_mode"] = os.environ.get("RETRIEVAL_MODE", "exact")
+        self.config["ann_index_method"] = os.environ.get("ANN_INDEX_METHOD", "hnsw")
+        self.config["ann_candidates"] = int(os.environ.get("ANN_CANDIDATES", "100"))
+        self.config["ann_ef_search"] = os.environ.get("ANN_EF_SEARCH")
+        self.config["ann_probes"] = os.environ.get("ANN_PROBES")
+        # pgvector 0.8+ keeps scanning the index until enough rows pass the space/file filters;
+        # "relaxed_order", "strict_order" or "off"
+        self.config["ann_iterative_scan"] = os.environ.get("ANN_ITERATIVE_SCAN", "relaxed_order")
+        self._pgvector_version = None
+        # "halfvec" or "binary" selects candidates on the compact columns (see upgradeto2.6.py)
+        # and reranks ann_compact_rescore times as many on the full-precision embedding
+        self.config["ann_compact"] = os.environ.get("ANN_COMPACT", "none")
+        self.config["ann_compact_rescore"] = int(os.environ.get("ANN_COMPACT_RESCORE", "4"))
+        # In-process cache of normalized per-space matrices for the exact search, 0 disables it
+        self.config["embedding_cache_mb"] = float(os.environ.get("EMBEDDING_CACHE_MB", "256"))
+        self.matrix_cache = SpaceMatrixCache(int(self.config["embedding_cache_mb"] * 1024 * 1024))
+        self.config["spaces_root"] = os.environ.get("SPACES_ROOT", "spaces")
+        self.config["disk_index_dtype"] = os.environ.get("DISK_INDEX_DTYPE", "int8")
+        self.config["disk_index_rescore"] = int(os.environ.get("DISK_INDEX_RESCORE", "4"))
+        self.disk_indexes = DiskIndexCache()
+        self.config["fts_config"] = os.environ.get("FTS_CONFIG", "english")
+        self.config["hybrid_candidates"] = int(os.environ.get("HYBRID_CANDIDATES", "50"))
+        self.config["rrf_k"] = int(os.environ.get("RRF_K", "60"))
+        # Minimum cosine similarity for /chat to reuse an earlier answer, 0 disables it
+        self.config["answer_cache_threshold"] = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+        # Retrieval reads use their own pooled connections so searches can run concurrently
+        self.config["search_pool_size"] = int(os.environ.get("SEARCH_POOL_SIZE", "4"))
+        self._search_pool = None
+        self._search_pool_lock = threading.Lock()
+        self._search_slots = threading.BoundedSemaphore(self.config["search_pool_size"])
+        self._search_executor = ThreadPoolExecutor(max_workers=self.config["search_pool_size"])
+        self._search_deadline = threading.local()
+        # Rows per INSERT statement of the bulk writers
+        self.config["bulk_page_size"] = int(os.environ.get("BULK_PAGE_SIZE", "500"))
+        # Embeddings already computed for the same normalized text are reused, see upgradeto2.5.py
+        self.embedding_store = EmbeddingStore(get_backend())
     
     def create_space(self, name):
         try:
@@ -109,12 +169,18 @@ class DataKeeper:
             self.connection.rollback()
             print(f"Error creating file: {e}")
             return None
-    def get_file_by_name(self, filename):
+    def get_file_by_name(self, filename, space_id=None):
         try:
             with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute("""
-                    SELECT * FROM org.spaces_files WHERE (name) = %s;
-                """, (filename,))
+                if space_id is not None:
+                    cursor.execute("""
+                        SELECT * FROM org.spaces_files WHERE (name) = %s AND space_id = %s
+                        ORDER BY id DESC;
+                    """, (filename, space_id))
+                else:
+                    cursor.execute("""
+                        SELECT * FROM org.spaces_files WHERE (name) = %s;
+                    """, (filename,))
                 return cursor.fetchone()
         except psycopg2.Error as e:
             print(f"Error fetching file: {e}")
@@ -130,7 +196,7 @@ class DataKeeper:
             print(f"Error fetching file: {e}")
             return None
 
-    def update_file(self, file_id, name=None, file_size_mb=None):
+    def update_file(self, file_id, name=None, file_size_mb=None, content_hash=None):
         try:
             with self.connection.cursor() as cursor:
                 updates = []
@@ -142,6 +208,9 @@ class DataKeeper:
                 if file_size_mb is not None:
                     updates.append("file_size_mb = %s")
                     params.append(file_size_mb)
+                if content_hash is not None:
+                    updates.append("content_hash = %s")
+                    params.append(content_hash)
 
                 if updates:
                     params.append(file_id)
@@ -165,19 +234,24 @@ class DataKeeper:
             self.connection.rollback()
             print(f"Error deleting file: {e}")
 
-    def create_conversation(self, sender, text, space_id, file_id, related_message_id, user_ip, embedding):
+    def create_conversation(self, sender, text, space_id, file_id, related_message_id, user_ip, embedding, citations=None, index_version=None):
+        if embedding is None:
+            print("Error creating conversation: missing embedding")
+            return None
+        citations = Json(citations) if citations is not None else None
         try:
             with self.connection.cursor() as cursor:
+                # index_version defaults to the space's current version, see find_cached_answer
                 if file_id :
                     cursor.execute("""
-                        INSERT INTO org.spaces_conversations (sender, text, timestamp, space_id, file_id, related_message_id, user_ip, embedding)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;
-                    """, (sender, text, datetime.datetime.today(), space_id, file_id, related_message_id, user_ip, embedding))
+                        INSERT INTO org.spaces_conversations (sender, text, timestamp, space_id, file_id, related_message_id, user_ip, embedding, citations, index_version)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, (SELECT index_version FROM org.spaces WHERE id = %s))) RETURNING id;
+                    """, (sender, text, datetime.datetime.today(), space_id, file_id, related_message_id, user_ip, embedding, citations, index_version, space_id))
                 else:
                     cursor.execute("""
-                        INSERT INTO org.spaces_conversations (sender, text, timestamp, space_id, related_message_id, user_ip, embedding)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;
-                    """, (sender, text, datetime.datetime.today(), space_id, related_message_id, user_ip, embedding))
+                        INSERT INTO org.spaces_conversations (sender, text, timestamp, space_id, related_message_id, user_ip, embedding, citations, index_version)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, (SELECT index_version FROM org.spaces WHERE id = %s))) RETURNING id;
+                    """, (sender, text, datetime.datetime.today(), space_id, related_message_id, user_ip, embedding, citations, index_version, space_id))
                 self.connection.commit()
                 return cursor.fetchone()[0]
         except psycopg2.Error as e:
@@ -185,6 +259,246 @@ class DataKeeper:
             print(f"Error creating conversation: {e}")
             return None
 
+    def find_cached_answer(self, space_id, file_id, embedding):
+        """
+        Looks for an earlier answer to a near-identical question.
+
+        Only questions asked in the same space and file against the space's
+        current index version qualify, so re-indexing a space invalidates them.
+
+        :return: Dict with the AI answer's text, citations and similarity, or None.
+        """
+        threshold = self.config["answer_cache_threshold"]
+        if not threshold or embedding is None:
+            return None
+        vector = to_vector_literal(embedding)
+        # The index scan runs before the space, file and version filters, so it
+        # over-fetches and the best question that passes them is kept
+        candidates = self._candidate_limit(max(int(self.config["ann_candidates"]), 1))
+        try:
+            with self.ann_cursor(candidates, cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(f"""
+                    SELECT a.text, a.citations, 1 - (q.embedding <=> %s::vector) AS similarity
+                    FROM (
+                        SELECT q.id, q.embedding
+                        FROM org.spaces_conversations q
+                        JOIN org.spaces s ON s.id = q.space_id
+                        WHERE q.sender = 'user' AND q.space_id = %s
+                        AND q.file_id IS NOT DISTINCT FROM %s
+                        AND q.index_version = s.index_version
+                        AND EXISTS (SELECT 1 FROM org.spaces_conversations a WHERE a.related_message_id = q.id AND a.sender = 'ai')
+                        ORDER BY {self._vector_order("q.")}
+                        LIMIT %s
+                    ) AS q
+                    JOIN org.spaces_conversations a ON a.related_message_id = q.id AND a.sender = 'ai'
+                    ORDER BY similarity DESC
+                    LIMIT 1;
+                """, (vector, space_id, file_id, vector, candidates))
+                row = cursor.fetchone()
+        except psycopg2.Error as e:
+            print(f"Error looking up cached answer: {e}")
+            return None
+        if row is None or row["similarity"] is None or row["similarity"] < threshold:
+            return None
+        return row
+
+    def bump_index_version(self, space_id):
+        """Marks the contents of a space as changed, invalidating cached answers."""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE org.spaces SET index_version = index_version + 1
+                    WHERE id = %s RETURNING index_version;
+                """, (space_id,))
+                self.connection.commit()
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            print(f"Error updating index version: {e}")
+            return None
+
+    # Background jobs, see upgradeto2.7.py. They use pooled autocommit
+    # connections because workers update them from their own threads.
+    def create_job(self, kind, payload, max_attempts=3):
+        try:
+            with self.search_connection() as connection, connection.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    INSERT INTO org.jobs (kind, payload, max_attempts)
+                    VALUES (%s, %s, %s) RETURNING *;
+                """, (kind, Json(payload), max_attempts))
+                return cursor.fetchone()
+        except psycopg2.Error as e:
+            print(f"Error creating job: {e}")
+            return None
+
+    def get_job(self, job_id):
+        try:
+            with self.search_connection() as connection, connection.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("SELECT * FROM org.jobs WHERE id = %s;", (job_id,))
+                return cursor.fetchone()
+        except psycopg2.Error as e:
+            print(f"Error fetching job: {e}")
+            return None
+
+    def list_jobs(self, status=None, limit=50):
+        try:
+            with self.search_connection() as connection, connection.cursor(cursor_factory=RealDictCursor) as cursor:
+                if status:
+                    cursor.execute("SELECT * FROM org.jobs WHERE status = %s ORDER BY id DESC LIMIT %s;", (status, limit))
+                else:
+                    cursor.execute("SELECT * FROM org.jobs ORDER BY id DESC LIMIT %s;", (limit,))
+                return cursor.fetchall()
+        except psycopg2.Error as e:
+            print(f"Error listing jobs: {e}")
+            return []
+
+    def claim_job(self, worker, kinds):
+        """
+        Takes the oldest runnable job of the given kinds and marks it running.
+
+        SKIP LOCKED lets several workers, in this process or others, poll the
+        queue without claiming the same job.
+
+        :return: The claimed job, or None when the queue is empty.
+        """
+        try:
+            with self.search_connection() as connection, connection.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    UPDATE org.jobs
+                    SET status = 'running', attempts = attempts + 1, worker = %s,
+                        started = now(), heartbeat = now()
+                    WHERE id = (
+                        SELECT id FROM org.jobs
+                        WHERE status = 'queued' AND run_after <= now() AND kind = ANY(%s)
+                        ORDER BY run_after, id
+                        FOR UPDATE SKIP LOCKED
+                        LIMIT 1
+                    )
+                    RETURNING *;
+                """, (worker, list(kinds)))
+                return cursor.fetchone()
+        except psycopg2.Error as e:
+            print(f"Error claiming job: {e}")
+            return None
+
+    def update_job_progress(self, job_id, pages_done=None, pages_total=None, errors=None):
+        """
+        Records progress and refreshes the job's heartbeat.
+
+        :return: True when cancellation of the job was requested.
+        """
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE org.jobs
+                    SET pages_done = COALESCE(%s, pages_done), pages_total = COALESCE(%s, pages_total),
+                        errors = COALESCE(%s, errors), heartbeat = now()
+                    WHERE id = %s RETURNING cancel_requested;
+                """, (pages_done, pages_total, Json(errors) if errors is not None else None, job_id))
+                row = cursor.fetchone()
+                return bool(row and row[0])
+        except psycopg2.Error as e:
+            print(f"Error updating job: {e}")
+            return False
+
+    def finish_job(self, job_id, status, result=None, error=None, retry_delay=None):
+        """
+        Ends a job run as succeeded, failed or cancelled.
+
+        A failed run with attempts left goes back to the queue after
+        ``retry_delay`` seconds instead of failing the job, unless the job was
+        asked to cancel, which then ends as cancelled. ``error`` is kept
+        in last_error; ``errors`` holds the page errors reported as progress.
+        """
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                if status == "failed" and retry_delay is not None:
+                    cursor.execute("""
+                        UPDATE org.jobs
+                        SET status = CASE WHEN cancel_requested THEN 'cancelled'
+                                          WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                            run_after = now() + make_interval(secs => %s),
+                            finished = CASE WHEN attempts < max_attempts AND NOT cancel_requested THEN NULL ELSE now() END,
+                            last_error = %s, worker = NULL
+                        WHERE id = %s;
+                    """, (retry_delay, error, job_id))
+                else:
+                    cursor.execute("""
+                        UPDATE org.jobs
+                        SET status = %s, result = %s, finished = now(), worker = NULL,
+                            last_error = COALESCE(%s, last_error)
+                        WHERE id = %s;
+                    """, (status, Json(result) if result is not None else None, error, job_id))
+        except psycopg2.Error as e:
+            print(f"Error finishing job: {e}")
+
+    def cancel_job(self, job_id):
+        """
+        Cancels a queued job at once, and asks the worker of a running job to stop.
+
+        :return: The job's status after the request, or None if it does not exist.
+        """
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE org.jobs
+                    SET cancel_requested = status IN ('queued', 'running'),
+                        status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                        finished = CASE WHEN status = 'queued' THEN now() ELSE finished END
+                    WHERE id = %s RETURNING status;
+                """, (job_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except psycopg2.Error as e:
+            print(f"Error cancelling job: {e}")
+            return None
+
+    def retry_job(self, job_id):
+        """
+        Puts a failed or cancelled job back in the queue with a fresh set of attempts.
+
+        :return: The job's status after the request, or None if it does not exist.
+        """
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE org.jobs
+                    SET status = CASE WHEN status IN ('failed', 'cancelled') THEN 'queued' ELSE status END,
+                        attempts = CASE WHEN status IN ('failed', 'cancelled') THEN 0 ELSE attempts END,
+                        cancel_requested = CASE WHEN status IN ('failed', 'cancelled') THEN false ELSE cancel_requested END,
+                        run_after = now(), finished = NULL
+                    WHERE id = %s RETURNING status;
+                """, (job_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except psycopg2.Error as e:
+            print(f"Error retrying job: {e}")
+            return None
+
+    def requeue_stale_jobs(self, stale_seconds):
+        """
+        Returns running jobs whose worker stopped sending heartbeats to the queue.
+
+        This is how jobs survive a server restart: whatever was running when
+        the process died is picked up again by the next worker.
+
+        :return: Number of requeued jobs.
+        """
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE org.jobs
+                    SET status = CASE WHEN cancel_requested THEN 'cancelled' ELSE 'queued' END,
+                        finished = CASE WHEN cancel_requested THEN now() ELSE NULL END,
+                        worker = NULL, run_after = now()
+                    WHERE status = 'running' AND heartbeat < now() - make_interval(secs => %s);
+                """, (stale_seconds,))
+                return cursor.rowcount
+        except psycopg2.Error as e:
+            print(f"Error requeueing jobs: {e}")
+            return 0
+
     def get_conversation(self, conversation_id):
         try:
             with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
@@ -228,19 +542,154 @@ class DataKeeper:
             self.connection.rollback()
             print(f"Error deleting conversation: {e}")
 
-    def create_embedding(self, pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id):
+    def create_embedding(self, pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, space_id=None, content_hash=None):
+        if embedding is None:
+            print("Error creating embedding: missing embedding")
+            return None
         try:
             with self.connection.cursor() as cursor:
+                # space_id defaults to the space of the file so retrieval can filter on the indexed ids
                 cursor.execute("""
-                    INSERT INTO org.spaces_embeddings (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, created)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;
-                """, (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, datetime.datetime.today()))
+                    INSERT INTO org.spaces_embeddings (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, space_id, content_hash, created)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, (SELECT space_id FROM org.spaces_files WHERE id = %s)), %s, %s) RETURNING id;
+                """, (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, space_id, file_id, content_hash, datetime.datetime.today()))
                 self.connection.commit()
-                return cursor.fetchone()[0]
+                embedding_id = cursor.fetchone()[0]
         except psycopg2.Error as e:
             self.connection.rollback()
             print(f"Error creating embedding: {e}")
             return None
+        metadata = json.loads(metadata) if isinstance(metadata, str) else metadata
+        if metadata:
+            self.matrix_cache.add_row(metadata.get("space"), embedding_id, embedding, numtokens or 0, (pageno, context, metadata, source, imagepath))
+        return embedding_id
+
+    def get_page_hashes(self, file_id):
+        """:return: Dict of page number to the hash of the page when it was indexed, see upgradeto2.8.py."""
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                cursor.execute("SELECT pageno, page_hash FROM org.spaces_pages WHERE file_id = %s;", (file_id,))
+                return dict(cursor.fetchall())
+        except psycopg2.Error as e:
+            print(f"Error fetching page hashes: {e}")
+            return {}
+
+    def replace_pages(self, file_id, space_id, pages):
+        """
+        Replaces the embedding rows of some pages of a file and records their hashes.
+
+        Each call is one transaction, so a page is either fully re-indexed or
+        left as it was; a run that stops halfway resumes after the last
+        committed page.
+
+        :param pages: List of (pageno, page_hash, rows). ``rows`` are dicts with the
+                      arguments of create_embedding; a page_hash of None forgets the page.
+                      All the rows are written with a handful of bulk statements.
+        :return: (ids of the inserted rows in order, ids of the removed rows), or None on error.
+        """
+        rows = [row for _, _, page_rows in pages for row in page_rows]
+        try:
+            with self.transaction() as connection, connection.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM org.spaces_embeddings WHERE file_id = %s AND pageno = ANY(%s) RETURNING id;
+                """, (file_id, [pageno for pageno, _, _ in pages]))
+                removed = [row[0] for row in cursor.fetchall()]
+                inserted = self._insert_embeddings(cursor, [dict(row, file_id=file_id, space_id=space_id) for row in rows])
+                cursor.execute("""
+                    DELETE FROM org.spaces_pages WHERE file_id = %s AND pageno = ANY(%s);
+                """, (file_id, [pageno for pageno, page_hash, _ in pages if page_hash is None]))
+                recorded = [(file_id, pageno, page_hash) for pageno, page_hash, _ in pages if page_hash is not None]
+                if recorded:
+                    execute_values(cursor, """
+                        INSERT INTO org.spaces_pages (file_id, pageno, page_hash) VALUES %s
+                        ON CONFLICT (file_id, pageno) DO UPDATE SET page_hash = EXCLUDED.page_hash, indexed = now();
+                    """, recorded)
+        except psycopg2.Error as e:
+            print(f"Error replacing pages: {e}")
+            return None
+        self.matrix_cache.remove_rows(removed)
+        self._cache_embeddings(inserted, rows)
+        return inserted, removed
+
+    def _insert_embeddings(self, cursor, rows):
+        """Inserts embedding rows, BULK_PAGE_SIZE per statement, and returns their ids in order."""
+        if not rows:
+            return []
+        created = datetime.datetime.today()
+        # space_id defaults to the space of the file, as in create_embedding
+        ids = execute_values(cursor, """
+            INSERT INTO org.spaces_embeddings (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, space_id, content_hash, created)
+            VALUES %s RETURNING id;
+        """, [(row["pageno"], row["metadata"], row["context"], row["embedding"], row["numtokens"], row["cost"], row["tabletext"], row["source"],
+               row["imagepath"], row["file_id"], row.get("space_id"), row["file_id"], row.get("content_hash"), created) for row in rows],
+            template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, (SELECT space_id FROM org.spaces_files WHERE id = %s)), %s, %s)",
+            page_size=self.config["bulk_page_size"], fetch=True)
+        return [row[0] for row in ids]
+
+    def _cache_embeddings(self, ids, rows):
+        """Adds inserted rows to the cached matrices, one snapshot per space."""
+        by_space = {}
+        for embedding_id, row in zip(ids, rows):
+            metadata = json.loads(row["metadata"]) if isinstance(row["metadata"], str) else row["metadata"]
+            if metadata:
+                by_space.setdefault(metadata.get("space"), []).append((embedding_id, row, metadata))
+        for space, space_rows in by_space.items():
+            self.matrix_cache.add_rows(
+                space,
+                [embedding_id for embedding_id, _, _ in space_rows],
+                [row["embedding"] for _, row, _ in space_rows],
+                [row["numtokens"] or 0 for _, row, _ in space_rows],
+                [(row["pageno"], row["context"], metadata, row["source"], row["imagepath"]) for _, row, metadata in space_rows],
+            )
+
+    def create_embeddings_bulk(self, rows):
+        """
+        Inserts many embedding rows in one transaction.
+
+        :param rows: Dicts with the arguments of create_embedding.
+        :return: Ids of the rows in order, or None when nothing was inserted.
+        """
+        if any(row["embedding"] is None for row in rows):
+            print("Error creating embeddings: missing embedding")
+            return None
+        try:
+            with self.transaction() as connection, connection.cursor() as cursor:
+                ids = self._insert_embeddings(cursor, rows)
+        except psycopg2.Error as e:
+            print(f"Error creating embeddings: {e}")
+            return None
+        self._cache_embeddings(ids, rows)
+        return ids
+
+    def create_conversations_bulk(self, rows):
+        """
+        Inserts many conversation messages in one transaction.
+
+        :param rows: Dicts with the arguments of create_conversation; file_id,
+                     related_message_id, citations and index_version are optional.
+        :return: Ids of the messages in order, or None when nothing was inserted.
+        """
+        if any(row["embedding"] is None for row in rows):
+            print("Error creating conversations: missing embedding")
+            return None
+        if not rows:
+            return []
+        timestamp = datetime.datetime.today()
+        try:
+            with self.transaction() as connection, connection.cursor() as cursor:
+                # index_version defaults to the space's current version, as in create_conversation
+                ids = execute_values(cursor, """
+                    INSERT INTO org.spaces_conversations (sender, text, timestamp, space_id, file_id, related_message_id, user_ip, embedding, citations, index_version)
+                    VALUES %s RETURNING id;
+                """, [(row["sender"], row["text"], row.get("timestamp", timestamp), row["space_id"], row.get("file_id"), row.get("related_message_id"),
+                       row["user_ip"], row["embedding"], Json(row["citations"]) if row.get("citations") is not None else None,
+                       row.get("index_version"), row["space_id"]) for row in rows],
+                    template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, (SELECT index_version FROM org.spaces WHERE id = %s)))",
+                    page_size=self.config["bulk_page_size"], fetch=True)
+                return [row[0] for row in ids]
+        except psycopg2.Error as e:
+            print(f"Error creating conversations: {e}")
+            return None
 
     def get_embedding(self, embedding_id):
         try:
@@ -273,6 +722,7 @@ class DataKeeper:
                         WHERE id = %s;
                     """, params)
                     self.connection.commit()
+                    self.matrix_cache.update_row(embedding_id, context=context, embedding=embedding)
         except psycopg2.Error as e:
             self.connection.rollback()
             print(f"Error updating embedding: {e}")
@@ -284,10 +734,46 @@ class DataKeeper:
                     DELETE FROM org.spaces_embeddings WHERE id = %s;
                 """, (embedding_id,))
                 self.connection.commit()
+                self.matrix_cache.remove_row(embedding_id)
         except psycopg2.Error as e:
             self.connection.rollback()
             print(f"Error deleting embedding: {e}")
 
+    def embed_texts(self, texts):
+        """
+        Embeds texts through the content-addressed embedding store.
+
+        Store reads and writes use pooled autocommit connections, so ingestion
+        threads can embed concurrently without sharing self.connection.
+
+        :return: (matrix, hashes) as returned by EmbeddingStore.embed.
+        """
+        try:
+            return self.embedding_store.embed(self.search_connection, texts)
+        except psycopg2.Error as e:
+            print(f"Error using embedding store, embedding directly: {e}")
+            backend = self.embedding_store.backend
+            return backend.embed([normalize_text(text) for text in texts]), [content_hash(backend.model, text) for text in texts]
+
+    def get_vector_dimension(self, table="spaces_embeddings", column="embedding"):
+        """
+        Reads n of a VECTOR(n) column from the catalog.
+
+        :return: The declared dimension, or None if the column has none.
+        """
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT atttypmod FROM pg_attribute
+                    WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped;
+                """, (f"org.{table}", column))
+                row = cursor.fetchone()
+                return row[0] if row and row[0] > 0 else None
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            print(f"Error fetching vector dimension: {e}")
+            return None
+
     def close(self):
         self.connection.close()
 
@@ -318,7 +804,10 @@ class DataKeeper:
                 file_id = None
 
             text_content = message['text']
-            embedding = get_embeddings(text_content)
+            embedding = self.embed_texts([text_content])[0][0]
+            if np.isnan(embedding).any():
+                raise EmbeddingError("Could not embed conversation text")
+            embedding = embedding.tolist()
 
             cursor.execute(f"""
                 INSERT INTO {self.config.dbschema}.{self.config.conversations_table} (sender, text, timestamp, space_id, file_id, user_ip, embedding)
@@ -335,6 +824,7 @@ class DataKeeper:
                 VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;
             """, (source, pageno, imagesource, ocrtext, embedding, cost, json.dumps(metadata)))
             self.connection.commit()
+            self.matrix_cache.invalidate(metadata.get("space"))
             return cursor.fetchone()[0]
     def insert_data(self, table, data):
         """
@@ -374,66 +864,446 @@ class DataKeeper:
         """Closes the database connection."""
         self.connection.close()
     
-    def get_top_chunks(self, query_embedding, schema, table, space, filename=None, numrows=5):
+    @contextmanager
+    def transaction(self):
+        """Borrows a pooled connection and runs the block in one transaction."""
+        with self.search_connection() as connection:
+            connection.autocommit = False
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.autocommit = True
+
+    @contextmanager
+    def search_deadline(self, deadline):
+        """
+        Bounds the searches of this thread by ``deadline``, a time.monotonic() value.
+
+        Connections borrowed meanwhile run with a statement_timeout of the time
+        left, so a search past its budget releases its thread and connection.
+        """
+        previous = getattr(self._search_deadline, "value", None)
+        self._search_deadline.value = deadline
         try:
-            with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                print(filename)
+            yield
+        finally:
+            self._search_deadline.value = previous
+
+    def _raise_if_deadline(self, error):
+        """Lets a search cancelled by search_deadline reach the caller, which reports it as timed out."""
+        if isinstance(error, psycopg2.extensions.QueryCanceledError) and getattr(self._search_deadline, "value", None) is not None:
+            raise error
+
+    @contextmanager
+    def search_connection(self):
+        """Borrows an autocommit connection from the search pool."""
+        with self._search_pool_lock:
+            if self._search_pool is None:
+                self._search_pool = ThreadedConnectionPool(1, self.config["search_pool_size"], **self.dsn)
+        deadline = getattr(self._search_deadline, "value", None)
+        # ThreadedConnectionPool raises when exhausted, callers wait for a free slot instead
+        if deadline is None:
+            self._search_slots.acquire()
+        elif not self._search_slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise psycopg2.extensions.QueryCanceledError("Search deadline exceeded")
+        try:
+            connection = self._search_pool.getconn()
+            broken = False
+            try:
+                connection.autocommit = True
+                if deadline is not None:
+                    remaining_ms = int((deadline - time.monotonic()) * 1000)
+                    if remaining_ms <= 0:
+                        raise psycopg2.extensions.QueryCanceledError("Search deadline exceeded")
+                    with connection.cursor() as cursor:
+                        cursor.execute("SET statement_timeout = %s;", (remaining_ms,))
+                yield connection
+            except psycopg2.OperationalError as e:
+                # A statement cancelled by its timeout leaves the connection usable
+                broken = not isinstance(e, psycopg2.extensions.QueryCanceledError)
+                raise
+            finally:
+                if deadline is not None and not broken:
+                    try:
+                        with connection.cursor() as cursor:
+                            cursor.execute("RESET statement_timeout;")
+                    except psycopg2.Error:
+                        broken = True
+                self._search_pool.putconn(connection, close=broken)
+        finally:
+            self._search_slots.release()
+
+    def get_top_chunks(self, query_embedding, schema, table, space, filename=None, numrows=5, query_text=None):
+        if self.config["retrieval_mode"] == "hybrid" and query_text:
+            return self.get_top_chunks_hybrid(query_embedding, query_text, schema, table, space, filename=filename, numrows=numrows)
+        if self.config["retrieval_mode"] in ("ann", "hybrid"):
+            return self.get_top_chunks_ann(query_embedding, schema, table, space, filename=filename, numrows=numrows)
+        if self.config["retrieval_mode"] == "disk":
+            return self.get_top_chunks_disk(query_embedding, schema, table, space, filename=filename, numrows=numrows)
+        if self.matrix_cache.enabled:
+            entry = self.matrix_cache.get(space)
+            if entry is None:
+                # Taken before loading, so a snapshot that misses a concurrent write is not cached
+                token = self.matrix_cache.token(space)
+                entry = self.load_space_matrix(schema, table, space)
+                if entry is None:
+                    return []
+                self.matrix_cache.put(space, entry, token=token)
+        else:
+            entry = self.load_space_matrix(schema, table, space, filename=filename)
+            if entry is None:
+                return []
+            filename = None
+
+        positions = entry.select(filename)
+        if positions is None:
+            indices, scores = top_k(query_embedding, entry.matrix, entry.numtokens, numrows, normalized=True)
+        else:
+            indices, scores = top_k(query_embedding, entry.matrix[positions], entry.numtokens[positions], numrows, normalized=True)
+            indices = positions[indices]
+        return [entry.rows[i] + (float(score),) for i, score in zip(indices, scores)]
+
+    def load_space_matrix(self, schema, table, space, filename=None):
+        """
+        Loads the embeddings of a space (optionally one file) as a SpaceMatrix.
+
+        :return: SpaceMatrix, or None if the query failed.
+        """
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                # vector_send returns pgvector's binary form, which decodes without any text parsing
                 if filename:
                     cursor.execute(f"""
-                        SELECT pageno, context, metadata, source, imagepath, embedding, COALESCE(numtokens, 0)
-                        FROM {schema}.{table} where metadata->>'space' = %s
-                        and source = %s
+                        SELECT id, pageno, context, metadata, source, imagepath, vector_send(embedding), COALESCE(numtokens, 0)
+                        FROM {schema}.{table} where space_id = (SELECT id FROM org.spaces WHERE name = %s)
+                        and file_id IN (SELECT id FROM org.spaces_files WHERE name = %s) and embedding IS NOT NULL
                     """, (space, filename))
                 else:
                     cursor.execute(f"""
-                        SELECT pageno, context, metadata, source, imagepath, embedding, COALESCE(numtokens, 0)
-                        FROM {schema}.{table} where metadata->>'space' = %s
+                        SELECT id, pageno, context, metadata, source, imagepath, vector_send(embedding), COALESCE(numtokens, 0)
+                        FROM {schema}.{table} where space_id = (SELECT id FROM org.spaces WHERE name = %s)
+                        and embedding IS NOT NULL
                     """, (space,))
                 rows = cursor.fetchall()
-                print("rows", len(rows))
-                # Compute similarities and store results
-            results = []
-            wrong_embeddings = []
-            # iterate in rows and find the similarity by averaging
-            for row in rows:
-                pageno, context, metadata, source, imagepath, embedding_str, numtokens = row
-                try:
-                    if isinstance(embedding_str, str):
-                        embedding = json.loads(embedding_str)
-                    elif isinstance(embedding_str, (bytes, bytearray)):
-                        embedding = json.loads(embedding_str.decode('utf-8'))
-                    elif isinstance(embedding_str, list):
-                        embedding = np.array(embedding_str)
-                    else:
-                        embedding = embedding_str
-
-                    # Safe normalization
-                    norm = np.linalg.norm(embedding)
-                    if norm == 0:
-                        logging.warning(f"Skipping normalization for zero vector: {embedding}")
-                        continue
-
-                    embedding = embedding / norm
-                    similarity = np.dot(query_embedding, embedding)
-
-                    # Ensure numtokens is a valid number
-                    numtokens = numtokens if numtokens is not None else 0
-
-                    # Optionally, weight similarity by the number of tokens or other criteria
-                    weighted_similarity = similarity * (1 + 0.01 * numtokens)
-
-                    results.append((pageno, context, metadata, source, imagepath, weighted_similarity))
-                except json.JSONDecodeError as e:
-                    logging.error(f"JSON decode error for row: {e}")
-                except Exception as e:
-                    logging.error(f"Error processing row : {e}")
-            #sort and return the results
-            results.sort(key=lambda x: x[-1], reverse=True)
-            top_docs = results
-            return top_docs
+        except psycopg2.Error as e:
+            self._raise_if_deadline(e)
+            print(f"Error fetching embeddings: {e}")
+            return None
+
+        return SpaceMatrix.from_raw(
+            ids=[row[0] for row in rows],
+            matrix=decode_vectors([row[6] for row in rows]),
+            numtokens=[row[7] for row in rows],
+            rows=[row[1:6] for row in rows],
+        )
+
+    @contextmanager
+    def ann_cursor(self, candidates, cursor_factory=None):
+        """
+        Borrows a search connection for one index-ordered query.
+
+        The index search settings are applied to the query's own transaction,
+        so they never leak to the next user of the pooled connection.
+
+        :param candidates: Rows the index scan must be able to return.
+        """
+        with self.transaction() as connection, connection.cursor(cursor_factory=cursor_factory) as cursor:
+            self._configure_ann_session(cursor, candidates)
+            yield cursor
+
+    def _configure_ann_session(self, cursor, candidates):
+        """
+        Applies the index search settings to the current transaction.
+
+        An HNSW scan returns at most hnsw.ef_search rows before the space and
+        file filters, so ef_search is raised to the candidate limit; on pgvector
+        0.8+ iterative scans keep searching until enough rows pass the filters.
+        """
+        method = self.config["ann_index_method"]
+        settings = {}
+        if method == "ivfflat":
+            if self.config["ann_probes"]:
+                settings["ivfflat.probes"] = int(self.config["ann_probes"])
+        else:
+            settings["hnsw.ef_search"] = min(max(int(self.config["ann_ef_search"] or 0), candidates), HNSW_MAX_EF_SEARCH)
+        iterative = self.config["ann_iterative_scan"]
+        if iterative != "off" and self._vector_extension_version(cursor) >= (0, 8):
+            # ivfflat only supports relaxed ordering
+            settings[f"{method}.iterative_scan"] = "relaxed_order" if method == "ivfflat" else iterative
+        for name, value in settings.items():
+            cursor.execute("SELECT set_config(%s, %s, true);", (name, str(value)))
+
+    def _vector_extension_version(self, cursor):
+        """:return: Installed pgvector version as a tuple of ints, e.g. (0, 8, 0)."""
+        if self._pgvector_version is None:
+            # A plain cursor, as the caller's may return dicts
+            with cursor.connection.cursor() as plain:
+                plain.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';")
+                row = plain.fetchone()
+            version = row[0] if row else "0"
+            self._pgvector_version = tuple(int(part) for part in version.split(".") if part.isdigit())
+        return self._pgvector_version
+
+    def _vector_order(self, alias=""):
+        """
+        Ordering of the first search phase, with one placeholder for the query vector.
+
+        Uses the halfvec or bit column when ANN_COMPACT is set, so the search
+        walks the smaller index, otherwise the full-precision embedding.
+        """
+        compact = self.config["ann_compact"]
+        if compact == "halfvec":
+            return f"{alias}embedding_half <=> %s::vector::halfvec"
+        if compact == "binary":
+            return f"{alias}embedding_bits <~> binary_quantize(%s::vector)"
+        return f"{alias}embedding <=> %s::vector"
+
+    def _candidate_limit(self, limit):
+        if self.config["ann_compact"] in ("halfvec", "binary"):
+            return limit * max(self.config["ann_compact_rescore"], 1)
+        return limit
+
+    def _ann_candidates(self, query_embedding, schema, table, space, filename, limit):
+        """
+        Runs the index-ordered vector query.
+
+        With ANN_COMPACT the index on the compact column selects the candidates,
+        which are then reranked by their full-precision cosine similarity.
+
+        :return: List of (id, pageno, context, metadata, source, imagepath, numtokens, similarity) rows.
+        """
+        vector = to_vector_literal(query_embedding)
+        order = self._vector_order()
+        with self.ann_cursor(self._candidate_limit(limit)) as cursor:
+            if filename:
+                cursor.execute(f"""
+                    SELECT id, pageno, context, metadata, source, imagepath, COALESCE(numtokens, 0),
+                           1 - (embedding <=> %s::vector) AS similarity
+                    FROM (
+                        SELECT id, pageno, context, metadata, source, imagepath, numtokens, embedding
+                        FROM {schema}.{table} where space_id = (SELECT id FROM org.spaces WHERE name = %s)
+                        and file_id IN (SELECT id FROM org.spaces_files WHERE name = %s)
+                        ORDER BY {order}
+                        LIMIT %s
+                    ) AS candidates
+                    ORDER BY similarity DESC
+                    LIMIT %s
+                """, (vector, space, filename, vector, self._candidate_limit(limit), limit))
+            else:
+                cursor.execute(f"""
+                    SELECT id, pageno, context, metadata, source, imagepath, COALESCE(numtokens, 0),
+                           1 - (embedding <=> %s::vector) AS similarity
+                    FROM (
+                        SELECT id, pageno, context, metadata, source, imagepath, numtokens, embedding
+                        FROM {schema}.{table} where space_id = (SELECT id FROM org.spaces WHERE name = %s)
+                        ORDER BY {order}
+                        LIMIT %s
+                    ) AS candidates
+                    ORDER BY similarity DESC
+                    LIMIT %s
+                """, (vector, space, vector, self._candidate_limit(limit), limit))
+            return cursor.fetchall()
+
+    def _lexical_candidates(self, query_text, schema, table, space, filename, limit):
+        """
+        Runs the full-text query over the GIN-indexed context_tsv column, and
+        over tabletext_tsv for chunks holding a table (see upgradeto2.9.py).
+
+        The question's terms are OR-ed together so a single exact identifier is
+        enough to match, and ts_rank (length-normalized) orders the matches.
+        Tables use the ``simple`` configuration, so codes, names and numbers in
+        their cells match as written.
+
+        :return: List of (id, pageno, context, metadata, source, imagepath, rank) rows.
+        """
+        fts_config = self.config["fts_config"]
+        with self.search_connection() as connection, connection.cursor() as cursor:
+            if filename:
+                cursor.execute(f"""
+                    SELECT id, pageno, context, metadata, source, imagepath,
+                           GREATEST(ts_rank(context_tsv, query, 1), ts_rank(tabletext_tsv, table_query, 1)) AS rank
+                    FROM {schema}.{table}, replace(plainto_tsquery(%s::regconfig, %s)::text, '&', '|')::tsquery AS query,
+                         replace(plainto_tsquery('simple', %s)::text, '&', '|')::tsquery AS table_query
+                    where space_id = (SELECT id FROM org.spaces WHERE name = %s)
+                    and file_id IN (SELECT id FROM org.spaces_files WHERE name = %s) and (context_tsv @@ query or tabletext_tsv @@ table_query)
+                    ORDER BY rank DESC
+                    LIMIT %s
+                """, (fts_config, query_text, query_text, space, filename, limit))
+            else:
+                cursor.execute(f"""
+                    SELECT id, pageno, context, metadata, source, imagepath,
+                           GREATEST(ts_rank(context_tsv, query, 1), ts_rank(tabletext_tsv, table_query, 1)) AS rank
+                    FROM {schema}.{table}, replace(plainto_tsquery(%s::regconfig, %s)::text, '&', '|')::tsquery AS query,
+                         replace(plainto_tsquery('simple', %s)::text, '&', '|')::tsquery AS table_query
+                    where space_id = (SELECT id FROM org.spaces WHERE name = %s)
+                    and (context_tsv @@ query or tabletext_tsv @@ table_query)
+                    ORDER BY rank DESC
+                    LIMIT %s
+                """, (fts_config, query_text, query_text, space, limit))
+            return cursor.fetchall()
+
+    def get_top_chunks_ann(self, query_embedding, schema, table, space, filename=None, numrows=5):
+        """
+        Retrieves the top chunks using the pgvector ANN index.
+
+        The index returns the ``ann_candidates`` nearest rows by cosine distance,
+        which are then re-scored with the same ``numtokens`` weighting as the
+        exact search so both modes rank results the same way.
+
+        :return: List of (pageno, context, metadata, source, imagepath, score) tuples.
+        """
+        candidates = max(int(self.config["ann_candidates"]), numrows)
+        try:
+            rows = self._ann_candidates(query_embedding, schema, table, space, filename, candidates)
+        except psycopg2.Error as e:
+            self._raise_if_deadline(e)
+            print(f"Error searching embeddings: {e}")
+            return []
+        return self._weighted(rows)[:numrows]
+
+    def _weighted(self, rows):
+        """Re-scores vector candidates with the numtokens weighting, best first."""
+        results = []
+        for row_id, pageno, context, metadata, source, imagepath, numtokens, similarity in rows:
+            if similarity is None:
+                continue
+            weighted_similarity = similarity * (1 + 0.01 * numtokens)
+            results.append((pageno, context, metadata, source, imagepath, weighted_similarity))
+        results.sort(key=lambda x: x[-1], reverse=True)
+        return results
+
+    def get_top_chunks_hybrid(self, query_embedding, query_text, schema, table, space, filename=None, numrows=5):
+        """
+        Retrieves the top chunks by fusing full-text and vector search.
+
+        Both legs run concurrently, each as one indexed query, and their rankings
+        are combined with reciprocal rank fusion, so a page that matches an exact
+        identifier surfaces even when its embedding is not among the nearest.
+
+        :return: List of (pageno, context, metadata, source, imagepath, score) tuples.
+        """
+        candidates = max(int(self.config["hybrid_candidates"]), numrows)
+        deadline = getattr(self._search_deadline, "value", None)
+        vector_leg = self._search_leg(deadline, self._ann_candidates, query_embedding, schema, table, space, filename, candidates)
+        lexical_leg = self._search_leg(deadline, self._lexical_candidates, query_text, schema, table, space, filename, candidates)
+        try:
+            vector_rows = vector_leg.result()
+        except psycopg2.Error as e:
+            self._raise_if_deadline(e)
+            print(f"Error searching embeddings: {e}")
+            vector_rows = []
+        try:
+            lexical_rows = lexical_leg.result()
+        except psycopg2.Error as e:
+            self._raise_if_deadline(e)
+            print(f"Error searching context: {e}")
+            lexical_rows = []
+
+        rows = {}
+        vector_ranking = []
+        for row in sorted(vector_rows, key=lambda r: (r[7] or 0) * (1 + 0.01 * r[6]), reverse=True):
+            rows[row[0]] = row[1:6]
+            vector_ranking.append(row[0])
+        lexical_ranking = []
+        for row in lexical_rows:
+            rows[row[0]] = row[1:6]
+            lexical_ranking.append(row[0])
+
+        fused = reciprocal_rank_fusion([vector_ranking, lexical_ranking], k=self.config["rrf_k"])
+        return [rows[row_id] + (score,) for row_id, score in fused[:numrows]]
+
+    def _search_leg(self, deadline, search, *args):
+        """
+        Starts one leg of a hybrid search and returns its future.
+
+        Under a search deadline the caller already runs on a federated search
+        thread, so the leg runs right there rather than queueing on a second
+        executor; otherwise it runs on the search executor.
+        """
+        if deadline is None:
+            return self._search_executor.submit(search, *args)
+        future = Future()
+        try:
+            with self.search_deadline(deadline):
+                future.set_result(search(*args))
         except Exception as e:
-            print(e)
-            rows = ""
-        return rows
+            future.set_exception(e)
+        return future
+
+    def disk_index_path(self, space):
+        return index_path(os.path.join(self.config["spaces_root"], space))
+
+    def rebuild_disk_index(self, schema, table, space, force=False):
+        """
+        Writes the memory-mapped index of a space from the rows in Postgres.
+
+        Concurrent callers wait for the first rebuild and reuse its index.
+
+        :param force: Rebuild even when the current index is complete.
+        """
+        path = self.disk_index_path(space)
+        with DiskVectorIndex.locked(path):
+            if not force:
+                index = self.disk_indexes.open(path)
+                if index is not None and index.built:
+                    return index
+            entry = self.load_space_matrix(schema, table, space)
+            if entry is None:
+                return None
+            dim = entry.matrix.shape[1] if len(entry.ids) else self.get_vector_dimension()
+            if dim is None:
+                return None
+            rows = [{"pageno": row[0], "source": row[3], "imagepath": row[4]} for row in entry.rows]
+            DiskVectorIndex.build(path, dim, entry.ids, entry.matrix, entry.numtokens, rows, dtype=self.config["disk_index_dtype"])
+        return self.disk_indexes.open(path)
 
+    def append_to_disk_index(self, space, ids, embeddings, numtokens, rows):
+        """Adds newly indexed rows to the space's disk index, if it has a complete one."""
+        path = self.disk_index_path(space)
+        with DiskVectorIndex.locked(path):
+            index = self.disk_indexes.open(path)
+            if index is None or not index.built:
+                return
+            try:
+                DiskVectorIndex.append(path, ids, embeddings, numtokens, rows)
+            except ValueError as e:
+                print(f"Error updating disk index, rebuilding it on the next query: {e}")
+                DiskVectorIndex.mark_stale(path)
 
+    def reset_disk_index(self, space):
+        """Marks the space's disk index stale after rows were removed; it is rebuilt on the next query."""
+        path = self.disk_index_path(space)
+        with DiskVectorIndex.locked(path):
+            DiskVectorIndex.mark_stale(path)
+
+    def get_top_chunks_disk(self, query_embedding, schema, table, space, filename=None, numrows=5):
+        """
+        Retrieves the top chunks from the space's memory-mapped index.
+
+        The index is built from Postgres the first time a space is queried. Only
+        the context of the winning rows is read from the database.
+
+        :return: List of (pageno, context, metadata, source, imagepath, score) tuples.
+        """
+        index = self.disk_indexes.open(self.disk_index_path(space))
+        if index is None or not index.built:
+            index = self.rebuild_disk_index(schema, table, space)
+            if index is None:
+                return []
+        ids, scores = index.search(query_embedding, numrows, filename=filename, rescore_factor=self.config["disk_index_rescore"])
+        if len(ids) == 0:
+            return []
+        try:
+            with self.search_connection() as connection, connection.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT id, pageno, context, metadata, source, imagepath
+                    FROM {schema}.{table} WHERE id = ANY(%s)
+                """, ([int(i) for i in ids],))
+                rows = {row[0]: row[1:] for row in cursor.fetchall()}
+        except psycopg2.Error as e:
+            self._raise_if_deadline(e)
+            print(f"Error fetching embeddings: {e}")
+            return []
+        # Rows deleted since the index was written are skipped
+        return [rows[int(i)] + (float(score),) for i, score in zip(ids, scores) if int(i) in rows]
@@ -3,6 +3,7 @@ CREATE TABLE org.spaces (
     id SERIAL PRIMARY KEY,
     name VARCHAR(255) UNIQUE NOT NULL,
     total_file_size_mb NUMERIC DEFAULT 0, -- Total file size on disk in megabytes
+    index_version INTEGER NOT NULL DEFAULT 0, -- Incremented whenever the indexed contents change
     created date NOT NULL
 );
 
@@ -25,7 +26,9 @@ CREATE TABLE org.spaces_conversations (
     file_id INTEGER REFERENCES org.spaces_files(id),
     related_message_id INTEGER REFERENCES org.spaces_conversations(id), -- Self-referencing column to indicate the related message
     user_ip INET NOT NULL, -- Column to store the user's IP address
-    embedding VECTOR(768) -- Column to store the vector representation of the conversation
+    embedding VECTOR(768), -- Column to store the vector representation of the conversation
+    citations JSONB, -- Citations returned with an AI answer
+    index_version INTEGER -- Space index_version the message was answered against
 );
 
 
@@ -42,9 +45,20 @@ CREATE TABLE IF NOT EXISTS org.spaces_embeddings (
     source TEXT,
     imagepath TEXT,
     file_id INTEGER REFERENCES org.spaces_files(id), -- Foreign key to spaces_files table
+    space_id INTEGER REFERENCES org.spaces(id), -- Space of the file, filtered on by retrieval
+    content_hash CHAR(64), -- Key of the vector in org.embedding_store
     created date NOT NULL
 );
 
+-- Content-addressed embeddings shared by identical texts across files, spaces and conversations
+CREATE TABLE IF NOT EXISTS org.embedding_store (
+    model VARCHAR(255) NOT NULL,
+    content_hash CHAR(64) NOT NULL, -- sha256 of the model name and the normalized text
+    embedding VECTOR(768) NOT NULL,
+    created TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (model, content_hash)
+);
+
 ALTER TABLE IF EXISTS org.spaces_embeddings
     OWNER TO postgres;
 
@@ -57,6 +71,11 @@ CREATE INDEX IF NOT EXISTS idx_spaces_conversations_file_id ON org.spaces_conver
 -- Create indexes on the embeddings table
 CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_id ON org.spaces_embeddings(id);
 CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_source ON org.spaces_embeddings(source);
+CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_space_file ON org.spaces_embeddings(space_id, file_id);
+CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_content_hash ON org.spaces_embeddings(content_hash);
+CREATE INDEX IF NOT EXISTS idx_spaces_conversations_space_file ON org.spaces_conversations(space_id, file_id);
+CREATE INDEX IF NOT EXISTS idx_spaces_conversations_related_message_id ON org.spaces_conversations(related_message_id);
+CREATE INDEX IF NOT EXISTS idx_spaces_conversations_embedding_hnsw ON org.spaces_conversations USING hnsw (embedding vector_cosine_ops);
 
 -- Create the necessary triggers
 
@@ -93,3 +112,57 @@ CREATE TRIGGER after_delete_files
 AFTER DELETE ON org.spaces_files
 FOR EACH ROW
 EXECUTE FUNCTION decrease_total_file_size();
+
+-- Approximate nearest neighbour index used when RETRIEVAL_MODE=ann
+CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_embedding_hnsw ON org.spaces_embeddings USING hnsw (embedding vector_cosine_ops);
+
+-- Full-text search over the page text used when RETRIEVAL_MODE=hybrid
+ALTER TABLE org.spaces_embeddings
+    ADD COLUMN IF NOT EXISTS context_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english'::regconfig, coalesce(context, ''))) STORED;
+CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_context_tsv ON org.spaces_embeddings USING gin (context_tsv);
+
+-- The compact halfvec/binary copies searched when ANN_COMPACT is set are optional,
+-- run upgradeto2.6.py to add them
+
+
+-- Background jobs such as PDF conversion, claimed by the workers in jobs/worker.py
+CREATE TABLE IF NOT EXISTS org.jobs (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(16) NOT NULL DEFAULT 'queued'
+        CHECK (status IN ('queued', 'running', 'succeeded', 'failed', 'cancelled')),
+    pages_done INTEGER NOT NULL DEFAULT 0,
+    pages_total INTEGER,
+    errors JSONB NOT NULL DEFAULT '[]',
+    last_error TEXT,
+    result JSONB,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    cancel_requested BOOLEAN NOT NULL DEFAULT false,
+    worker VARCHAR(255),
+    heartbeat TIMESTAMPTZ,
+    run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+    created TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started TIMESTAMPTZ,
+    finished TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_queued ON org.jobs (run_after, id) WHERE status = 'queued';
+
+-- Per-file and per-page hashes, so re-indexing only touches the pages that changed
+ALTER TABLE org.spaces_files ADD COLUMN IF NOT EXISTS content_hash CHAR(64); -- sha256 of the file when it was last fully indexed
+CREATE TABLE IF NOT EXISTS org.spaces_pages (
+    file_id INTEGER NOT NULL REFERENCES org.spaces_files(id) ON DELETE CASCADE,
+    pageno INTEGER NOT NULL,
+    page_hash CHAR(64) NOT NULL, -- extractor.page_hash of the page when it was indexed
+    indexed TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (file_id, pageno)
+);
+CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_file_pageno ON org.spaces_embeddings(file_id, pageno);
+
+-- Full-text index over the Markdown tables of table chunks, matched as written by the hybrid retrieval
+ALTER TABLE org.spaces_embeddings
+    ADD COLUMN IF NOT EXISTS tabletext_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, coalesce(tabletext, ''))) STORED;
+CREATE INDEX IF NOT EXISTS idx_spaces_embeddings_tabletext_tsv ON org.spaces_embeddings USING gin (tabletext_tsv);
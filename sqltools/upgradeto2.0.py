@@ -1,9 +1,13 @@
 import os
+import sys
 import json
-import requests
+import numpy as np
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 from dotenv import load_dotenv
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from embedlib.backends import get_backend
+from embedlib.store import EmbeddingStore
 
 # Load environment variables
 load_dotenv()
@@ -14,6 +18,7 @@ DBUSER = os.environ.get("DBUSER")
 DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
 HOST = os.environ.get("HOST")
 PORT = os.environ.get("PORT")
+BULK_PAGE_SIZE = int(os.environ.get("BULK_PAGE_SIZE", "500"))
 
 def get_db_connection():
     return psycopg2.connect(
@@ -83,18 +88,14 @@ def read_file_content(file_path):
 def sanitize_content(content):
     return content.replace('\x00', '')  # Remove null characters
 
-def get_embedding_from_api(prompt):
-    url = "http://localhost:11434/api/embeddings"
-    payload = {
-        "model": "nomic-embed-text",
-        "prompt": prompt
-    }
-    headers = {
-        "Content-Type": "application/json"
-    }
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
-    response.raise_for_status()
-    return response.json()["embedding"]
+embedding_store = EmbeddingStore(get_backend())
+
+def get_embedding_from_api(conn, prompt):
+    # Reuses the stored vector when the same text was embedded before
+    embedding = embedding_store.embed(conn, [prompt])[0][0]
+    if np.isnan(embedding).any():
+        raise RuntimeError("Could not embed file content")
+    return embedding.tolist()
 
 def update_embeddings_for_file(conn, space_id, file_id, file_path):
     with conn.cursor(cursor_factory=DictCursor) as cursor:
@@ -105,30 +106,38 @@ def update_embeddings_for_file(conn, space_id, file_id, file_path):
             # If no embeddings exist for this file, create them
             context = read_file_content(file_path)
             context = sanitize_content(context)  # Sanitize the content
-            embedding = get_embedding_from_api(context)  # Get embedding from API
+            embedding = get_embedding_from_api(conn, context)  # Get embedding from store or API
             metadata = {"space_id": space_id, "file_id": file_id}
             cursor.execute("""
-                INSERT INTO org.spaces_embeddings (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (1, json.dumps(metadata), context, embedding, len(context.split()), 0.0, '', file_path, file_path, file_id))
+                INSERT INTO org.spaces_embeddings (pageno, metadata, context, embedding, numtokens, cost, tabletext, source, imagepath, file_id, space_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (1, json.dumps(metadata), context, embedding, len(context.split()), 0.0, '', file_path, file_path, file_id, space_id))
 
 def update_conversations_embeddings(conn):
     with conn.cursor(cursor_factory=DictCursor) as cursor:
         cursor.execute("SELECT * FROM org.spaces_conversations")
         conversations = cursor.fetchall()
 
-        for conversation in conversations:
-            if conversation['embedding'] is None:
-                embedding = get_embedding_from_api(conversation['text'])  # Get embedding from API
-                cursor.execute(
-                    "UPDATE org.spaces_conversations SET embedding = %s WHERE id = %s",
-                    (embedding, conversation['id'])
-                )
+        missing = [conversation for conversation in conversations if conversation['embedding'] is None]
+        embeddings = embedding_store.embed(conn, [conversation['text'] for conversation in missing])[0]
+        updates = []
+        for conversation, embedding in zip(missing, embeddings):
+            if np.isnan(embedding).any():
+                print(f"Could not embed conversation {conversation['id']}")
+                continue
+            updates.append((conversation['id'], embedding.tolist()))
+        # One statement per BULK_PAGE_SIZE conversations instead of one per row
+        execute_values(cursor, """
+            UPDATE org.spaces_conversations AS c SET embedding = v.embedding::vector
+            FROM (VALUES %s) AS v (id, embedding)
+            WHERE c.id = v.id
+        """, updates, page_size=BULK_PAGE_SIZE)
 
 def main():
     conn = get_db_connection()
     try:
         create_indexes(conn)
+        embedding_store.ensure_table(conn)
         update_spaces_table(conn)
         update_conversations_embeddings(conn)
         conn.commit()
@@ -0,0 +1,74 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+# Index settings, see https://github.com/pgvector/pgvector#indexing
+ANN_INDEX_METHOD = os.environ.get("ANN_INDEX_METHOD", "hnsw")
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "64"))
+IVFFLAT_LISTS = os.environ.get("IVFFLAT_LISTS")
+MAINTENANCE_WORK_MEM = os.environ.get("MAINTENANCE_WORK_MEM", "1GB")
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def ivfflat_lists(conn):
+    # pgvector recommends rows / 1000 lists up to 1M rows and sqrt(rows) above that
+    if IVFFLAT_LISTS:
+        return int(IVFFLAT_LISTS)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM org.spaces_embeddings WHERE embedding IS NOT NULL")
+        rows = cursor.fetchone()[0]
+    if rows > 1000000:
+        return max(int(rows ** 0.5), 1)
+    return max(rows // 1000, 1)
+
+def create_ann_index(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+        if ANN_INDEX_METHOD == "ivfflat":
+            lists = ivfflat_lists(conn)
+            print(f"Building ivfflat index with {lists} lists")
+            cursor.execute(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_embeddings_embedding_ivfflat
+                ON org.spaces_embeddings USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists});
+            """)
+        else:
+            print(f"Building hnsw index with m={HNSW_M}, ef_construction={HNSW_EF_CONSTRUCTION}")
+            cursor.execute(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_embeddings_embedding_hnsw
+                ON org.spaces_embeddings USING hnsw (embedding vector_cosine_ops)
+                WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});
+            """)
+        cursor.execute("ANALYZE org.spaces_embeddings")
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        create_ann_index(conn)
+        print("ANN index is ready, set RETRIEVAL_MODE=ann to use it")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+# Must match FTS_CONFIG used by DataKeeper for the query side
+FTS_CONFIG = os.environ.get("FTS_CONFIG", "english")
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def add_tsvector_column(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT %s::regconfig", (FTS_CONFIG,))
+        print(f"Adding context_tsv with text search configuration {FTS_CONFIG}")
+        cursor.execute(f"""
+            ALTER TABLE org.spaces_embeddings
+            ADD COLUMN IF NOT EXISTS context_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('{FTS_CONFIG}'::regconfig, coalesce(context, ''))) STORED;
+        """)
+
+def create_fts_index(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_embeddings_context_tsv
+            ON org.spaces_embeddings USING gin (context_tsv);
+        """)
+        cursor.execute("ANALYZE org.spaces_embeddings")
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        add_tsvector_column(conn)
+        create_fts_index(conn)
+        print("Full-text index is ready, set RETRIEVAL_MODE=hybrid to use it")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
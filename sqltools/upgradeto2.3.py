@@ -0,0 +1,116 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", "10000"))
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def add_space_id_column(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            ALTER TABLE org.spaces_embeddings
+            ADD COLUMN IF NOT EXISTS space_id INTEGER REFERENCES org.spaces(id);
+        """)
+
+def backfill_file_ids(conn):
+    # Older rows were written without file_id, match them to their file by name within the space.
+    # Rows without a matching file keep a NULL file_id, so batches walk the ids instead of
+    # repeating until nothing is left.
+    total = 0
+    last_id = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT max(id) FROM (
+                    SELECT id FROM org.spaces_embeddings
+                    WHERE file_id IS NULL AND id > %s
+                    ORDER BY id
+                    LIMIT %s
+                ) batch;
+            """, (last_id, BACKFILL_BATCH_SIZE))
+            batch_end = cursor.fetchone()[0]
+            if batch_end is None:
+                break
+            cursor.execute("""
+                UPDATE org.spaces_embeddings e
+                SET file_id = (
+                    SELECT max(f.id) FROM org.spaces_files f
+                    JOIN org.spaces s ON s.id = f.space_id
+                    WHERE f.name = e.source AND s.name = e.metadata->>'space'
+                )
+                WHERE e.file_id IS NULL AND e.id > %s AND e.id <= %s;
+            """, (last_id, batch_end))
+            total += cursor.rowcount
+        last_id = batch_end
+        print(f"Matched file_id for {total} rows")
+
+def backfill_space_ids(conn):
+    # Batches keep each transaction (and its row locks) short on large tables.
+    # Only rows whose file has a space are picked, so every batch shrinks what is left.
+    total = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE org.spaces_embeddings e
+                SET space_id = f.space_id
+                FROM org.spaces_files f
+                WHERE e.id IN (
+                    SELECT e2.id FROM org.spaces_embeddings e2
+                    JOIN org.spaces_files f2 ON f2.id = e2.file_id
+                    WHERE e2.space_id IS NULL AND f2.space_id IS NOT NULL
+                    LIMIT %s
+                )
+                AND f.id = e.file_id;
+            """, (BACKFILL_BATCH_SIZE,))
+            updated = cursor.rowcount
+        total += updated
+        if updated == 0:
+            break
+        print(f"Backfilled space_id for {total} rows")
+
+def create_indexes(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_embeddings_space_file
+            ON org.spaces_embeddings(space_id, file_id);
+        """)
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_conversations_space_file
+            ON org.spaces_conversations(space_id, file_id);
+        """)
+        cursor.execute("ANALYZE org.spaces_embeddings")
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        add_space_id_column(conn)
+        backfill_file_ids(conn)
+        backfill_space_ids(conn)
+        create_indexes(conn)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
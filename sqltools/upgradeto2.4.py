@@ -0,0 +1,61 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def add_answer_cache_columns(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            ALTER TABLE org.spaces
+            ADD COLUMN IF NOT EXISTS index_version INTEGER NOT NULL DEFAULT 0;
+        """)
+        cursor.execute("""
+            ALTER TABLE org.spaces_conversations
+            ADD COLUMN IF NOT EXISTS citations JSONB,
+            ADD COLUMN IF NOT EXISTS index_version INTEGER;
+        """)
+
+def create_indexes(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_conversations_related_message_id
+            ON org.spaces_conversations(related_message_id);
+        """)
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_conversations_embedding_hnsw
+            ON org.spaces_conversations USING hnsw (embedding vector_cosine_ops);
+        """)
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        # Existing conversations have no index_version and are never served from the cache
+        add_answer_cache_columns(conn)
+        create_indexes(conn)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
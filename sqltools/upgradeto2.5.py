@@ -0,0 +1,58 @@
+import os
+import sys
+import psycopg2
+from dotenv import load_dotenv
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from embedlib.backends import get_backend
+from embedlib.store import EmbeddingStore
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def add_content_hash_column(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            ALTER TABLE org.spaces_embeddings
+            ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+        """)
+
+def create_indexes(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_embeddings_content_hash
+            ON org.spaces_embeddings(content_hash);
+        """)
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        # Rows indexed before this version keep a NULL content_hash; the store
+        # fills up as files are converted again
+        EmbeddingStore(get_backend()).ensure_table(conn)
+        add_content_hash_column(conn)
+        create_indexes(conn)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+# Compact representations to build: "halfvec", "binary" or "both" (requires pgvector >= 0.7)
+COMPACT_VECTORS = os.environ.get("COMPACT_VECTORS", "both")
+COMPACT_BATCH_SIZE = int(os.environ.get("COMPACT_BATCH_SIZE", "5000"))
+EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "768"))
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "64"))
+MAINTENANCE_WORK_MEM = os.environ.get("MAINTENANCE_WORK_MEM", "1GB")
+# Drops the full-precision HNSW index once the compact one exists, the largest memory saving
+DROP_FULL_INDEX = os.environ.get("DROP_FULL_INDEX", "false").lower() == "true"
+
+TABLES = ["spaces_embeddings", "spaces_conversations"]
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def add_compact_columns(conn):
+    with conn.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(f"""
+                ALTER TABLE org.{table}
+                ADD COLUMN IF NOT EXISTS embedding_half halfvec({EMBEDDING_DIMENSION}),
+                ADD COLUMN IF NOT EXISTS embedding_bits bit({EMBEDDING_DIMENSION});
+            """)
+
+def create_trigger(conn):
+    # New and re-embedded rows get their compact copies on write, so only
+    # existing rows need the batched backfill below
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION org.fill_compact_embeddings()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                NEW.embedding_half := NEW.embedding::halfvec;
+                NEW.embedding_bits := binary_quantize(NEW.embedding);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        for table in TABLES:
+            cursor.execute(f"DROP TRIGGER IF EXISTS fill_compact_embeddings ON org.{table};")
+            cursor.execute(f"""
+                CREATE TRIGGER fill_compact_embeddings
+                BEFORE INSERT OR UPDATE OF embedding ON org.{table}
+                FOR EACH ROW
+                EXECUTE FUNCTION org.fill_compact_embeddings();
+            """)
+
+def backfill(conn, table):
+    # Each batch commits on its own, keeping locks short and the run resumable
+    total = 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(f"""
+                UPDATE org.{table}
+                SET embedding_half = embedding::halfvec, embedding_bits = binary_quantize(embedding)
+                WHERE id IN (
+                    SELECT id FROM org.{table}
+                    WHERE embedding IS NOT NULL AND (embedding_half IS NULL OR embedding_bits IS NULL)
+                    ORDER BY id
+                    LIMIT %s
+                );
+            """, (COMPACT_BATCH_SIZE,))
+            if cursor.rowcount == 0:
+                break
+            total += cursor.rowcount
+            print(f"{table}: {total} rows populated")
+
+def create_indexes(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+        for table in TABLES:
+            if COMPACT_VECTORS in ("halfvec", "both"):
+                print(f"Building halfvec hnsw index on {table}")
+                cursor.execute(f"""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{table}_embedding_half_hnsw
+                    ON org.{table} USING hnsw (embedding_half halfvec_cosine_ops)
+                    WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});
+                """)
+            if COMPACT_VECTORS in ("binary", "both"):
+                print(f"Building binary hnsw index on {table}")
+                cursor.execute(f"""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{table}_embedding_bits_hnsw
+                    ON org.{table} USING hnsw (embedding_bits bit_hamming_ops)
+                    WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});
+                """)
+            if DROP_FULL_INDEX:
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS org.idx_{table}_embedding_hnsw;")
+            cursor.execute(f"ANALYZE org.{table}")
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        add_compact_columns(conn)
+        create_trigger(conn)
+        for table in TABLES:
+            backfill(conn, table)
+        create_indexes(conn)
+        print("Compact vectors are ready, set ANN_COMPACT=halfvec or ANN_COMPACT=binary to use them")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
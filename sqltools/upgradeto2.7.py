@@ -0,0 +1,66 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def create_jobs_table(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS org.jobs (
+                id SERIAL PRIMARY KEY,
+                kind VARCHAR(64) NOT NULL,
+                payload JSONB NOT NULL DEFAULT '{}',
+                status VARCHAR(16) NOT NULL DEFAULT 'queued'
+                    CHECK (status IN ('queued', 'running', 'succeeded', 'failed', 'cancelled')),
+                pages_done INTEGER NOT NULL DEFAULT 0,
+                pages_total INTEGER,
+                errors JSONB NOT NULL DEFAULT '[]',
+                last_error TEXT,
+                result JSONB,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                cancel_requested BOOLEAN NOT NULL DEFAULT false,
+                worker VARCHAR(255),
+                heartbeat TIMESTAMPTZ,
+                run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+                created TIMESTAMPTZ NOT NULL DEFAULT now(),
+                started TIMESTAMPTZ,
+                finished TIMESTAMPTZ
+            );
+        """)
+        # Workers only ever look for queued jobs
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_jobs_queued ON org.jobs (run_after, id) WHERE status = 'queued';
+        """)
+
+def main():
+    conn = get_db_connection()
+    try:
+        create_jobs_table(conn)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def add_hash_columns(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            ALTER TABLE org.spaces_files
+            ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS org.spaces_pages (
+                file_id INTEGER NOT NULL REFERENCES org.spaces_files(id) ON DELETE CASCADE,
+                pageno INTEGER NOT NULL,
+                page_hash CHAR(64) NOT NULL, -- extractor.page_hash of the page when it was indexed
+                indexed TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (file_id, pageno)
+            );
+        """)
+
+def create_indexes(conn):
+    with conn.cursor() as cursor:
+        # Re-indexing replaces the rows of one page at a time
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_embeddings_file_pageno
+            ON org.spaces_embeddings(file_id, pageno);
+        """)
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        # Files indexed before this version have no page hashes, so their next
+        # conversion replaces every page once, dropping any duplicated rows
+        add_hash_columns(conn)
+        create_indexes(conn)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
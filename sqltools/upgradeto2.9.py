@@ -0,0 +1,56 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection parameters
+DBNAME = os.environ.get("DBNAME")
+DBUSER = os.environ.get("DBUSER")
+DBUSERPASSWORD = os.environ.get("DBUSERPASSWORD")
+HOST = os.environ.get("HOST")
+PORT = os.environ.get("PORT")
+
+def get_db_connection():
+    return psycopg2.connect(
+        dbname=DBNAME,
+        user=DBUSER,
+        password=DBUSERPASSWORD,
+        host=HOST,
+        port=PORT
+    )
+
+def add_tsvector_column(conn):
+    with conn.cursor() as cursor:
+        # The simple configuration keeps codes, names and numbers in table cells as written
+        cursor.execute("""
+            ALTER TABLE org.spaces_embeddings
+            ADD COLUMN IF NOT EXISTS tabletext_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, coalesce(tabletext, ''))) STORED;
+        """)
+
+def create_fts_index(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_spaces_embeddings_tabletext_tsv
+            ON org.spaces_embeddings USING gin (tabletext_tsv);
+        """)
+        cursor.execute("ANALYZE org.spaces_embeddings")
+
+def main():
+    conn = get_db_connection()
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        # Tables are extracted when files are converted again; the extraction
+        # settings are part of the page hashes, so every page is re-indexed once
+        add_tsvector_column(conn)
+        create_fts_index(conn)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()